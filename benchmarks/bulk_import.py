@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Compares importing entries with attached files through DbManager.add() (one ORM object at a
+time) and through DbManager.bulk_insert().
+Run from the project root: python -m benchmarks.bulk_import [entries]
+"""
+
+import os
+import sys
+import tempfile
+from datetime import date
+from timeit import default_timer
+from diary.database import DbManager
+from diary.models import Entry, File, entry_files
+
+
+def import_objects(db, entries):
+    for number in range(entries):
+        entry = Entry(title="Entry {}".format(number), text="Some text", timestamp=date.today())
+        entry.files = [File(name="file_{}".format(number), ftype="jpg")]
+        db.add(entry)
+    db.commit()
+
+
+def import_bulk(db, entries):
+    db.bulk_insert(Entry, ({"id": number, "title": "Entry {}".format(number),
+                            "text": "Some text", "timestamp": date.today()}
+                           for number in range(1, entries + 1)))
+    db.bulk_insert(File, ({"id": number, "name": "file_{}".format(number), "type": "jpg",
+                           "timestamp": date.today()}
+                          for number in range(1, entries + 1)))
+    db.bulk_insert(entry_files, ({"entry_id": number, "file_id": number}
+                                 for number in range(1, entries + 1)))
+    db.commit()
+
+
+def run(entries=100000):
+    print("{:<10} {:>10}".format("path", "seconds"))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, function in (("add", import_objects), ("bulk", import_bulk)):
+            db = DbManager()
+            db.initialize(db=os.path.join(directory, name + ".db"))
+            start = default_timer()
+            function(db, entries)
+            print("{:<10} {:>10.3f}".format(name, default_timer() - start))
+            db.session.close()
+            db.engine.dispose()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
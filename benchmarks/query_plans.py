@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Shows the SQLite query plans and timings of the common access patterns of the diary: browsing
+entries by date range, finding files by name and finding the entries using a file.
+Run from the project root: python -m benchmarks.query_plans [entries]
+"""
+
+import sys
+from datetime import date, timedelta
+from timeit import default_timer
+from sqlalchemy.dialects import sqlite
+from diary.database import DbManager
+from diary.models import Entry, File, entry_files
+
+
+def populate(db, entries):
+    start = date(2000, 1, 1)
+    db.bulk_insert(Entry, ({"id": number, "title": "Entry {}".format(number), "text": "",
+                            "timestamp": start + timedelta(days=number % 7000)}
+                           for number in range(1, entries + 1)))
+    db.bulk_insert(File, ({"id": number, "name": "file_{}".format(number),
+                           "timestamp": start + timedelta(days=number % 7000)}
+                          for number in range(1, entries + 1)))
+    db.bulk_insert(entry_files, ({"entry_id": number, "file_id": (number * 7) % entries + 1}
+                                 for number in range(1, entries + 1)))
+    db.commit()
+
+
+def patterns(db):
+    return (("entries by date range",
+             db.read(Entry).filter(Entry.timestamp.between(date(2005, 1, 1), date(2005, 2, 1)))),
+            ("files by name", db.read(File).filter(File.name == "file_42")),
+            ("files by date", db.read(File).filter(File.timestamp >= date(2019, 1, 1))),
+            ("entries using a file",
+             db.read(Entry).join(Entry.files).filter(File.id == 42)))
+
+
+def run(entries=100000):
+    db = DbManager()
+    db.initialize()
+    populate(db, entries)
+    for name, query in patterns(db):
+        statement = str(query.statement.compile(dialect=sqlite.dialect(),
+                                                compile_kwargs={"literal_binds": True}))
+        plan = db.session.execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+        start = default_timer()
+        for _ in range(10):
+            query.all()
+        duration = (default_timer() - start) / 10
+        print("{} ({:.2f} ms)".format(name, duration * 1000))
+        for row in plan:
+            print("    " + row[-1])
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Compares the relationship loading strategies of DbManager.read() by reading all entries
+together with their files, like SqlAlchemyQueryModel does for the relation column.
+Run from the project root: python -m benchmarks.relation_loading [entries]
+"""
+
+import sys
+from timeit import default_timer
+from sqlalchemy import event
+from diary.database import DbManager
+from diary.models import Entry, File
+
+
+def populate(db, entries, files_per_entry=2):
+    for number in range(entries):
+        entry = Entry(title="Entry {}".format(number), text="Some text")
+        entry.files = [File(name="file_{}_{}".format(number, count))
+                       for count in range(files_per_entry)]
+        db.add(entry)
+    db.commit()
+
+
+def run(entries=10000):
+    db = DbManager()
+    db.initialize()
+    populate(db, entries)
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    print("{:<10} {:>10} {:>10}".format("strategy", "queries", "seconds"))
+    for strategy in DbManager.loading_strategies:
+        db.session.expunge_all()  # start every run with an empty identity map
+        statements[0] = 0
+        start = default_timer()
+        for entry in db.read(Entry, loading=strategy):
+            [file.name for file in entry.files]
+        duration = default_timer() - start
+        print("{:<10} {:>10} {:>10.3f}".format(strategy, statements[0], duration))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # coding=utf-8
 
+from asyncio import iscoroutinefunction
 from functools import wraps
 from utilities import MetaSingleton
 
@@ -66,6 +67,15 @@ class Component:
 
     @classmethod
     def dependent(cls, func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                if self.is_valid():
+                    return await func(self, *args, **kwargs)
+                else:
+                    raise ValueError("{} object is not in a valid state.".format(cls))
+            return async_wrapper
+
         @wraps(func)
         def wrapper(self, *args, **kwargs):
             if self.is_valid():
@@ -1,24 +1,219 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from sqlalchemy import create_engine, event, inspect, Table
+from sqlalchemy.orm import sessionmaker, scoped_session, lazyload, selectinload, joinedload, \
+    subqueryload, Query
 from sqlalchemy.engine.url import URL
+from sqlalchemy.pool import QueuePool
 from diary.application import Component
+from diary.migrations import Migrator
 from diary.models import Model
+from diary.search import create_search_index
 
 
 class DbManager(Component):
+    loading_strategies = {"select": lazyload,
+                          "selectin": selectinload,
+                          "joined": joinedload,
+                          "subquery": subqueryload}
+    # SQLite tuning, pragmas are run in this order on every new connection
+    sqlite_pragmas = ("page_size", "journal_mode", "synchronous", "cache_size", "mmap_size",
+                      "temp_store", "busy_timeout")
+    sqlite_pragma_choices = {"journal_mode": ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL",
+                                              "OFF"),
+                             "synchronous": ("OFF", "NORMAL", "FULL", "EXTRA"),
+                             "temp_store": ("DEFAULT", "FILE", "MEMORY")}
+    sqlite_profiles = {
+        # every commit is synced to disk before it returns
+        "durable": {"journal_mode": "WAL", "synchronous": "FULL", "cache_size": -8192,
+                    "mmap_size": 0, "temp_store": "DEFAULT"},
+        # a power loss may undo the latest commits, but never corrupts the database
+        "fast": {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -65536,
+                 "mmap_size": 268435456, "temp_store": "MEMORY"},
+        # for import runs that can simply be repeated if they fail
+        "bulk-load": {"journal_mode": "MEMORY", "synchronous": "OFF", "cache_size": -262144,
+                      "mmap_size": 268435456, "temp_store": "MEMORY"}
+    }
+
     def __init__(self):
         super(DbManager, self).__init__()
         self.engine = self.invalid_state("engine", None)
         self.session = self.invalid_state("session", None)
+        self._loading = "select"  # default strategy for loading relationships in read()
+        self._session_factory = None
+        self._pragmas = dict(self.sqlite_profiles["durable"])  # run on every SQLite connection
+        self._memory = False  # whether the database only exists in memory
+        self.search_index = None
+
+    def configure(self, config, section="database"):
+        """
+        Reads the optional database settings from a config manager (see configmanager module).
+        Supported keys of the section are: relation_loading, profile (see set_profile()) and the
+        SQLite pragmas of sqlite_pragmas, which override the values of the profile.
+        :param ManagerBase config: Config manager holding the settings
+        :param str section: optional - Section of the database settings
+        """
+        try:
+            self.set_loading(config.get("relation_loading", section))
+        except KeyError:
+            pass
+        try:
+            profile = config.get("profile", section)
+        except KeyError:
+            profile = None
+        pragmas = dict()
+        for pragma in self.sqlite_pragmas:
+            try:
+                pragmas[pragma] = config.get(pragma, section)
+            except KeyError:
+                pass
+        if profile or pragmas:
+            self.set_profile(profile, **pragmas)
+
+    def set_profile(self, profile=None, **pragmas):
+        """
+        Sets the SQLite tuning, either by a named profile of sqlite_profiles ('durable' is used by
+        default, 'fast' or 'bulk-load'), by single pragmas or both (pragmas override the profile).
+        Settings are applied to every new connection, page_size only affects new databases.
+        Changing the tuning of an open database commits the session of the calling thread, which
+        continues on a connection with the new settings. Sessions of other threads keep their
+        connection until they are released (see release_session()).
+        :param str profile: optional - Name of the profile
+        :param pragmas: optional - Values for the pragmas of sqlite_pragmas
+        """
+        settings = dict()
+        if profile is not None:
+            if profile not in self.sqlite_profiles:
+                raise ValueError("profile should be one of {}.".format(
+                    ", ".join(self.sqlite_profiles)))
+            settings.update(self.sqlite_profiles[profile])
+        settings.update(pragmas)
+        checked = dict()
+        for pragma, value in settings.items():
+            if pragma not in self.sqlite_pragmas:
+                raise ValueError("'{}' is no supported pragma.".format(pragma))
+            if pragma in self.sqlite_pragma_choices:
+                value = str(value).upper()
+                if value not in self.sqlite_pragma_choices[pragma]:
+                    raise ValueError("{} should be one of {}.".format(
+                        pragma, ", ".join(self.sqlite_pragma_choices[pragma])))
+            else:
+                value = int(value)
+            checked[pragma] = value
+        self._pragmas.update(checked)
+        if self.engine is not None and self.engine.dialect.name == "sqlite":
+            if self._memory:  # the only connection can't be replaced
+                self._set_pragmas(self.session.connection().connection, None)
+            else:  # new connections get the new settings
+                self.session.commit()
+                self.session.remove()  # gives the connection of the session back to the pool
+                self.engine.dispose()
+
+    @contextmanager
+    def using_profile(self, profile=None, **pragmas):
+        """
+        Context manager applying a SQLite tuning (see set_profile()) only for the block, i.e.
+        'bulk-load' during an import. Changes left uncommitted by a failing block are rolled back.
+        """
+        previous = dict(self._pragmas)
+        self.set_profile(profile, **pragmas)
+        try:
+            yield self
+        except BaseException:
+            if self.engine is not None:
+                self.session.rollback()
+            raise
+        finally:
+            self._pragmas = previous
+            self.set_profile()
+
+    def set_loading(self, strategy):
+        """
+        Sets the default strategy used by read() to load the relationships of queried models.
+        :param str strategy: One of 'select' (lazy), 'selectin', 'joined' or 'subquery'
+        """
+        if strategy not in self.loading_strategies:
+            raise ValueError("strategy should be one of {}.".format(
+                ", ".join(self.loading_strategies)))
+        self._loading = strategy
 
-    def initialize(self, driver="sqlite", db=None, user=None, password=None, host=None, port=None):
-        self.engine = create_engine(URL(drivername=driver, database=db, host=host, port=port,
-                                        username=user, password=password))
-        Model.metadata.create_all(self.engine)
-        self.session = sessionmaker(bind=self.engine)()
+    def initialize(self, driver="sqlite", db=None, user=None, password=None, host=None, port=None,
+                   pool_size=5, max_overflow=10, busy_timeout=5000):
+        """
+        Connects to the database and sets up the sessions. The session attribute is a registry
+        (scoped_session) handing out one session per thread, so worker threads can use the
+        DbManager methods next to the UI thread. For separate units of work see task_session().
+        SQLite connections are tuned by the profile set through set_profile() or configure(),
+        the default profile 'durable' opens files in WAL mode, which lets readers work while a
+        writer commits.
+        :param int pool_size: optional - Connections kept open in the pool
+        :param int max_overflow: optional - Connections opened additionally under load
+        :param int busy_timeout: optional - Milliseconds SQLite waits for a lock to be released
+        """
+        url = URL(drivername=driver, database=db, host=host, port=port,
+                  username=user, password=password)
+        self._memory = not db or db == ":memory:"
+        if driver.startswith("sqlite"):
+            if not self._memory:
+                # the connections of the pool are shared between threads (never concurrently)
+                self.engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size,
+                                            max_overflow=max_overflow,
+                                            connect_args={"check_same_thread": False})
+            else:  # every connection would see its own in-memory database
+                self.engine = create_engine(url)
+            self._pragmas["busy_timeout"] = int(busy_timeout)
+            event.listen(self.engine, "connect", self._set_pragmas)
+        else:
+            self.engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                                        pool_pre_ping=True)
+        Migrator(self.engine).upgrade()
+        self.search_index = create_search_index(self.engine)
+        self._session_factory = sessionmaker(bind=self.engine)
+        self.session = scoped_session(self._session_factory)
+
+    def _set_pragmas(self, connection, record):
+        cursor = connection.cursor()
+        for pragma in self.sqlite_pragmas:
+            if pragma not in self._pragmas:
+                continue
+            if self._memory and pragma in ("journal_mode", "mmap_size"):
+                continue  # not applicable to in-memory databases
+            # values are checked by set_profile(), so formatting them into the statement is safe
+            cursor.execute("PRAGMA {} = {}".format(pragma, self._pragmas[pragma]))
+        cursor.close()
+
+    @Component.dependent
+    @contextmanager
+    def task_session(self, expire_on_commit=True):
+        """
+        Context manager providing a separate session for a unit of work, i.e. a background task.
+        The session is committed when the block ends, rolled back on errors and closed in any
+        case.
+        :param bool expire_on_commit: optional - False keeps loaded attributes usable after the
+        block ended
+        """
+        session = self._session_factory(expire_on_commit=expire_on_commit)
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    @Component.dependent
+    def release_session(self):
+        """
+        Closes the session of the calling thread, worker threads should call this when done.
+        """
+        self.session.remove()
 
     def _session_action(self, action, *items):
         actions = ["add", "delete"]
@@ -36,8 +231,127 @@ class DbManager(Component):
         self._session_action("add", *items)
 
     @Component.dependent
-    def read(self, *args, **kwargs):
-        return self.session.query(*args, **kwargs)
+    def bulk_insert(self, target, rows, chunk_size=1000, progress=None):
+        """
+        Inserts many rows at once with executemany INSERT statements, bypassing the identity
+        map of the session. Meant for large imports, use add() for normal work. Like add() the
+        rows are part of the current transaction until commit() is called.
+        Row values are given by column name, missing values are inserted as NULL. Association
+        rows (i.e. entry_files) can be inserted by passing the Table, which needs the ids of the
+        related rows, so give the imported rows explicit ids in that case.
+        :param target: Model class or association Table to insert into
+        :param Iterable rows: dicts of column values, may be a generator
+        :param int chunk_size: optional - Number of rows sent per executemany
+        :param callable progress: optional - Called with the number of rows inserted so far
+        :return: Number of inserted rows
+        :rtype: int
+        """
+        if isinstance(target, Table):
+            table = target
+        elif isinstance(target, type) and issubclass(target, Model):
+            table = target.__table__
+        else:
+            raise TypeError("Rows can't be inserted into {}.".format(type(target)))
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive number.")
+        statement = table.insert()
+        rows = iter(rows)
+        inserted = 0
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            # executemany needs the same keys in every row
+            keys = set().union(*chunk)
+            unknown = keys.difference(table.columns.keys())
+            if unknown:
+                raise ValueError("{} has no columns {}.".format(table.name, ", ".join(unknown)))
+            self.session.execute(statement, [{key: row.get(key) for key in keys}
+                                             for row in chunk])
+            inserted += len(chunk)
+            if progress is not None:
+                progress(inserted)
+        return inserted
+
+    @Component.dependent
+    def read(self, *args, loading=None, **kwargs):
+        """
+        Returns a query for the given models or columns. The relationships of queried models are
+        loaded by the strategy set through set_loading() unless loading is given.
+        :param str loading: optional - Relationship loading strategy for this query only
+        :rtype: sqlalchemy.orm.query.Query
+        """
+        strategy = loading if loading else self._loading
+        if strategy not in self.loading_strategies:
+            raise ValueError("loading should be one of {}.".format(
+                ", ".join(self.loading_strategies)))
+        query = self.session.query(*args, **kwargs)
+        if strategy == "select":  # mapper default, no options needed
+            return query
+        loader = self.loading_strategies[strategy]
+        for column in query.column_descriptions:
+            if column["expr"] is column["type"] and isinstance(column["type"], type):
+                for relation in inspect(column["type"]).relationships.keys():
+                    query = query.options(loader(getattr(column["type"], relation)))
+        return query
+
+    @Component.dependent
+    def search(self, text, limit=None, highlight=("[", "]")):
+        """
+        Full-text search over title and text of all entries, see diary.search.
+        :param str text: Text to search for
+        :param int limit: optional - Maximum number of results
+        :param tuple highlight: optional - Markers put around matched terms in snippets
+        :return: Matching entries with rank and highlighted snippets, best first
+        :rtype: list of diary.search.SearchResult
+        """
+        return self.search_index.search(self.session, text, limit, highlight)
+
+    @Component.dependent
+    def filter_search(self, query, text):
+        """
+        Restricts a query for entries to those matching text in the full-text search.
+        :param sqlalchemy.orm.query.Query query: Query including the Entry model
+        :param str text: Text to search for
+        :rtype: sqlalchemy.orm.query.Query
+        """
+        return query.filter(self.search_index.condition(text))
+
+    @Component.dependent
+    def stream(self, *args, chunk_size=1000, plain=False):
+        """
+        Iterates over the result of a query in chunks of chunk_size rows (server side cursor
+        where the driver supports it), so the whole result never has to be in memory at once.
+        Relationships are loaded lazily, eager loading can't be combined with chunked results.
+        :param args: Models or columns to query for like read(), or a single prepared Query
+        :param int chunk_size: optional - Number of rows fetched at once
+        :param bool plain: optional - Yield plain result rows of column values instead of model
+        objects, which skips the identity map
+        :return: Generator of model objects, tuples of them or plain rows
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive number.")
+        if len(args) == 1 and isinstance(args[0], Query):
+            query = args[0]
+        else:
+            query = self.session.query(*args)
+        if not plain:
+            # eager loaders added by read() (see set_loading()) can't work on chunks
+            query = query.enable_eagerloads(False)
+            return iter(query.execution_options(stream_results=True).yield_per(chunk_size))
+        self.session.flush()  # executing the bare statement doesn't flush automatically
+        result = self.session.execute(query.statement.execution_options(stream_results=True))
+        return self._fetch_chunks(result, chunk_size)
+
+    @staticmethod
+    def _fetch_chunks(result, chunk_size):
+        try:
+            rows = result.fetchmany(chunk_size)
+            while rows:
+                yield from rows
+                rows = result.fetchmany(chunk_size)
+        finally:
+            result.close()
 
     @Component.dependent
     def delete(self, *items):
@@ -50,3 +364,86 @@ class DbManager(Component):
     @Component.dependent
     def rollback(self):
         self.session.rollback()
+
+
+class AsyncDbManager(Component):
+    """
+    Asyncio facade for a DbManager. Every call is a complete unit of work running in its own
+    session on a pool of worker threads, so the event loop is never blocked by the database.
+    Returned model objects are detached from any session but keep their loaded attributes,
+    relationships that weren't loaded can't be accessed anymore (see DbManager.read(loading=)).
+    The DbManager should use a database file, as every thread would see its own in-memory
+    database.
+    """
+    def __init__(self, db_manager=None, workers=4):
+        super(AsyncDbManager, self).__init__()
+        self._db = self.invalid_state("_db", None)
+        self._db = db_manager
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="diary-db")
+
+    def set(self, db_manager):
+        self._db = db_manager
+
+    def is_valid(self):
+        return super(AsyncDbManager, self).is_valid() and self._db.is_valid()
+
+    def _work(self, function, args):
+        with self._db.task_session(expire_on_commit=False) as session:
+            return function(session, *args)
+
+    @Component.dependent
+    async def run(self, function, *args):
+        """
+        Runs function(session, *args) on a worker thread and returns its result. The session is
+        committed afterwards or rolled back if function raised an error.
+        :param callable function: Function doing the work with the given session
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(self._work, function, args))
+
+    @Component.dependent
+    async def add(self, *items):
+        for item in items:
+            if not isinstance(item, Model):
+                raise TypeError("Item of {} can't be appended to a commit.".format(type(item)))
+        await self.run(lambda session: session.add_all(items))
+
+    @Component.dependent
+    async def delete(self, *items):
+        for item in items:
+            if not isinstance(item, Model):
+                raise TypeError("Item of {} can't be deleted.".format(type(item)))
+        await self.run(lambda session: [session.delete(session.merge(item)) for item in items])
+
+    @Component.dependent
+    async def read(self, *args, loading=None, where=None, limit=None):
+        """
+        Returns the whole result of a query like DbManager.read() as list.
+        :param str loading: optional - Relationship loading strategy, see DbManager.read()
+        :param where: optional - SQL expression to filter the query by
+        :param int limit: optional - Maximum number of results
+        :rtype: list
+        """
+        def query(session):
+            result = self._db.read(*args, loading=loading).with_session(session)
+            if where is not None:
+                result = result.filter(where)
+            if limit is not None:
+                result = result.limit(limit)
+            return result.all()
+        return await self.run(query)
+
+    @Component.dependent
+    async def search(self, text, limit=None, highlight=("[", "]")):
+        """
+        Full-text search like DbManager.search().
+        :rtype: list of diary.search.SearchResult
+        """
+        return await self.run(lambda session: self._db.search_index.search(session, text, limit,
+                                                                           highlight))
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads, no further calls are possible afterwards.
+        """
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+from collections import namedtuple
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Index, Integer, BigInteger, String, \
+    Date, Float, Text, inspect, select, func, text
+from sqlalchemy.exc import DBAPIError
+from diary.search import fts5_available
+
+
+Migration = namedtuple("Migration", ["version", "function", "batched"])
+migrations = list()  # all migrations of the diary schema, registered by @migration()
+
+
+def migration(version, batched=False):
+    """
+    Decorator registering a function as migration of the schema to version. The function is
+    called with a MigrationContext. Unless batched is True the whole migration runs in a single
+    transaction, batched migrations open their transactions through MigrationContext.batched()
+    and have to be repeatable, as an interrupted run starts over again.
+    Migrations describe the tables as they were at their version instead of using diary.models,
+    so later changes of the models don't change what an old migration does.
+    :param int version: Schema version reached by the migration
+    :param bool batched: optional - Whether the migration handles its transactions itself
+    """
+    def register(function):
+        migrations.append(Migration(version, function, batched))
+        return function
+    return register
+
+
+class MigrationContext:
+    def __init__(self, connection, batch_size=1000):
+        self.connection = connection
+        self.batch_size = batch_size
+        # pysqlite doesn't begin transactions before DDL statements, so BEGIN is sent explicitly
+        self._explicit_begin = connection.dialect.name == "sqlite"
+
+    def begin(self):
+        """
+        Begins a transaction that includes DDL statements, use it as context manager.
+        """
+        transaction = self.connection.begin()
+        if self._explicit_begin:
+            self.connection.execute("BEGIN")
+        return transaction
+
+    def batched(self, table, function, batch_size=None):
+        """
+        Calls function(connection, low, high) for consecutive ranges of the integer primary key
+        of table, every range in its own transaction. Rewriting a large table this way never
+        locks the database for long.
+        :param Table table: Table to work through
+        :param callable function: Does the work for all rows with low <= primary key <= high
+        :param int batch_size: optional - Size of the primary key ranges
+        """
+        size = batch_size if batch_size else self.batch_size
+        key = list(table.primary_key.columns)[0]
+        lowest, highest = self.connection.execute(select([func.min(key), func.max(key)])).first()
+        if lowest is None:
+            return
+        low = lowest
+        while low <= highest:
+            with self.begin():
+                function(self.connection, low, low + size - 1)
+            low += size
+
+    def has_index(self, table, name):
+        return name in {index["name"] for index in inspect(self.connection).get_indexes(table)}
+
+    def has_column(self, table, name):
+        return name in {column["name"] for column in inspect(self.connection).get_columns(table)}
+
+    def add_column(self, table, column):
+        """
+        Adds a nullable column to an existing table, unless the table has it already.
+        :param str table: Name of the table
+        :param Column column: Column to add, only its name and type are used
+        """
+        if not self.has_column(table, column.name):
+            self.connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                table, column.name, column.type.compile(dialect=self.connection.dialect)))
+
+
+class Migrator:
+    """
+    Brings the schema of a database up to date by applying the pending migrations in order.
+    The reached version is stored in the schema_version table, so starting with an up to date
+    database costs a single query and never reflects the schema.
+    """
+    def __init__(self, engine, migration_list=None, batch_size=1000):
+        self._engine = engine
+        self._migrations = sorted(migration_list if migration_list is not None else migrations,
+                                  key=lambda item: item.version)
+        versions = [item.version for item in self._migrations]
+        if len(set(versions)) != len(versions) or (versions and versions[0] < 1):
+            raise ValueError("Migration versions should be unique and positive.")
+        self._batch_size = batch_size
+        self._version_table = Table("schema_version", MetaData(),
+                                    Column("version", Integer, nullable=False))
+
+    @property
+    def latest_version(self):
+        return self._migrations[-1].version if self._migrations else 0
+
+    def current_version(self, connection=None):
+        """
+        Returns the schema version of the database, 0 for databases without version.
+        """
+        if connection is None:
+            with self._engine.connect() as connection:
+                return self.current_version(connection)
+        transaction = connection.begin()
+        try:
+            version = connection.execute(select([self._version_table.c.version])).scalar()
+        except DBAPIError:  # no schema_version table yet
+            transaction.rollback()
+            return 0
+        transaction.commit()
+        return version if version else 0
+
+    def pending(self, connection=None):
+        current = self.current_version(connection)
+        return [item for item in self._migrations if item.version > current]
+
+    def upgrade(self, progress=None):
+        """
+        Applies all pending migrations.
+        :param callable progress: optional - Called with the version of every applied migration
+        :return: Number of applied migrations
+        :rtype: int
+        """
+        with self._engine.connect() as connection:
+            pending = self.pending(connection)
+            if not pending:
+                return 0
+            self._version_table.create(connection, checkfirst=True)
+            context = MigrationContext(connection, self._batch_size)
+            raw_connection = connection.connection.connection
+            if context._explicit_begin:
+                isolation_level = raw_connection.isolation_level
+                raw_connection.isolation_level = None  # stop pysqlite managing transactions
+            try:
+                for item in pending:
+                    if item.batched:
+                        item.function(context)
+                        with context.begin():
+                            self._set_version(connection, item.version)
+                    else:
+                        with context.begin():
+                            item.function(context)
+                            self._set_version(connection, item.version)
+                    if progress is not None:
+                        progress(item.version)
+            finally:
+                if context._explicit_begin:
+                    raw_connection.isolation_level = isolation_level
+        return len(pending)
+
+    def _set_version(self, connection, version):
+        connection.execute(self._version_table.delete())
+        connection.execute(self._version_table.insert().values(version=version))
+
+
+@migration(1)
+def initial_schema(context):
+    # databases created before versioning already have these tables
+    metadata = MetaData()
+    Table("entries", metadata,
+          Column("id", Integer, primary_key=True),
+          Column("title", String(80)),
+          Column("text", Text),
+          Column("timestamp", Date))
+    Table("files", metadata,
+          Column("id", Integer, primary_key=True),
+          Column("name", String(80)),
+          Column("subpath", String(120)),
+          Column("type", String(10)),
+          Column("timestamp", Date))
+    Table("entry_files", metadata,
+          Column("entry_id", ForeignKey("entries.id"), primary_key=True),
+          Column("file_id", ForeignKey("files.id"), primary_key=True))
+    metadata.create_all(context.connection)
+
+
+@migration(2)
+def lookup_indexes(context):
+    metadata = MetaData()
+    entries = Table("entries", metadata, Column("timestamp", Date))
+    files = Table("files", metadata, Column("name", String(80)), Column("timestamp", Date))
+    entry_files = Table("entry_files", metadata, Column("file_id", Integer))
+    for index in (Index("ix_entries_timestamp", entries.c.timestamp),
+                  Index("ix_files_name", files.c.name),
+                  Index("ix_files_timestamp", files.c.timestamp),
+                  Index("ix_entry_files_file_id", entry_files.c.file_id)):
+        if not context.has_index(index.table.name, index.name):
+            index.create(context.connection)
+
+
+@migration(3)
+def file_metadata(context):
+    metadata = MetaData()
+    files = Table("files", metadata,
+                  Column("size", BigInteger),
+                  Column("mtime", Float),
+                  Column("hash", String(64)),
+                  Column("mime", String(80)))
+    for column in files.columns:
+        context.add_column("files", column)
+    index = Index("ix_files_hash", files.c.hash)
+    if not context.has_index("files", index.name):
+        index.create(context.connection)
+
+
+@migration(4)
+def full_text_index(context):
+    # databases indexed before this migration already have the table and its triggers
+    if not fts5_available(context.connection):
+        return  # the generic SearchIndex needs nothing inside the database
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(title, text, "
+        "content='entries', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN "
+        "INSERT INTO entries_fts(rowid, title, text) VALUES (new.id, new.title, new.text); END",
+        "CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN "
+        "INSERT INTO entries_fts(entries_fts, rowid, title, text) "
+        "VALUES ('delete', old.id, old.title, old.text); END",
+        "CREATE TRIGGER IF NOT EXISTS entries_fts_update AFTER UPDATE ON entries BEGIN "
+        "INSERT INTO entries_fts(entries_fts, rowid, title, text) "
+        "VALUES ('delete', old.id, old.title, old.text); "
+        "INSERT INTO entries_fts(rowid, title, text) VALUES (new.id, new.title, new.text); END",
+        # index the entries stored before the index existed
+        "INSERT INTO entries_fts(entries_fts) VALUES ('rebuild')"]
+    for statement in statements:
+        context.connection.execute(text(statement))
@@ -3,7 +3,7 @@
 
 from datetime import date
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Table, Column, ForeignKey, Integer, String, Date, Text
+from sqlalchemy import Table, Column, ForeignKey, Integer, BigInteger, String, Date, Float, Text
 from sqlalchemy.orm import relationship
 
 
@@ -12,7 +12,7 @@ Model = declarative_base()
 
 entry_files = Table("entry_files", Model.metadata,
                     Column("entry_id", ForeignKey("entries.id"), primary_key=True),
-                    Column("file_id", ForeignKey("files.id"), primary_key=True))
+                    Column("file_id", ForeignKey("files.id"), primary_key=True, index=True))
 
 
 class Entry(Model):
@@ -20,7 +20,7 @@ class Entry(Model):
     id = Column(Integer, primary_key=True)
     title = Column(String(80))
     text = Column(Text)
-    timestamp = Column(Date)
+    timestamp = Column(Date, index=True)
     files = relationship("File", secondary=entry_files, back_populates="entries")
 
     def __init__(self, title="", text="", timestamp=date.today()):
@@ -35,17 +35,27 @@ class Entry(Model):
 class File(Model):
     __tablename__ = "files"
     id = Column(Integer, primary_key=True)
-    name = Column(String(80))
+    name = Column(String(80), index=True)
     subpath = Column(String(120))
     type = Column(String(10))
-    timestamp = Column(Date)
+    timestamp = Column(Date, index=True)
+    # meta-data of the stored file, maintained by FileManager
+    size = Column(BigInteger)
+    mtime = Column(Float)
+    hash = Column(String(64), index=True)
+    mime = Column(String(80))
     entries = relationship("Entry", secondary=entry_files, back_populates="files")
 
-    def __init__(self, name="", ftype="", path="./", timestamp=date.today()):
+    def __init__(self, name="", ftype="", path="./", timestamp=date.today(), size=None,
+                 mtime=None, digest=None, mime=None):
         self.name = name
         self.type = ftype
         self.subpath = path
         self.timestamp = timestamp
+        self.size = size
+        self.mtime = mtime
+        self.hash = digest
+        self.mime = mime
 
     def __repr__(self):
         return "File(id={}, name='{}')".format(self.id, self.name)
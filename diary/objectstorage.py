@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import datetime
+import hashlib
+import hmac
+import http.client
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, quote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from diary.storage import StorageBase, StoredObject
+
+
+_empty_hash = hashlib.sha256(b"").hexdigest()
+
+
+class ObjectStorage(StorageBase):
+    """
+    Keeps the keys as objects in a bucket of an S3 compatible object store (Amazon S3, MinIO,
+    Ceph, ...), talking to its REST API directly. Files larger than part_size are uploaded by
+    multipart uploads and downloaded by ranged requests, up to workers parts at the same time.
+    Connections are kept alive and shared by all requests and threads.
+    Requests are signed with AWS Signature Version 4 if an access key is given. Exclusive puts
+    are conditional writes (If-None-Match), which the store has to support.
+    """
+    part_size = 8 * 1024 * 1024  # S3 needs at least 5 MiB for every part but the last
+    read_buffer_size = 256 * 1024  # bytes fetched at least by a read of open() files
+
+    def __init__(self, endpoint, bucket, access_key=None, secret_key=None, region="us-east-1",
+                 prefix="", workers=4, timeout=60):
+        """
+        :param str endpoint: URL of the object store, i.e. 'https://s3.eu-central-1.amazonaws.com'
+        :param str bucket: Name of the bucket to keep the objects in
+        :param str access_key: optional - Access key id, requests are unsigned without
+        :param str secret_key: optional - Secret access key
+        :param str region: optional - Region of the bucket, used for signing
+        :param str prefix: optional - Prefix of all object names, i.e. 'diary/'
+        :param int workers: optional - Maximum number of parts transferred at the same time
+        :param float timeout: optional - Seconds to wait for the store
+        """
+        url = urlsplit(endpoint)
+        if url.scheme not in ("http", "https") or not url.hostname:
+            raise ValueError("'{}' is not a valid endpoint.".format(endpoint))
+        self._connection_class = http.client.HTTPSConnection if url.scheme == "https" else \
+            http.client.HTTPConnection
+        self._host = url.hostname
+        self._port = url.port
+        self._netloc = url.netloc
+        self.bucket = bucket
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.workers = workers
+        self.timeout = timeout
+        self._connections = list()  # idle connections, kept alive for the next requests
+        self._connections_lock = threading.Lock()
+
+    @contextmanager
+    def _connection(self):
+        with self._connections_lock:
+            connection = self._connections.pop() if self._connections else None
+        if connection is None:
+            connection = self._connection_class(self._host, self._port, timeout=self.timeout)
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            raise
+        with self._connections_lock:
+            self._connections.append(connection)
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, list()
+        for connection in connections:
+            connection.close()
+
+    def _path(self, key):
+        if key is None:
+            return "/{}".format(self.bucket)
+        return "/{}/{}".format(self.bucket, quote(self.prefix + key, safe="/-_.~"))
+
+    def _sign(self, method, path, query, headers, payload_hash, now):
+        """
+        Adds the headers of AWS Signature Version 4 to headers, which have lowercase names.
+        """
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        headers["x-amz-date"] = amz_date
+        headers["x-amz-content-sha256"] = payload_hash
+        if self._access_key is None:
+            return
+        names = sorted(headers)
+        canonical_request = "\n".join([
+            method, path, query,
+            "".join("{}:{}\n".format(name, " ".join(str(headers[name]).split()))
+                    for name in names),
+            ";".join(names), payload_hash])
+        scope = "{}/{}/s3/aws4_request".format(amz_date[:8], self.region)
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+        signing_key = ("AWS4" + self._secret_key).encode()
+        for part in scope.split("/"):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = \
+            "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+                self._access_key, scope, ";".join(names), signature)
+
+    def _request(self, method, key=None, query=None, headers=None, body=None, expected=(200,)):
+        """
+        Sends a request for key (the bucket if None) and returns the response and its data.
+        Connections closed by the store while they were idle are replaced once.
+        """
+        path = self._path(key)
+        query = "&".join("{}={}".format(quote(name, safe="-_.~"), quote(value, safe="-_.~"))
+                         for name, value in sorted((query if query else dict()).items()))
+        headers = {name.lower(): value for name, value in (headers if headers else {}).items()}
+        headers["host"] = self._netloc
+        self._sign(method, path, query, headers,
+                   hashlib.sha256(body).hexdigest() if body else _empty_hash,
+                   datetime.datetime.now(datetime.timezone.utc))
+        url = "{}?{}".format(path, query) if query else path
+        for attempt in (1, 2):
+            try:
+                with self._connection() as connection:
+                    connection.request(method, url, body=body, headers=headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if attempt == 2:
+                    raise
+        if response.status in expected:
+            return response, data
+        if response.status == 404:
+            raise FileNotFoundError("'{}' is not in storage.".format(key))
+        if response.status == 412:
+            raise FileExistsError("'{}' is already in storage.".format(key))
+        raise OSError("{} {} failed: {} {} {}".format(method, url, response.status,
+                                                      response.reason, self._error(data)))
+
+    @staticmethod
+    def _error(data):
+        try:
+            return ElementTree.fromstring(data).findtext("Message", "")
+        except ElementTree.ParseError:
+            return ""
+
+    def create_bucket(self):
+        """
+        Creates the bucket if it doesn't exist yet.
+        """
+        try:
+            self._request("PUT")
+        except OSError:
+            self._request("HEAD")  # already owned or the actual error
+
+    def exists(self, key):
+        try:
+            self.stat(key)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def stat(self, key):
+        response, _ = self._request("HEAD", key)
+        return StoredObject(int(response.getheader("Content-Length")),
+                            parsedate_to_datetime(response.getheader("Last-Modified")).timestamp())
+
+    def put(self, src_path, key, exclusive=True, synced=None):
+        size = os.path.getsize(src_path)
+        conditions = {"If-None-Match": "*"} if exclusive else None
+        if size <= self.part_size:
+            with open(src_path, "rb") as src_file:
+                self._request("PUT", key, headers=conditions, body=src_file.read())
+            return "put", size
+        _, data = self._request("POST", key, {"uploads": ""})
+        upload_id = ElementTree.fromstring(data).findtext("{*}UploadId")
+
+        def upload(number):
+            with open(src_path, "rb") as src_file:
+                src_file.seek((number - 1) * self.part_size)
+                part = src_file.read(self.part_size)
+            response, _ = self._request("PUT", key, {"partNumber": str(number),
+                                                     "uploadId": upload_id}, body=part)
+            return "<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>".format(
+                number, escape(response.getheader("ETag")))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix="diary-upload") as pool:
+                parts = list(pool.map(upload, range(1, (size - 1) // self.part_size + 2)))
+            body = "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format("".join(parts))
+            _, data = self._request("POST", key, {"uploadId": upload_id}, conditions,
+                                    body.encode())
+            if b"<Error>" in data:  # the store can fail after answering with 200
+                raise OSError("Completing the upload of '{}' failed: {}".format(
+                    key, self._error(data)))
+        except BaseException:
+            try:
+                self._request("DELETE", key, {"uploadId": upload_id}, expected=(200, 204))
+            except OSError:  # the store removes abandoned uploads eventually
+                pass
+            raise
+        return "multipart", size
+
+    def write(self, key, write, exclusive=True, synced=None):
+        descriptor, temp_path = tempfile.mkstemp(suffix=".tmp")
+        os.close(descriptor)
+        try:
+            result = write(temp_path)
+            self.put(temp_path, key, exclusive)
+        finally:
+            os.remove(temp_path)
+        return result
+
+    def _read_range(self, key, offset, length):
+        if length <= 0:
+            return b""
+        _, data = self._request("GET", key,
+                                headers={"Range": "bytes={}-{}".format(offset,
+                                                                       offset + length - 1)},
+                                expected=(200, 206))
+        return data
+
+    def open(self, key):
+        return io.BufferedReader(_ObjectReader(self, key, self.stat(key).size),
+                                 buffer_size=self.read_buffer_size)
+
+    def get(self, key, target_path):
+        size = self.stat(key).size
+        if size <= self.part_size:
+            _, data = self._request("GET", key)
+            with open(target_path, "wb") as target_file:
+                target_file.write(data)
+            return "get", len(data)
+        with open(target_path, "wb") as target_file:
+            target_file.truncate(size)
+
+        def download(offset):
+            data = self._read_range(key, offset, min(self.part_size, size - offset))
+            with open(target_path, "r+b") as target_file:
+                target_file.seek(offset)
+                target_file.write(data)
+
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix="diary-download") as pool:
+            for _ in pool.map(download, range(0, size, self.part_size)):
+                pass
+        return "ranged", size
+
+    def delete(self, key):
+        self.stat(key)  # the store doesn't tell whether the object existed
+        self._request("DELETE", key, expected=(200, 204))
+
+    def keys(self, prefix=""):
+        token = None
+        while True:
+            query = {"list-type": "2", "prefix": self.prefix + prefix}
+            if token:
+                query["continuation-token"] = token
+            _, data = self._request("GET", query=query)
+            result = ElementTree.fromstring(data)
+            for name in result.iterfind("{*}Contents/{*}Key"):
+                yield name.text[len(self.prefix):]
+            token = result.findtext("{*}NextContinuationToken")
+            if result.findtext("{*}IsTruncated") != "true" or not token:
+                return
+
+
+class _ObjectReader(io.RawIOBase):
+    """
+    Reads an object by ranged requests, see ObjectStorage.open().
+    """
+    def __init__(self, storage, key, size):
+        super(_ObjectReader, self).__init__()
+        self._storage = storage
+        self._key = key
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position {}.".format(offset))
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        data = self._storage._read_range(self._key, self._position,
+                                         min(len(buffer), self._size - self._position))
+        memoryview(buffer).cast("B")[:len(data)] = data
+        self._position += len(data)
+        return len(data)
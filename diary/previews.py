@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import hashlib
+import io
+import mimetypes
+import os
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+Preview = namedtuple("Preview", ["kind", "data"])  # kind 'image' with PNG data or 'text'
+
+
+def text_excerpt(read, cache):
+    """
+    Preview generator returning the first excerpt_length characters of a text file with its
+    whitespace collapsed.
+    """
+    text = read(cache.excerpt_length * 4).decode("utf-8", errors="replace")
+    return Preview("text", " ".join(text.split())[:cache.excerpt_length])
+
+
+def pillow_thumbnail(read, cache):
+    """
+    Preview generator scaling images down to thumbnail_size with Pillow.
+    """
+    image = Image.open(io.BytesIO(read(None)))
+    image.draft("RGB", cache.thumbnail_size)  # JPEGs are decoded at a reduced size already
+    image.thumbnail(cache.thumbnail_size)
+    if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+        image = image.convert("RGBA")
+    output = io.BytesIO()
+    image.save(output, "PNG")
+    return Preview("image", output.getvalue())
+
+
+class PreviewCache:
+    """
+    Creates previews (thumbnails of images, excerpts of texts) of the items of a FileManager on
+    a pool of worker threads and keeps them in a directory. Entries are keyed by content hash
+    (the path if no hash is known) and modification time of the stored file, so changed files
+    get new previews while the outdated ones are never used again. The least recently used
+    entries are removed as soon as the cache grows beyond max_size bytes.
+    Generators create the previews by MIME type, they are called with a function reading the
+    first bytes of the file (all for None) and the cache, and return a Preview or None. Images
+    are only handled if Pillow is installed, other generators can be added by register().
+    """
+    # bytes counted for every entry besides its data, so entries without preview count as well
+    entry_overhead = 256
+
+    def __init__(self, file_manager, directory, max_size=64 * 1024 * 1024,
+                 thumbnail_size=(128, 128), excerpt_length=300, workers=2):
+        """
+        :param FileManager file_manager: FileManager holding the items
+        :param str directory: Directory of the cache, created if it doesn't exist
+        :param int max_size: optional - Maximum size of all cached previews in bytes
+        :param tuple thumbnail_size: optional - Maximum width and height of thumbnails
+        :param int excerpt_length: optional - Maximum number of characters of text excerpts
+        :param int workers: optional - Number of previews created at the same time
+        """
+        self._manager = file_manager
+        self._directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.excerpt_length = excerpt_length
+        self._generators = OrderedDict([("text/", text_excerpt)])
+        if Image:
+            self._generators["image/"] = pillow_thumbnail
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="diary-preview")
+        self._lock = threading.RLock()  # done callbacks may run while it is held
+        self._running = dict()  # futures of the previews being created by key
+        self._entries = OrderedDict()  # file name and size of cached previews by key, LRU first
+        self._size = 0
+        os.makedirs(self._directory, exist_ok=True)
+        self._load_entries()
+
+    def register(self, mime_prefix, generator):
+        """
+        Sets the generator for all MIME types starting with mime_prefix (i.e. 'image/'), the
+        longest matching prefix wins. None removes the generator.
+        """
+        if generator is None:
+            self._generators.pop(mime_prefix, None)
+        else:
+            self._generators[mime_prefix] = generator
+
+    @property
+    def size(self):
+        return self._size
+
+    def _load_entries(self):
+        entries = list()
+        for name in os.listdir(self._directory):
+            key, extension = os.path.splitext(name)
+            if extension in (".png", ".txt", ".none"):
+                stat = os.stat(os.path.join(self._directory, name))
+                entries.append((stat.st_mtime, key, name, stat.st_size + self.entry_overhead))
+        for _, key, name, size in sorted(entries):  # the mtime is set on every use
+            self._entries[key] = (name, size)
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            _, (name, size) = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self._directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _key(self, digest, mtime):
+        source = "{}:{}:{}x{}:{}".format(digest, mtime, self.thumbnail_size[0],
+                                         self.thumbnail_size[1], self.excerpt_length)
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    def _item_source(self, item):
+        info = self._manager.get_info(item)
+        mtime = info.get("mtime")
+        if mtime is None:
+            mtime = os.stat(info["path"]).st_mtime
+        mime = info.get("mime") or mimetypes.guess_type(item)[0]
+        key = self._key(info.get("hash") or info["path"] or info["key"], mtime)
+        return key, mime, lambda length: self._manager.read(item, 0, length)
+
+    def _path_source(self, path):
+        path = os.path.abspath(path)
+
+        def read(length):
+            with open(path, "rb") as file:
+                return file.read(-1 if length is None else length)
+        return self._key(path, os.stat(path).st_mtime), mimetypes.guess_type(path)[0], read
+
+    def generator(self, mime):
+        """
+        Returns the generator used for files of the MIME type mime, None if there is none.
+        """
+        matches = [prefix for prefix in self._generators if mime and mime.startswith(prefix)]
+        return self._generators[max(matches, key=len)] if matches else None
+
+    def _cached(self, key):
+        """
+        Returns (True, preview) for cached keys, the preview is None if there is none.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            self._entries.move_to_end(key)
+        path = os.path.join(self._directory, entry[0])
+        try:
+            os.utime(path)  # remembers the use for the next start
+            if entry[0].endswith(".none"):
+                return True, None
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            with self._lock:
+                if self._entries.pop(key, None):
+                    self._size -= entry[1]
+            return False, None
+        if entry[0].endswith(".txt"):
+            return True, Preview("text", data.decode("utf-8"))
+        return True, Preview("image", data)
+
+    def _store(self, key, preview):
+        if preview is None:
+            name, data = key + ".none", b""
+        elif preview.kind == "text":
+            name, data = key + ".txt", preview.data.encode("utf-8")
+        else:
+            name, data = key + ".png", preview.data
+        temp_path = os.path.join(self._directory, "{}.{}.tmp".format(key, threading.get_ident()))
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, os.path.join(self._directory, name))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._size -= old[1]
+            self._entries[key] = (name, len(data) + self.entry_overhead)
+            self._size += len(data) + self.entry_overhead
+            self._evict()
+
+    def _create(self, key, mime, read):
+        generator = self.generator(mime)
+        try:
+            preview = generator(read, self) if generator else None
+        except (OSError, ValueError, SyntaxError):  # broken or unsupported content
+            preview = None
+        self._store(key, preview)
+        return preview
+
+    def get(self, item):
+        """
+        Returns the cached preview of an item without creating it, None if there is none.
+        """
+        return self._cached(self._item_source(item)[0])[1]
+
+    def request(self, item, callback=None):
+        """
+        Returns the preview of an item as Future, creating it in the background if it isn't
+        cached yet.
+        :param str item: Item of the FileManager
+        :param callable callback: optional - Called with item and Preview (None if no preview
+                                  can be made) when it's available, from a worker thread if the
+                                  preview had to be created
+        :rtype: concurrent.futures.Future
+        """
+        return self._request(item, self._item_source(item), callback)
+
+    def request_path(self, path, callback=None):
+        """
+        Like request() but for a file outside of the storage, i.e. before it's stored.
+        """
+        return self._request(path, self._path_source(path), callback)
+
+    def _request(self, source, details, callback):
+        key, mime, read = details
+        cached, preview = self._cached(key)
+        if cached:
+            future = Future()
+            future.set_result(preview)
+        else:
+            with self._lock:
+                future = self._running.get(key)
+                if future is None:
+                    future = self._executor.submit(self._create, key, mime, read)
+                    self._running[key] = future
+                    future.add_done_callback(lambda _: self._finished(key))
+        if callback is not None:
+            future.add_done_callback(
+                lambda done: callback(source, None if done.exception() else done.result()))
+        return future
+
+    def _finished(self, key):
+        with self._lock:
+            self._running.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            for name, _ in self._entries.values():
+                try:
+                    os.remove(os.path.join(self._directory, name))
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self._size = 0
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
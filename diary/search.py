@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+from collections import namedtuple
+from sqlalchemy import text as sql_text, column, and_, or_, false
+from diary.models import Entry
+
+
+SearchResult = namedtuple("SearchResult", ["entry", "rank", "title", "text"])
+
+
+def _terms(text):
+    return [term for term in text.split() if term] if text else list()
+
+
+class SearchIndex:
+    """
+    Full-text search over Entry.title and Entry.text. This generic implementation works with
+    every database driver: it matches entries by LIKE and ranks and highlights them in Python.
+    Subclasses can use a real index of the database (see SqliteSearchIndex).
+    """
+    snippet_size = 60  # characters of text around the first match shown in a snippet
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def condition(self, text):
+        """
+        Returns a SQL expression for filtering queries of Entry by text. All terms of text
+        have to match either title or text of an entry.
+        :param str text: Text to search for
+        """
+        terms = _terms(text)
+        if not terms:
+            return false()
+        conditions = list()
+        for term in terms:
+            pattern = "%{}%".format(term.replace("\\", "\\\\").replace("%", "\\%")
+                                    .replace("_", "\\_"))
+            conditions.append(or_(Entry.title.ilike(pattern, escape="\\"),
+                                  Entry.text.ilike(pattern, escape="\\")))
+        return and_(*conditions)
+
+    def search(self, session, text, limit=None, highlight=("[", "]")):
+        """
+        Searches all entries for text and returns the matches, best first.
+        :param sqlalchemy.orm.session.Session session: Session to load the entries with
+        :param str text: Text to search for
+        :param int limit: optional - Maximum number of results
+        :param tuple highlight: optional - Markers put around matched terms in snippets
+        :rtype: list of SearchResult
+        """
+        terms = [term.lower() for term in _terms(text)]
+        if not terms:
+            return list()
+        results = list()
+        for entry in session.query(Entry).filter(self.condition(text)):
+            title = entry.title or ""
+            body = entry.text or ""
+            rank = sum(2 * title.lower().count(term) + body.lower().count(term) for term in terms)
+            results.append(SearchResult(entry, float(rank),
+                                        self._highlight(title, terms, highlight),
+                                        self._highlight(self._excerpt(body, terms), terms,
+                                                        highlight)))
+        results.sort(key=lambda result: result.rank, reverse=True)
+        return results[:limit] if limit else results
+
+    def _excerpt(self, text, terms):
+        lowered = text.lower()
+        positions = [lowered.find(term) for term in terms if term in lowered]
+        if not positions or len(text) <= self.snippet_size:
+            return text[:self.snippet_size]
+        start = max(0, min(positions) - self.snippet_size // 4)
+        excerpt = text[start:start + self.snippet_size]
+        return ("..." if start > 0 else "") + excerpt + \
+               ("..." if start + self.snippet_size < len(text) else "")
+
+    @staticmethod
+    def _highlight(text, terms, markers):
+        lowered = text.lower()
+        spans = list()
+        for term in terms:
+            position = lowered.find(term)
+            while position >= 0:
+                spans.append((position, position + len(term)))
+                position = lowered.find(term, position + len(term))
+        if not spans:
+            return text
+        merged = list()
+        for start, end in sorted(spans):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        parts = list()
+        last = 0
+        for start, end in merged:
+            parts.extend((text[last:start], markers[0], text[start:end], markers[1]))
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
+
+
+class SqliteSearchIndex(SearchIndex):
+    """
+    Full-text search backed by a SQLite FTS5 table. The table uses the entries table as external
+    content and triggers keep it current on every INSERT, UPDATE and DELETE of an entry, so any
+    change flushed through the session is indexed immediately. The table and its triggers are
+    created by the full_text_index migration (see diary.migrations).
+    """
+    table = "entries_fts"
+
+    @staticmethod
+    def _match(text):
+        # every term is quoted to keep FTS5 query syntax out of user input, * matches prefixes
+        return " ".join('"{}"*'.format(term.replace('"', '""')) for term in _terms(text))
+
+    def condition(self, text):
+        if not _terms(text):
+            return false()
+        matches = sql_text("SELECT rowid FROM {0} WHERE {0} MATCH :match".format(self.table))\
+            .bindparams(match=self._match(text)).columns(column("rowid"))
+        return Entry.id.in_(matches)
+
+    def search(self, session, text, limit=None, highlight=("[", "]")):
+        if not _terms(text):
+            return list()
+        session.flush()  # pending changes have to reach the triggers first
+        statement = "SELECT rowid, -bm25({0}, 2.0, 1.0) AS rank, " \
+                    "snippet({0}, 0, :start, :end, '...', 8), " \
+                    "snippet({0}, 1, :start, :end, '...', 12) " \
+                    "FROM {0} WHERE {0} MATCH :match ORDER BY rank DESC".format(self.table)
+        parameters = {"match": self._match(text), "start": highlight[0], "end": highlight[1]}
+        if limit:
+            statement += " LIMIT :limit"
+            parameters["limit"] = limit
+        rows = session.execute(sql_text(statement), parameters).fetchall()
+        entries = dict()
+        ids = [row[0] for row in rows]
+        for start in range(0, len(ids), 500):  # stay below SQLite's variable limit
+            for entry in session.query(Entry).filter(Entry.id.in_(ids[start:start + 500])):
+                entries[entry.id] = entry
+        return [SearchResult(entries[row[0]], row[1], row[2], row[3])
+                for row in rows if row[0] in entries]
+
+
+def fts5_available(connection):
+    """
+    Returns whether connection is a SQLite database supporting FTS5. Only the compile options
+    of the library are asked, the schema isn't touched.
+    :param sqlalchemy.engine.Connection connection: Connection to the diary database
+    :rtype: bool
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    return bool(connection.execute(
+        sql_text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+
+
+def create_search_index(engine):
+    """
+    Returns the best SearchIndex available for the database behind engine.
+    :param sqlalchemy.engine.Engine engine: Engine of the diary database
+    :rtype: SearchIndex
+    """
+    with engine.connect() as connection:
+        if fts5_available(connection):
+            return SqliteSearchIndex(engine)
+    return SearchIndex(engine)
@@ -1,73 +1,1121 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import datetime
+import errno
+import hashlib
+import lzma
+import mimetypes
+import mmap
 import os
+import re
 import shutil
+import struct
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from contextlib import contextmanager
 from diary.application import Component
+from diary.models import File
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BatchResult = namedtuple("BatchResult", ["source", "item", "error"])
+StoredObject = namedtuple("StoredObject", ["size", "mtime"])
+Codec = namedtuple("Codec", ["id", "compressor", "decompressor"])
+codecs = OrderedDict()  # available compression codecs, the first one is the default
+if zstandard:
+    codecs["zstd"] = Codec(b"z", lambda: zstandard.ZstdCompressor(level=9).compressobj(),
+                           lambda: zstandard.ZstdDecompressor().decompressobj())
+codecs["lzma"] = Codec(b"x", lambda: lzma.LZMACompressor(preset=6), lzma.LZMADecompressor)
+
+# stored compressed files start with the magic, the codec id and the original size
+_header = struct.Struct(">6scQ")
+_magic = b"\x89DIARY"
+# leading bytes of formats that don't get smaller by compressing them again
+_compressed_signatures = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"PK\x03\x04", b"\x1f\x8b",
+                          b"BZh", b"\xfd7zXZ\x00", b"\x28\xb5\x2f\xfd", b"7z\xbc\xaf", b"Rar!",
+                          b"%PDF", b"ID3", b"OggS", b"fLaC")
+_compressed_extensions = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".zip", ".gz",
+                          ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar", ".docx", ".xlsx", ".pptx",
+                          ".odt", ".ods", ".odp", ".epub", ".pdf", ".mp3", ".ogg", ".flac",
+                          ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm"}
+
+_FICLONE = 0x40049409  # Linux ioctl sharing the extents of a file (btrfs, XFS, ...)
+# errors of copy_file_range() and sendfile() meaning the files don't support them
+_unsupported_errors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+                       errno.EBADF, errno.EPERM, errno.ETXTBSY, errno.ENOTSOCK}
+
+
+def copy_file(src_path, target_path, exclusive=False, buffer_size=8 * 1024 * 1024,
+              hardlink=False):
+    """
+    Copies a file with the fastest method the operating system and file system support. In
+    order of preference these are a hardlink (only if allowed), a reflink, which shares the data
+    until one of the files is changed, copy_file_range() and sendfile(), which copy inside the
+    kernel, and finally a copy through a buffer of buffer_size bytes.
+    :param str src_path: Path of the file to copy
+    :param str target_path: Path of the copy
+    :param bool exclusive: optional - Raise FileExistsError instead of replacing target_path
+                           (shutil.SameFileError if it is src_path, which is never truncated)
+    :param int buffer_size: optional - Size of the buffer used if nothing else is supported
+    :param bool hardlink: optional - Whether to link exclusive targets instead of copying,
+                          changing one of the files changes the other then
+    :return: Used method and number of copied bytes
+    :rtype: tuple
+    """
+    _check_same_file(src_path, target_path)
+    if hardlink and exclusive:
+        try:
+            os.link(src_path, target_path)
+            return "hardlink", os.path.getsize(target_path)
+        except FileExistsError:
+            raise
+        except OSError:  # other file system or links not supported
+            pass
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if exclusive else os.O_TRUNC) | \
+        getattr(os, "O_BINARY", 0)
+    with open(src_path, "rb", buffering=0) as src_file:
+        size = os.fstat(src_file.fileno()).st_size
+        target = os.open(target_path, flags, 0o666)
+        try:
+            method = _copy_fd(src_file, target, size, buffer_size)
+        except BaseException:
+            os.close(target)
+            os.remove(target_path)
+            raise
+        os.close(target)
+    return method, size
+
+
+def _check_same_file(src_path, target_path):
+    if os.path.exists(target_path) and os.path.samefile(src_path, target_path):
+        raise shutil.SameFileError("'{}' and '{}' are the same file.".format(
+            src_path, target_path))
+
+
+_temp_name = re.compile(r"\.[0-9a-f]{16}\.tmp$")  # names given by _temp_path()
+
+
+def _temp_path(target_path):
+    """
+    Returns a unique path for a temporary file in the directory of target_path, on the same file
+    system so it can be linked or renamed into place. Scans of the storage skip these files, see
+    is_temp_name().
+    """
+    return os.path.join(os.path.dirname(target_path), ".{}.tmp".format(os.urandom(8).hex()))
+
+
+def is_temp_name(name):
+    """
+    Returns whether the file name (without directory) is one of a temporary file of the storage.
+    """
+    return _temp_name.match(name) is not None
+
+
+def _publish(temp_path, target_path, exclusive=True):
+    """
+    Gives the complete file temp_path its final name target_path, so the name never shows a
+    partially written file. Exclusive targets are hardlinked, which fails with FileExistsError
+    if the name is taken, as a rename would replace it silently. On file systems without
+    hardlinks the name is reserved by an empty file created with O_EXCL instead.
+    """
+    if not exclusive:
+        os.replace(temp_path, target_path)
+        return
+    try:
+        os.link(temp_path, target_path)
+    except FileExistsError:
+        raise
+    except OSError:  # no hardlinks on this file system
+        os.close(os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+        os.replace(temp_path, target_path)
+        return
+    os.remove(temp_path)
+
+
+def _fsync_directory(directory):
+    """
+    Flushes the entries of directory to disk, making new names durable.
+    """
+    if not hasattr(os, "O_DIRECTORY"):  # directories can't be opened on Windows
+        return
+    descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _copy_fd(src_file, target, size, buffer_size):
+    src = src_file.fileno()
+    if fcntl and size:
+        try:
+            fcntl.ioctl(target, _FICLONE, src)
+            return "reflink"
+        except OSError:
+            pass
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+    for method, function in (
+            ("copy_file_range",
+             copy_file_range and (lambda offset: copy_file_range(src, target, size - offset,
+                                                                 offset, offset))),
+            ("sendfile", sendfile and (lambda offset: sendfile(target, src, offset,
+                                                               size - offset)))):
+        if function is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                sent = function(copied)
+                if not sent:  # the file got shorter
+                    break
+                copied += sent
+            return method
+        except OSError as error:
+            if copied or error.errno not in _unsupported_errors:
+                raise
+    buffer = memoryview(bytearray(buffer_size))
+    while True:
+        read = src_file.readinto(buffer)
+        if not read:
+            return "buffered"
+        written = 0
+        while written < read:
+            written += os.write(target, buffer[written:read])
+
+
+class StorageBase:
+    """
+    Interface of the places FileManager keeps the stored bytes in. Content is addressed by keys
+    with '/' separated parts like '2020/holiday/beach.jpg', FileManager builds its items,
+    content addressing and compression on top of it, so they work with every storage.
+    Storages are used from several threads at once.
+    """
+    def local_path(self, key):
+        """
+        Returns the path of the file holding key on the local file system, None for storages
+        which aren't local. The empty key returns the directory holding all keys.
+        """
+        return None
+
+    def exists(self, key):
+        raise NotImplementedError()
+
+    def stat(self, key):
+        """
+        Returns a StoredObject with size and modification time of key, raises FileNotFoundError
+        for unknown keys.
+        """
+        raise NotImplementedError()
+
+    def put(self, src_path, key, exclusive=True, synced=None):
+        """
+        Stores the local file src_path under key. Readers see either nothing or the complete
+        file under key.
+        :param bool exclusive: optional - Raise FileExistsError instead of replacing key
+        :param set synced: optional - Collects what has to be flushed by sync() for the new key
+                           to be durable, it's flushed right away if None
+        :return: Used method and number of stored bytes
+        :rtype: tuple
+        """
+        raise NotImplementedError()
+
+    def write(self, key, write, exclusive=True, synced=None):
+        """
+        Like put() for content written by write(), which is called with the path of a local file
+        to write to. Returns what write() returns.
+        """
+        raise NotImplementedError()
+
+    def open(self, key):
+        """
+        Returns a seekable binary file object reading the content of key.
+        """
+        raise NotImplementedError()
+
+    def get(self, key, target_path):
+        """
+        Copies the content of key into the local file target_path, replacing it.
+        :return: Used method and number of copied bytes
+        :rtype: tuple
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """
+        Removes key, raises FileNotFoundError for unknown keys.
+        """
+        raise NotImplementedError()
+
+    def keys(self, prefix=""):
+        """
+        Yields all keys starting with prefix.
+        """
+        raise NotImplementedError()
+
+    def sync(self, synced):
+        """
+        Flushes what put() and write() collected in synced.
+        """
+        pass
+
+
+class LocalStorage(StorageBase):
+    """
+    Keeps every key as file inside a root directory. New files are written to a temporary file
+    next to their target, flushed to disk and only then linked to their name, so a crash or a
+    concurrent put() never leaves a truncated file behind and storing an existing name fails
+    without any lock held between the writers.
+    """
+    copy_buffer_size = 8 * 1024 * 1024  # used if the system can't copy files by itself
+    # stored files are hardlinks to their sources if possible, saving the copy but changing the
+    # stored file when the source is changed in place
+    hardlinks = False
+    # stored files and their directories are flushed to disk before they are used
+    fsync = True
+
+    def __init__(self, root):
+        """
+        :param str root: Existing directory to store the files in
+        """
+        if not os.path.exists(os.path.abspath(root)):
+            raise NotADirectoryError("'{}' is not a valid root directory.".format(root))
+        self.root = os.path.abspath(root)
+
+    def local_path(self, key):
+        return os.path.join(self.root, *key.split("/")) if key else self.root
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def stat(self, key):
+        stat = os.stat(self.local_path(key))
+        return StoredObject(stat.st_size, stat.st_mtime)
+
+    def put(self, src_path, key, exclusive=True, synced=None):
+        return self.write(key, lambda temp_path: copy_file(src_path, temp_path, True,
+                                                           self.copy_buffer_size,
+                                                           self.hardlinks),
+                          exclusive, synced)
+
+    def write(self, key, write, exclusive=True, synced=None):
+        path = self.local_path(key)
+        temp_path = _temp_path(path)
+        try:
+            try:
+                result = write(temp_path)
+            except FileNotFoundError:  # first file of its directory
+                if os.path.isdir(os.path.dirname(path)):
+                    raise
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                result = write(temp_path)
+            if self.fsync:
+                with open(temp_path, "rb") as temp_file:
+                    os.fsync(temp_file.fileno())
+            _publish(temp_path, path, exclusive)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        directory = os.path.dirname(path)
+        if synced is None:
+            self.sync({directory})
+        else:
+            synced.add(directory)
+        return result
+
+    def open(self, key):
+        return open(self.local_path(key), "rb")
+
+    def get(self, key, target_path):
+        return copy_file(self.local_path(key), target_path, buffer_size=self.copy_buffer_size)
+
+    def delete(self, key):
+        path = self.local_path(key)
+        if os.path.isfile(path):
+            os.remove(path)
+        else:
+            raise FileNotFoundError("'{}' is not in storage.".format(key))
+
+    def keys(self, prefix=""):
+        top = self.local_path(prefix.rpartition("/")[0])
+        for directory, _, names in os.walk(top):
+            for name in names:
+                if is_temp_name(name):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), self.root)
+                key = key.replace(os.sep, "/")
+                if key.startswith(prefix):
+                    yield key
+
+    def sync(self, synced):
+        if self.fsync:
+            for directory in synced:
+                _fsync_directory(directory)
 
 
 class FileManager(Component):
-    def __init__(self, root=None, backend=None, compressed=False):
+    """
+    Stores files and hands them out again by their item name. The bytes are kept by a storage
+    (see StorageBase), by default a LocalStorage inside a root directory, where every item is a
+    plain file named like the item.
+    In content addressed mode every distinct content is stored only once as blob named by its
+    SHA-256 hash, sharded into blobs/ab/cd/<hash>, while names/<item> holds the hash of its
+    content. Blobs are reference counted, so deleting an item only removes its content when no
+    other item uses it. The counts are guarded inside the process only, so a storage shared
+    with other processes should not be used content addressed.
+    In compressed mode files are compressed while being copied into the storage, except for
+    formats which are compressed already or small files. retrieve() decompresses them again.
+    With a DbManager as backend every stored item gets a File row holding its meta-data (size,
+    modification time, hash and MIME type), which answers exists() and get_info() without
+    touching the storage. reconcile() finds differences between both. As the backend is used
+    from the worker threads of store_many(), it should use a database file.
+    """
+    chunk_size = 1024 * 1024  # bytes read at once while hashing or (de)compressing
+    min_compressed_size = 512  # smaller files are stored as they are
+
+    def __init__(self, root=None, backend=None, compressed=False, content_addressed=False,
+                 storage=None):
+        """
+        :param str root: optional - Directory to store the files in
+        :param backend: optional - DbManager for meta-data of the files
+        :param compressed: optional - True to compress with the default codec or name of a codec
+        :param bool content_addressed: optional - Whether to store identical content only once
+        :param StorageBase storage: optional - Storage to keep the files in instead of root
+        """
         super(FileManager, self).__init__()
         self._db = backend
-        self._compression = compressed
-        self._root = self.invalid_state("_root", None)
-        if root and os.path.exists(os.path.abspath(root)):
-            self._root = os.path.abspath(root)
+        self._compression = self._codec(compressed)
+        self._content_addressed = content_addressed
+        self._refs_lock = threading.RLock()  # guards the reference counts of blobs
+        self._transfer_hook = None
+        self._busy = set()  # items being stored or deleted, reconcile() leaves them alone
+        self._busy_lock = threading.Lock()
+        self._root = None  # root directory of a LocalStorage
+        self._storage = self.invalid_state("_storage", None)
+        if storage is not None:
+            self._use_storage(storage)
+        elif root and os.path.exists(os.path.abspath(root)):
+            self._use_storage(LocalStorage(root))
 
-    def set(self, root=None, backend=None, compressed=None):
-        if root:
+    def set(self, root=None, backend=None, compressed=None, content_addressed=None,
+            storage=None):
+        if storage is not None:
+            self._use_storage(storage)
+        elif root:
             if os.path.exists(os.path.abspath(root)):
-                self._root = os.path.abspath(root)
+                self._use_storage(LocalStorage(root))
             else:
                 raise NotADirectoryError()
         if backend:
             self._db = backend
         if compressed is not None:
-            self._compression = compressed
+            self._compression = self._codec(compressed)
+        if content_addressed is not None:
+            self._content_addressed = content_addressed
+
+    def _use_storage(self, storage):
+        self._storage = storage
+        self._root = storage.root if isinstance(storage, LocalStorage) else None
+
+    @property
+    def storage(self):
+        return self._storage
+
+    def set_transfer_hook(self, hook):
+        """
+        Sets a function called after every copy into or out of the storage, i.e. to monitor
+        throughput. It gets a dictionary with the operation ('store' or 'retrieve'), the used
+        method (see copy_file(), the compression codec or the methods of the storage), the bytes
+        of the original file, the seconds it took and the throughput in bytes per second.
+        :param callable hook: Function to call, None to remove the hook
+        """
+        self._transfer_hook = hook
+
+    def _report(self, operation, method, size, start):
+        if self._transfer_hook is not None:
+            seconds = time.perf_counter() - start
+            self._transfer_hook({"operation": operation, "method": method, "bytes": size,
+                                 "seconds": seconds,
+                                 "throughput": size / seconds if seconds else float("inf")})
+
+    @staticmethod
+    def _codec(compressed):
+        if not compressed:
+            return None
+        name = next(iter(codecs)) if compressed is True else compressed
+        if name not in codecs:
+            raise ValueError("Compression codec '{}' is not available.".format(compressed))
+        return name
+
+    def _item_key(self, item):
+        """
+        Returns the storage key of item, its pointer to the blob in content addressed mode.
+        The names and blobs directories hold the content addressed layout, so items can't be
+        stored inside them in the plain layout.
+        """
+        parts = os.path.normpath(item).split(os.sep)
+        if os.path.isabs(item) or parts[0] == os.pardir or is_temp_name(parts[-1]):
+            raise ValueError("'{}' is not a valid item.".format(item))
+        if not self._content_addressed and len(parts) > 1 and parts[0] in ("names", "blobs"):
+            raise ValueError("'{}' is reserved for content addressed storage.".format(parts[0]))
+        return "/".join(["names"] + parts if self._content_addressed else parts)
+
+    @staticmethod
+    def _blob_key(digest):
+        return "blobs/{}/{}/{}".format(digest[:2], digest[2:4], digest)
+
+    def _read_digest(self, item):
+        with self._storage.open(self._item_key(item)) as pointer:
+            return pointer.read().decode("ascii").strip()
+
+    def _change_refs(self, digest, change, synced=None):
+        """
+        Changes the reference count of a blob and returns the new count.
+        """
+        refs_key = self._blob_key(digest) + ".refs"
+        with self._refs_lock:
+            try:
+                with self._storage.open(refs_key) as refs_file:
+                    count = int(refs_file.read())
+            except FileNotFoundError:
+                count = 0
+            count += change
+            if count > 0:
+                self._storage.write(refs_key,
+                                    lambda temp_path: self._write_text(temp_path, str(count)),
+                                    exclusive=False, synced=synced)
+            elif self._storage.exists(refs_key):
+                self._storage.delete(refs_key)
+        return count
+
+    @staticmethod
+    def _write_text(path, text):
+        with open(path, "w") as text_file:
+            text_file.write(text)
+
+    @classmethod
+    def hash_file(cls, path):
+        """
+        Returns the SHA-256 hex digest of a file, read in chunks of chunk_size.
+        """
+        hasher = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(cls.chunk_size), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _content(self, key, offset=0, length=None, chunk_size=None):
+        """
+        Yields the original content of a stored file in chunks, decompressing it if needed.
+        Only length bytes (all if None) starting at offset are yielded.
+        """
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError("offset and length should not be negative.")
+        chunk_size = chunk_size if chunk_size else self.chunk_size
+        remaining = length
+        with self._storage.open(key) as stored_file:
+            header = self._read_header(stored_file)
+            if header is None:
+                stored_file.seek(offset)
+                while remaining is None or remaining > 0:
+                    chunk = stored_file.read(chunk_size if remaining is None
+                                             else min(chunk_size, remaining))
+                    if not chunk:
+                        return
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+                return
+            # compressed data can't be sought, the content before offset is skipped
+            decompressor = self._decompressor(header[0], key)
+            skip = offset
+            for data in iter(lambda: stored_file.read(self.chunk_size), b""):
+                piece = decompressor.decompress(data)
+                if skip:
+                    if len(piece) <= skip:
+                        skip -= len(piece)
+                        continue
+                    piece = piece[skip:]
+                    skip = 0
+                if remaining is not None:
+                    piece = piece[:remaining]
+                    remaining -= len(piece)
+                for start in range(0, len(piece), chunk_size):
+                    yield piece[start:start + chunk_size]
+                if remaining == 0:
+                    return
+
+    @staticmethod
+    def _decompressor(codec_id, key):
+        for codec in codecs.values():
+            if codec.id == codec_id:
+                return codec.decompressor()
+        raise ValueError("'{}' is compressed with an unavailable codec.".format(key))
+
+    def _should_compress(self, src_path, src_file):
+        start = src_file.read(len(_magic))
+        src_file.seek(0)
+        if start == _magic:  # has to be wrapped, otherwise retrieve() would decompress it
+            return True
+        if not self._compression or \
+                os.fstat(src_file.fileno()).st_size < self.min_compressed_size:
+            return False
+        if os.path.splitext(src_path)[1].lower() in _compressed_extensions:
+            return False
+        return not start.startswith(_compressed_signatures)
+
+    def _copy_in(self, src_path, key, exclusive=True, synced=None):
+        """
+        Stores src_path under key, compressing it if compression is enabled and useful. Files
+        starting like compressed files are always compressed, even if compression is disabled.
+        """
+        start = time.perf_counter()
+        with open(src_path, "rb") as src_file:
+            compress = self._should_compress(src_path, src_file)
+        if compress:
+            method, size = self._storage.write(
+                key, lambda temp_path: self._compress(src_path, temp_path), exclusive, synced)
+        else:
+            method, size = self._storage.put(src_path, key, exclusive, synced)
+        self._report("store", method, size, start)
+
+    def _compress(self, src_path, target_path):
+        """
+        Writes the compressed content of src_path to target_path. Compressed output that isn't
+        smaller than the original is replaced by a plain copy.
+        :return: Used codec or copy method and size of the original
+        :rtype: tuple
+        """
+        name = self._compression if self._compression else next(iter(codecs))
+        with open(src_path, "rb") as src_file:
+            size = os.fstat(src_file.fileno()).st_size
+            codec = codecs[name]
+            compressor = codec.compressor()
+            with open(target_path, "wb") as target_file:
+                target_file.write(_header.pack(_magic, codec.id, size))
+                for chunk in iter(lambda: src_file.read(self.chunk_size), b""):
+                    target_file.write(compressor.compress(chunk))
+                target_file.write(compressor.flush())
+                stored = target_file.tell()
+            src_file.seek(0)
+            if stored < size or src_file.read(len(_magic)) == _magic:
+                return name, size
+        return copy_file(src_path, target_path)
+
+    def _copy_out(self, key, target_path):
+        """
+        Copies the stored file of key to target_path, decompressing it if needed.
+        """
+        start = time.perf_counter()
+        stored_path = self._storage.local_path(key)
+        if stored_path is not None:  # opening target_path must not truncate the stored file
+            _check_same_file(stored_path, target_path)
+        with self._storage.open(key) as stored_file:
+            header = self._read_header(stored_file)
+        if header is None:
+            method, size = self._storage.get(key, target_path)
+            self._report("retrieve", method, size, start)
+            return
+        with open(target_path, "wb") as target_file:
+            for chunk in self._content(key):
+                target_file.write(chunk)
+        codec = [name for name, codec in codecs.items() if codec.id == header[0]]
+        self._report("retrieve", codec[0], header[1], start)
+
+    @staticmethod
+    def _read_header(stored_file):
+        """
+        Returns (codec id, original size) of a compressed file, None for plain files.
+        """
+        data = stored_file.read(_header.size)
+        if len(data) < _header.size or not data.startswith(_magic):
+            return None
+        return _header.unpack(data)[1:]
+
+    @staticmethod
+    def _split_item(item):
+        subpath, name = os.path.split(os.path.normpath(item))
+        return subpath if subpath else "./", name
+
+    @staticmethod
+    def file_item(file):
+        """
+        Returns the item name of a File row.
+        """
+        return os.path.normpath(os.path.join(file.subpath, file.name))
+
+    def _file_row(self, session, item):
+        subpath, name = self._split_item(item)
+        return session.query(File).filter(File.name == name, File.subpath == subpath).first()
+
+    def _index(self, item, src_path, ftype=None, date=None, digest=None):
+        """
+        Adds the File row of a stored item. A row left behind by a file removed outside of the
+        FileManager is updated instead, keeping its id and the entries it belongs to.
+        """
+        subpath, name = self._split_item(item)
+        stored_key = self._blob_key(digest) if self._content_addressed else self._item_key(item)
+        values = dict(type=ftype if ftype else os.path.splitext(name)[1][1:10].lower(),
+                      timestamp=date if date else datetime.date.today(),
+                      size=os.path.getsize(src_path), mtime=self._storage.stat(stored_key).mtime,
+                      hash=digest if digest else self.hash_file(src_path),
+                      mime=mimetypes.guess_type(name)[0])
+        with self._db.task_session() as session:
+            row = self._file_row(session, item)
+            if row is None:
+                row = File(name=name, path=subpath)
+                session.add(row)
+            for column, value in values.items():
+                setattr(row, column, value)
 
     @Component.dependent
     def exists(self, item):
-        return os.path.isfile(os.path.join(self._root, item))
+        if self._db is not None:
+            self._item_key(item)  # validates item
+            with self._db.task_session() as session:
+                return self._file_row(session, item) is not None
+        return self._storage.exists(self._item_key(item))
 
     @Component.dependent
     def store(self, src, name=None, ftype=None, date=None, hierarchy=None):
+        """
+        Copies the file src into the storage.
+        :param str src: Path of the file to store
+        :param str name: optional - Item name, defaults to the file name of src
+        :param str hierarchy: optional - Subdirectory (i.e. '2020/holiday') to store the item in
+        :return: Item name for accessing the stored file, including the hierarchy
+        :rtype: str
+        """
+        return self._store(src, name, ftype, date, hierarchy)
+
+    @Component.dependent
+    def store_many(self, sources, hierarchy=None, workers=4, progress=None, cancel=None):
+        """
+        Stores several files at once on a pool of worker threads. A failing file doesn't stop
+        the others, its error is returned in its result instead. The directories of the stored
+        files are flushed to disk once at the end instead of after every file.
+        :param sources: Paths of the files to store or (path, name) tuples
+        :param str hierarchy: optional - Subdirectory to store all items in
+        :param int workers: optional - Maximum number of files copied at the same time
+        :param callable progress: optional - Called from the worker threads with the number of
+                                  finished files, the number of all files and the BatchResult of
+                                  the last finished file
+        :param threading.Event cancel: optional - When set, files not started yet are skipped
+                                       with a CancelledError
+        :return: BatchResult with source, item name and error (or None) for every file, in the
+                 order of sources
+        :rtype: list
+        """
+        synced = set()
+
+        def store(source):
+            src, name = source if isinstance(source, tuple) else (source, None)
+            return self._store(src, name, hierarchy=hierarchy, synced=synced)
+        try:
+            return self._run_many(store, sources, workers, progress, cancel)
+        finally:
+            self._storage.sync(synced)
+
+    @Component.dependent
+    def retrieve_many(self, items, target, workers=4, progress=None, cancel=None):
+        """
+        Copies several stored items into the directory target on a pool of worker threads,
+        see store_many().
+        :return: BatchResult with item, path of the copy and error (or None) for every item
+        :rtype: list
+        """
+        return self._run_many(lambda item: self._retrieve(item, target), items, workers,
+                              progress, cancel)
+
+    @staticmethod
+    def _run_many(function, sources, workers, progress, cancel):
+        sources = list(sources)
+        results = [None] * len(sources)
+        lock = threading.Lock()
+        finished = [0]
+
+        def work(index):
+            if cancel is not None and cancel.is_set():
+                result = BatchResult(sources[index], None, CancelledError())
+            else:
+                try:
+                    result = BatchResult(sources[index], function(sources[index]), None)
+                except Exception as error:  # reported per file, the batch goes on
+                    result = BatchResult(sources[index], None, error)
+            results[index] = result
+            if progress is not None:
+                with lock:
+                    finished[0] += 1
+                    progress(finished[0], len(sources), result)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="diary-storage") as pool:
+            for _ in pool.map(work, range(len(sources))):
+                pass
+        return results
+
+    @contextmanager
+    def _working_on(self, item):
+        item = os.path.normpath(item)
+        with self._busy_lock:
+            self._busy.add(item)
+        try:
+            yield
+        finally:
+            with self._busy_lock:
+                self._busy.discard(item)
+
+    def _store(self, src, name=None, ftype=None, date=None, hierarchy=None, synced=None):
         src_path = os.path.abspath(src)
         if os.path.isfile(src_path):
             stored_name = os.path.basename(src_path) if not name else name
-            # TODO: Implement optional storing inside subdirectories (hierarchy)
-            if os.path.exists(os.path.join(self._root, stored_name)):
-                raise FileExistsError("File with the same name is already stored.")
-            shutil.copy(src_path, self._root)
-            # TODO: Implement optional database storing of meta-data (name, ftype, date, hierarchy)
+            item = os.path.join(hierarchy, stored_name) if hierarchy else stored_name
+            with self._working_on(item):
+                digest = None
+                if self._content_addressed:
+                    digest = self._store_blob(src_path, item, synced)
+                else:
+                    try:  # the target is created exclusively, no need to check for it first
+                        self._copy_in(src_path, self._item_key(item), synced=synced)
+                    except FileExistsError:
+                        raise FileExistsError("File with the same name is already stored.")
+                if self._db is not None:
+                    try:
+                        self._index(item, src_path, ftype, date, digest)
+                    except Exception:  # the stored file would be unknown to the database
+                        self._remove(item)
+                        raise
+            return item
         else:
             raise ValueError("FileManager.store() should only be called with a path to a file.")
 
+    def _store_blob(self, src_path, item, synced=None):
+        pointer_key = self._item_key(item)
+        if self._storage.exists(pointer_key):
+            raise FileExistsError("File with the same name is already stored.")
+        digest = self.hash_file(src_path)
+        blob_key = self._blob_key(digest)
+        if self._change_refs(digest, 1, synced) == 1 or not self._storage.exists(blob_key):
+            try:  # written once, the blob keeps the modification time its File rows know
+                self._copy_in(src_path, blob_key, synced=synced)
+            except FileExistsError:
+                pass  # written by a concurrent store() of the same content meanwhile
+            except BaseException:
+                self._release_blob(digest)
+                raise
+        try:
+            self._storage.write(pointer_key, lambda temp_path: self._write_text(temp_path, digest),
+                                synced=synced)
+        except FileExistsError:
+            self._release_blob(digest)
+            raise FileExistsError("File with the same name is already stored.")
+        except BaseException:
+            self._release_blob(digest)
+            raise
+        return digest
+
+    def _release_blob(self, digest):
+        with self._refs_lock:  # a concurrent store() must not reference a blob being removed
+            if self._change_refs(digest, -1) <= 0:
+                blob_key = self._blob_key(digest)
+                if self._storage.exists(blob_key):
+                    self._storage.delete(blob_key)
+
     @Component.dependent
     def retrieve(self, item, target):
-        src_path = os.path.join(self._root, item)
+        """
+        Copies the stored item into the directory target, decompressing compressed files.
+        :return: Path of the copy
+        :rtype: str
+        """
+        return self._retrieve(item, target)
+
+    def _retrieve(self, item, target):
+        key = self._info(item)["key"]
         target_path = os.path.abspath(target)
-        if os.path.isfile(src_path):
-            if os.path.isdir(target_path):
-                shutil.copy(src_path, target_path)
-            else:
-                raise NotADirectoryError("'{}' is not a valid target directory.".format(target))
+        if os.path.isdir(target_path):
+            copy_path = os.path.join(target_path, os.path.basename(item))
+            self._copy_out(key, copy_path)
+            return copy_path
         else:
-            raise FileNotFoundError("'{}' is not in storage or not a valid item.".format(item))
+            raise NotADirectoryError("'{}' is not a valid target directory.".format(target))
 
     @Component.dependent
     def delete(self, item):
-        target_path = os.path.join(self._root, item)
-        if os.path.isfile(target_path):
-            os.remove(target_path)
+        with self._working_on(item):
+            indexed = False
+            if self._db is not None:
+                with self._db.task_session() as session:
+                    row = self._file_row(session, item)
+                    if row is not None:
+                        session.delete(row)
+                        indexed = True
+            try:
+                self._remove(item)
+            except FileNotFoundError:
+                if not indexed:  # otherwise only the row of a missing file was left
+                    raise
+
+    def _remove(self, item):
+        key = self._item_key(item)
+        if self._storage.exists(key):
+            if self._content_addressed:
+                digest = self._read_digest(item)
+                self._storage.delete(key)
+                self._release_blob(digest)
+            else:
+                self._storage.delete(key)
         else:
             raise FileNotFoundError("'{}' is not in storage or not a valid item.".format(item))
 
     @Component.dependent
     def get_info(self, item):
-        # right now there is only an implementation without DB usage
-        src_path = os.path.join(self._root, item)
-        if os.path.isfile(src_path):
-            return {"path": src_path}
+        return self._info(item)
+
+    def _info(self, item):
+        """
+        Returns a dictionary with the storage key and local path (None if the storage isn't
+        local) of the stored file and, if known, its hash. With a backend it's read from the
+        File row together with the id, size, mtime, mime, type and date of the item. Without,
+        items of storages which aren't local get their mtime.
+        """
+        key = self._item_key(item)
+        if self._db is not None:
+            with self._db.task_session() as session:
+                row = self._file_row(session, item)
+                if row is None:
+                    raise FileNotFoundError("'{}' is not in storage or not a valid item."
+                                            .format(item))
+                if self._content_addressed:
+                    key = self._blob_key(row.hash)
+                return {"path": self._storage.local_path(key), "key": key, "hash": row.hash,
+                        "id": row.id, "size": row.size, "mtime": row.mtime, "mime": row.mime,
+                        "type": row.type, "date": row.timestamp}
+        if self._storage.exists(key):
+            info = dict()
+            if self._content_addressed:
+                info["hash"] = self._read_digest(item)
+                key = self._blob_key(info["hash"])
+            info.update(path=self._storage.local_path(key), key=key)
+            if info["path"] is None:  # there is no file to look at
+                info["mtime"] = self._storage.stat(key).mtime
+            return info
         else:
             raise FileNotFoundError("'{}' is not in storage or not a valid item.".format(item))
+
+    @Component.dependent
+    def read(self, item, offset=0, length=None):
+        """
+        Reads bytes of a stored item without copying it to disk.
+        :param str item: Item to read
+        :param int offset: optional - Position of the first byte to read
+        :param int length: optional - Number of bytes to read, all up to the end if None
+        :rtype: bytes
+        """
+        return b"".join(self._content(self._info(item)["key"], offset, length, length))
+
+    @Component.dependent
+    def iter_chunks(self, item, chunk_size=None, offset=0, length=None):
+        """
+        Returns an iterator over the content of a stored item, i.e. for streaming it.
+        :param int chunk_size: optional - Maximum size of the chunks, chunk_size of the class
+                               by default
+        :param int offset: optional - Position of the first byte
+        :param int length: optional - Number of bytes to iterate over, all if None
+        """
+        return self._content(self._info(item)["key"], offset, length, chunk_size)
+
+    @Component.dependent
+    @contextmanager
+    def view(self, item):
+        """
+        Context manager providing the content of a stored item as read-only memoryview. Plain
+        files are memory mapped, so only the pages actually accessed are read from disk, while
+        compressed items and items of storages which aren't local are read into memory. The
+        view is released when the block ends, slices of it which are still referenced keep the
+        mapping open until they are gone.
+        """
+        info = self._info(item)
+        if info["path"] is None:
+            content = memoryview(b"".join(self._content(info["key"])))
+            try:
+                yield content
+            finally:
+                content.release()
+            return
+        with open(info["path"], "rb") as stored_file:
+            header = self._read_header(stored_file)
+            if header is not None or os.fstat(stored_file.fileno()).st_size == 0:
+                content = memoryview(b"".join(self._content(info["key"])) if header else b"")
+                try:
+                    yield content
+                finally:
+                    content.release()
+                return
+            mapping = mmap.mmap(stored_file.fileno(), 0, access=mmap.ACCESS_READ)
+        content = memoryview(mapping)
+        try:
+            yield content
+        finally:
+            content.release()
+            try:
+                mapping.close()
+            except BufferError:  # slices of the view still exist
+                pass
+
+    @Component.dependent
+    def compression_stats(self):
+        """
+        Scans the storage and sums up how much space compression saves.
+        :return: Dictionary with the number of files and compressed files, the original size,
+                 the stored size and the saved bytes of all stored content
+        :rtype: dict
+        """
+        stats = {"files": 0, "compressed": 0, "size": 0, "stored_size": 0}
+        for key in self._storage.keys("blobs/" if self._content_addressed else ""):
+            if key.endswith(".refs"):
+                continue
+            with self._storage.open(key) as stored_file:
+                header = self._read_header(stored_file)
+            stored_size = self._storage.stat(key).size
+            stats["files"] += 1
+            stats["stored_size"] += stored_size
+            if header:
+                stats["compressed"] += 1
+                stats["size"] += header[1]
+            else:
+                stats["size"] += stored_size
+        stats["saved"] = stats["size"] - stats["stored_size"]
+        return stats
+
+    @Component.dependent
+    def reconcile(self, fix=False, items=None):
+        """
+        Compares the stored files with their File rows in the backend. Files are only hashed
+        again if their size or modification time changed. Items being stored or deleted at the
+        same time are skipped.
+        :param bool fix: optional - Whether to update the database to match the files: rows of
+                         missing files are deleted, untracked files get rows and the rows of
+                         changed files are updated
+        :param items: optional - Only check these items (i.e. reported by a StorageWatcher)
+                      instead of scanning the whole storage
+        :return: Dictionary with lists of the 'missing' items (row but no file), the 'untracked'
+                 items (file but no row) and the 'changed' items (modified since their row was
+                 written)
+        :rtype: dict
+        """
+        if self._db is None:
+            raise ValueError("FileManager.reconcile() needs a backend.")
+        report = {"missing": list(), "untracked": list(), "changed": list()}
+        with self._busy_lock:
+            busy = set(self._busy)
+        with self._db.task_session() as session:
+            if items is None:
+                rows = {self.file_item(row): row for row in session.query(File)}
+                stored_items = self._stored_items()
+            else:
+                items = {os.path.normpath(item) for item in items} - busy
+                rows = self._rows(session, items)
+                stored_items = sorted(item for item in items
+                                      if self._storage.exists(self._item_key(item)))
+            for item in stored_items:
+                if item in busy:
+                    rows.pop(item, None)
+                    continue
+                row = rows.pop(item, None)
+                if row is None:
+                    report["untracked"].append(item)
+                    if fix:
+                        subpath, name = self._split_item(item)
+                        row = File(name=name, ftype=os.path.splitext(name)[1][1:10].lower(),
+                                   path=subpath)
+                        session.add(row)
+                        self._update_row(row, item)
+                elif not self._is_current(row, item):
+                    report["changed"].append(item)
+                    if fix:
+                        self._update_row(row, item)
+            for item, row in rows.items():
+                if item in busy:
+                    continue
+                report["missing"].append(item)
+                if fix:
+                    session.delete(row)
+        return report
+
+    def _rows(self, session, items):
+        """
+        Returns the File rows of items by item.
+        """
+        rows = dict()
+        names = sorted({self._split_item(item)[1] for item in items})
+        for start in range(0, len(names), 500):  # stay below the variable limit of SQLite
+            for row in session.query(File).filter(File.name.in_(names[start:start + 500])):
+                item = self.file_item(row)
+                if item in items:
+                    rows[item] = row
+        return rows
+
+    @property
+    def items_directory(self):
+        """
+        Local directory holding the items, their pointers to the blobs in content addressed
+        mode. None if the storage isn't local.
+        """
+        return self._storage.local_path("names" if self._content_addressed else "")
+
+    def _stored_items(self):
+        if self._content_addressed:
+            for key in self._storage.keys("names/"):
+                yield os.path.join(*key.split("/")[1:])
+            return
+        for key in self._storage.keys():
+            parts = key.split("/")
+            if parts[0] not in ("names", "blobs") or len(parts) == 1:
+                yield os.path.join(*parts)
+
+    def _stored_key(self, item):
+        if self._content_addressed:
+            return self._blob_key(self._read_digest(item))
+        return self._item_key(item)
+
+    def _is_current(self, row, item):
+        try:
+            if self._content_addressed and self._read_digest(item) != row.hash:
+                return False
+            stored_key = self._stored_key(item)
+            stat = self._storage.stat(stored_key)
+            if stat.mtime != row.mtime:
+                return False
+            if stat.size == row.size or self._compression is not None:
+                return True
+            # the stored size of compressed files differs from the original size in the row
+            with self._storage.open(stored_key) as stored_file:
+                return self._read_header(stored_file) is not None
+        except FileNotFoundError:
+            return False
+
+    def _update_row(self, row, item):
+        stored_key = self._stored_key(item)
+        hasher = hashlib.sha256()
+        size = 0
+        for chunk in self._content(stored_key):
+            hasher.update(chunk)
+            size += len(chunk)
+        row.size = size
+        row.mtime = self._storage.stat(stored_key).mtime
+        row.hash = hasher.hexdigest()
+        row.mime = mimetypes.guess_type(row.name)[0]
@@ -3,32 +3,135 @@
 
 
 from PyQt5.QtCore import QAbstractTableModel, QSortFilterProxyModel, QModelIndex, Qt, QDate,\
-    pyqtSlot, QStandardPaths
+    pyqtSlot, pyqtSignal, QStandardPaths, QTimer, QBuffer, QByteArray, QIODevice
+from PyQt5.QtGui import QImageReader, QPixmap, QIcon
 from PyQt5.QtWidgets import *
-from collections import Iterable
-from sqlalchemy import inspect
+from collections import OrderedDict
+from collections.abc import Iterable
+from sqlalchemy import event, inspect, tuple_, or_, false, String
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
 from datetime import date
+from diary.previews import Preview
+from diary.storage import FileManager
+from operator import attrgetter, itemgetter
+import os
+import threading
+import weakref
+
+
+_flush_watchers = weakref.WeakKeyDictionary()  # session: models displaying its objects
+
+
+def _clear_display_caches(session, flush_context):
+    for model in _flush_watchers.get(session, ()):
+        model.clear_display_cache()
+
+
+def _watch_flushes(model):
+    """
+    Registers model to have its display cache cleared after every flush of its query's session.
+    A single listener per session is used, so short-lived models don't pile up listeners.
+    """
+    session = model._query.session
+    if session not in _flush_watchers:
+        _flush_watchers[session] = weakref.WeakSet()
+        event.listen(session, "after_flush", _clear_display_caches)
+    _flush_watchers[session].add(model)
+
+
+def _same(obj):
+    return obj
+
+
+def _to_qdate(value):
+    return QDate(value) if isinstance(value, date) else value
+
+
+class _ColumnAccessor:
+    """
+    Ready to call accessors for a column of a SqlAlchemyQueryModel: value() returns the cell
+    content and obj() the model object (or single column value) of a result row, convert is
+    applied to the content before handing it to Qt (if not None).
+    """
+    __slots__ = ("value", "obj", "convert", "name", "editable", "relation")
+
+    def __init__(self, value, obj, convert, name, editable, relation):
+        self.value = value
+        self.obj = obj
+        self.convert = convert
+        self.name = name
+        self.editable = editable
+        self.relation = relation
+
+
+class _EvictedRow:
+    """
+    Placeholder for a row of a SqlAlchemyQueryModel whose result was evicted from memory.
+    """
+    __slots__ = ("identity",)
+
+    def __init__(self, identity):
+        self.identity = identity
 
 
 class SqlAlchemyQueryModel(QAbstractTableModel):
-    def __init__(self, query, parent=None):
+    commit_failed = pyqtSignal(object)  # error of a write-behind commit, see set_commit_delay()
+
+    def __init__(self, query, parent=None, batch_size=None, max_pages=None):
+        """
+        A table model for the results of a SqlAlchemy query. By default the whole result is
+        loaded at once. If batch_size is given the model works incrementally: rows are fetched
+        in pages of batch_size (LIMIT/OFFSET) as the view asks for more (see canFetchMore() and
+        fetchMore()) and, if max_pages is given too, least recently used pages are evicted and
+        transparently fetched again when accessed.
+        :param sqlalchemy.orm.query.Query query: Query for the data to display
+        :param QObject parent: optional - Parent of the model
+        :param int batch_size: optional - Number of rows per fetched page
+        :param int max_pages: optional - Number of pages kept in memory (needs batch_size)
+        """
         super(SqlAlchemyQueryModel, self).__init__(parent)
         if not type(query).__name__ == "Query":
             raise TypeError("parameter query should be of type sqlalchemy.orm.query.Query")
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("parameter batch_size should be a positive number")
+        if max_pages is not None and (not batch_size or max_pages < 1):
+            raise ValueError("parameter max_pages needs batch_size and should be positive")
+        self._base_query = query  # query as given, sorting and filtering are applied to a copy
         self._query = query
+        self._order = None  # ORDER BY expression set by sort()
+        self._filter_text = ""  # text to filter the rows by, see set_filter()
+        self._filter_function = None  # see set_filter_function()
         self._data = list()
+        self._batch_size = batch_size
+        self._max_pages = max_pages
+        self._pages = OrderedDict()  # loaded pages (page number: None) in least recent order
+        self._fetched = 0  # number of rows already fetched from the database
+        self._all_fetched = True
+        # rows inserted through this model since the last load() by _row_key(), the references
+        # keep their ids unique while their pages are evicted
+        self._inserted = dict()
+        self._evictable = False
+        self._display_cache = dict()  # (row, column): display string of a relation column
+        self._commit_delay = None  # write-behind delay for edits, see set_commit_delay()
+        self._pending_row = None  # key of the row with uncommitted edits
+        self._commit_timer = QTimer(self)
+        self._commit_timer.setSingleShot(True)
+        self._commit_timer.timeout.connect(self._commit_pending)
         self._header_data = dict()
         self._result_is_collection = False  # query result could be single model class or collection
         self._vheader_enabled = False  # whether model displays vertical headers (row numbers)
         self._last_insert = QModelIndex()
         self.meta_columns = list()  # Description of all columns in query result
+        self._accessors = tuple()  # compiled meta_columns, see _compile_column()
+        _watch_flushes(self)
         self.load()
 
     def _analyse_data(self):
-        if type(self._data[0]).__name__ == "result":
-            self._result_is_collection = True
-        else:
-            self._result_is_collection = False
+        # keep relation keys set through set_relation_display() when the query gets analysed again
+        relation_keys = {field["name"]: field["relation_key"] for field in self.meta_columns
+                         if "relation_key" in field}
+        self.meta_columns = list()
         for column_count, column in enumerate(self._query.column_descriptions):
             if column["expr"] is column["type"]:
                 # column is a model class
@@ -52,6 +155,8 @@ class SqlAlchemyQueryModel(QAbstractTableModel):
                         "result_position": column_count,
                         "related_class": getattr(inspector.class_, relation).mapper.class_
                     }
+                    if relation in relation_keys:
+                        definition["relation_key"] = relation_keys[relation]
                     self.meta_columns.append(definition)
             elif type(column["expr"]).__name__ == "InstrumentedAttribute":
                 # column is a selected Column from a Table
@@ -66,19 +171,46 @@ class SqlAlchemyQueryModel(QAbstractTableModel):
                 self.meta_columns.append(definition)
             else:
                 raise ValueError("parameter query only excepts tables or individual columns")
+        self._accessors = tuple(self._compile_column(column) for column in self.meta_columns)
+
+    def _compile_column(self, column):
+        """
+        Compiles the description of a column (see _analyse_data()) into a _ColumnAccessor, so
+        data() and setData() don't have to evaluate the description for every cell.
+        """
+        name = column["name"]
+        editable = column["type"] in ("class_attr", "class_relation")
+        convert = None
+        if "column_type" in column:
+            try:
+                if issubclass(column["column_type"].python_type, date):
+                    convert = _to_qdate
+            except NotImplementedError:
+                pass
+        if not self._result_is_collection:
+            return _ColumnAccessor(attrgetter(name), _same, convert, name, editable,
+                                   column["type"] == "class_relation")
+        get_obj = itemgetter(column["result_position"])
+        if column["type"] == "attr":
+            get_value = get_obj
+        else:
+            get_attr = attrgetter(name)
+
+            def get_value(data):
+                return get_attr(get_obj(data))
+        return _ColumnAccessor(get_value, get_obj, convert, name, editable,
+                               column["type"] == "class_relation")
 
     def _list_relations(self, index):
         column = index.column()
         if self.meta_columns[column]["type"] != "class_relation":
             raise ValueError("Column {} has no relations to display.".format(column))
-        position = self.meta_columns[column]["result_position"]
-        collection = self.meta_columns[column]["name"]
         row = index.row()
-        if self._result_is_collection:
-            data = getattr(self._data[row][position], collection)
-        else:
-            data = getattr(self._data[row], collection)
+        if (row, column) in self._display_cache:
+            return self._display_cache[(row, column)]
+        data = self._accessors[column].value(self._row(row))
         if len(data) == 0:  # no relations for this item to display
+            self._display_cache[(row, column)] = ""
             return ""
         if "relation_key" in self.meta_columns[column]:
             primary_key = self.meta_columns[column]["relation_key"]
@@ -87,7 +219,20 @@ class SqlAlchemyQueryModel(QAbstractTableModel):
         relation_list = list()
         for related_obj in data:
             relation_list.append(str(getattr(related_obj, primary_key)))
-        return ", ".join(relation_list)
+        self._display_cache[(row, column)] = ", ".join(relation_list)
+        return self._display_cache[(row, column)]
+
+    def clear_display_cache(self, row=None):
+        """
+        Drops the cached display strings of relation columns, either for a single row or, if row
+        is not given, for all rows. Called whenever the displayed relations could have changed.
+        :param int row: optional - Row to drop the cached strings for
+        """
+        if row is None:
+            self._display_cache.clear()
+        else:
+            for key in [key for key in self._display_cache if key[0] == row]:
+                del self._display_cache[key]
 
     def set_relation_display(self, collection, key):
         """
@@ -100,6 +245,7 @@ class SqlAlchemyQueryModel(QAbstractTableModel):
         for field in self.meta_columns:
             if field["name"] == collection and field["type"] == "class_relation":
                 field["relation_key"] = key
+                self.clear_display_cache()
                 return
         raise ValueError("Collection '{}' was not found in query or is no 'class_relation'."
                          .format(collection))
@@ -132,12 +278,245 @@ class SqlAlchemyQueryModel(QAbstractTableModel):
         raise ValueError("Collection '{}' was not found in query or is no 'class_relation'."
                          .format(collection))
 
+    def _paged_query(self):
+        """
+        Returns the query used for fetching pages. The primary key of the first queried entity is
+        appended to the ordering to make LIMIT/OFFSET pages deterministic.
+        """
+        entity = self._query.column_descriptions[0]["entity"]
+        if entity is None:
+            return self._query
+        return self._query.order_by(*inspect(entity).primary_key)
+
+    def _fetch_page(self):
+        fetched = self._paged_query().offset(self._fetched).limit(self._batch_size).all()
+        self._fetched += len(fetched)
+        self._all_fetched = len(fetched) < self._batch_size
+        if not self._inserted:
+            return fetched
+        # rows inserted by this model show up again after they got committed, from then on they
+        # count as fetched
+        identities = {self._identity(item): key for key, item in self._inserted.items()}
+        identities.pop(None, None)
+        rows = list()
+        for item in fetched:
+            key = self._row_key(item)
+            if key not in self._inserted:
+                key = identities.get(self._identity(item))
+            if key is None:
+                rows.append(item)
+            else:
+                del self._inserted[key]
+        return rows
+
+    def _row_key(self, item):
+        return id(item[0] if self._result_is_collection else item)
+
+    def _identity(self, item):
+        """
+        Returns the primary key identity of the row item, None until it got flushed.
+        """
+        state = inspect(item[0] if self._result_is_collection else item, raiseerr=False)
+        return state.identity if state is not None else None
+
+    def _inserted_key(self, item):
+        """
+        Returns the key of item in _inserted, None if it wasn't inserted through this model.
+        The row may have been loaded again as another object after its page was evicted.
+        """
+        key = self._row_key(item)
+        if key in self._inserted:
+            return key
+        identity = self._identity(item)
+        if identity is not None:
+            for key, inserted in self._inserted.items():
+                if self._identity(inserted) == identity:
+                    return key
+        return None
+
+    def _touch_page(self, page):
+        self._pages[page] = None
+        self._pages.move_to_end(page)
+        if not self._evictable:
+            return
+        while len(self._pages) > self._max_pages:
+            evicted, _ = self._pages.popitem(last=False)
+            start = evicted * self._batch_size
+            for row in range(start, min(start + self._batch_size, len(self._data))):
+                item = self._data[row]
+                if item is None or isinstance(item, _EvictedRow):
+                    continue
+                identity = inspect(item).identity
+                if identity is not None:  # pending objects only live inside this model
+                    self._data[row] = _EvictedRow(identity)
+
+    def _restore_page(self, page):
+        start = page * self._batch_size
+        end = min(start + self._batch_size, len(self._data))
+        evicted = {row: self._data[row] for row in range(start, end)
+                   if isinstance(self._data[row], _EvictedRow)}
+        primary_key = inspect(self._query.column_descriptions[0]["entity"]).primary_key
+        identities = [item.identity for item in evicted.values()]
+        if len(primary_key) == 1:
+            condition = primary_key[0].in_([identity[0] for identity in identities])
+        else:
+            condition = tuple_(*primary_key).in_(identities)
+        restored = {inspect(item).identity: item for item in self._query.filter(condition)}
+        for row, item in evicted.items():
+            # rows deleted by someone else in the meantime can't be restored
+            self._data[row] = restored.get(item.identity)
+
+    def _row(self, row):
+        """
+        Returns the query result for row, fetching it again if its page was evicted before.
+        """
+        if self._batch_size is None:
+            return self._data[row]
+        page = row // self._batch_size
+        if isinstance(self._data[row], _EvictedRow):
+            self._restore_page(page)
+        self._touch_page(page)
+        return self._data[row]
+
     def load(self):
-        self._data = self._query.all()
+        description = self._query.column_descriptions
+        # unless a single model class is queried the result of a row is a tuple-like object
+        self._result_is_collection = len(description) > 1 \
+            or description[0]["expr"] is not description[0]["type"]
+        # only results of a single model class can be fetched again by their identity
+        self._evictable = bool(self._max_pages) and not self._result_is_collection
+        self.clear_display_cache()
+        if self._batch_size is None:
+            self._data = self._query.all()
+        else:
+            self._pages.clear()
+            self._inserted.clear()
+            self._fetched = 0
+            self._data = self._fetch_page()
+            self._touch_page(0)
         self._analyse_data()
 
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return False
+        return not self._all_fetched
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._all_fetched:
+            return
+        fetched = self._fetch_page()
+        if not fetched:
+            return
+        first = len(self._data)
+        self.beginInsertRows(QModelIndex(), first, first + len(fetched) - 1)
+        self._data.extend(fetched)
+        for page in range(first // self._batch_size, (len(self._data) - 1) // self._batch_size + 1):
+            self._touch_page(page)
+        self.endInsertRows()
+
+    def _requery(self):
+        """
+        Applies the current ordering and filter to the base query and loads the result again.
+        """
+        self.submit()
+        query = self._base_query
+        if self._filter_text:
+            if self._filter_function:
+                query = self._filter_function(query, self._filter_text)
+            else:
+                query = self._string_filter(query, self._filter_text)
+        if self._order is not None:
+            query = query.order_by(None).order_by(self._order)
+        self.beginResetModel()
+        self._query = query
+        self._last_insert = QModelIndex()
+        self.load()
+        self.endResetModel()
+
+    def _string_filter(self, query, text):
+        escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions = [getattr(field["class"], field["name"])
+                      .ilike("%{}%".format(escaped), escape="\\")
+                      for field in self.meta_columns if field["type"] in ("class_attr", "attr")
+                      and isinstance(field["column_type"], String)]
+        return query.filter(or_(*conditions)) if conditions else query.filter(false())
+
+    def set_filter_function(self, function=None):
+        """
+        Sets the function used by set_filter() to restrict the query, i.e. a full-text search
+        like DbManager.filter_search. Without a function the string columns are searched by LIKE.
+        :param callable function: optional - Called as function(query, text), returns a query
+        """
+        self._filter_function = function
+        if self._filter_text:
+            self._requery()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """
+        Sorts the rows by column inside the database (ORDER BY) and loads them again. Relation
+        columns can't be sorted.
+        """
+        if not (0 <= column < len(self.meta_columns)):
+            return
+        field = self.meta_columns[column]
+        if field["type"] == "class_relation":
+            return
+        expression = getattr(field["class"], field["name"])
+        self._order = expression.desc() if order == Qt.DescendingOrder else expression.asc()
+        self._requery()
+
+    def set_filter(self, text):
+        """
+        Restricts the rows to those containing text in any of their string columns (WHERE) and
+        loads them again. An empty text removes the filter. See set_filter_function() for using
+        a different search.
+        :param str text: Text to search for (case insensitive)
+        """
+        self._filter_text = text if text else ""
+        self._requery()
+
+    def set_commit_delay(self, msecs=None):
+        """
+        Enables write-behind for edits: instead of committing every setData() call, edited rows
+        are committed together in one transaction when the delay has passed since the first
+        uncommitted edit, when another row gets edited, on submit() or an explicit save().
+        If a commit started by the delay fails, the edits are rolled back and commit_failed is
+        emitted with the error.
+        :param int msecs: optional - Delay in milliseconds, None commits every edit immediately
+        """
+        if msecs is not None and msecs < 0:
+            raise ValueError("parameter msecs should not be negative")
+        self._commit_delay = msecs
+        if msecs is None:
+            self.submit()
+        else:
+            self._commit_timer.setInterval(msecs)
+
     def save(self):
-        self._query.session.commit()
+        self._commit_timer.stop()
+        self._pending_row = None
+        try:
+            self._query.session.commit()
+        except SQLAlchemyError:
+            # uncommitted edits are lost, the view has to show the restored values again
+            self._query.session.rollback()
+            if self.rowCount() and self.columnCount():
+                self.dataChanged.emit(self.index(0, 0),
+                                      self.index(self.rowCount() - 1, self.columnCount() - 1))
+            raise
+
+    @pyqtSlot()
+    def submit(self):
+        if self._pending_row is not None:
+            self.save()
+        return True
+
+    @pyqtSlot()
+    def _commit_pending(self):
+        try:
+            self.submit()
+        except SQLAlchemyError as error:  # save() already restored the model
+            self.commit_failed.emit(error)
 
     def vertical_headers_enabled(self, status=True):
         self._vheader_enabled = status
@@ -161,116 +540,131 @@ class SqlAlchemyQueryModel(QAbstractTableModel):
                                      "orientation": orientation}
 
     def data(self, index, role=Qt.DisplayRole):
+        if role not in (Qt.DisplayRole, Qt.EditRole, Qt.UserRole):
+            return None
         if not index.isValid() or not (0 <= index.row() < len(self._data)):
             return None
-        data = self._data[index.row()]
-        column = index.column()
-        value = None
-        if role in (Qt.DisplayRole, Qt.EditRole, Qt.UserRole):
-            if self._result_is_collection:
-                model_obj = data[self.meta_columns[column]["result_position"]]
-                # handle collections returned by query
-                if self.meta_columns[column]["type"] == "class_attr":
-                    value = getattr(model_obj, self.meta_columns[column]["name"])
-                if self.meta_columns[column]["type"] == "attr":
-                    value = model_obj
-                if self.meta_columns[column]["type"] == "class_relation":
-                    value = self._list_relations(index) if role == Qt.DisplayRole \
-                        else getattr(model_obj, self.meta_columns[column]["name"])
-                if role == Qt.UserRole:
-                    value = model_obj
-            else:
-                # handle single result (only possible, when a single model class was queried for
-                if self.meta_columns[column]["type"] == "class_relation":
-                    value = self._list_relations(index) if role == Qt.DisplayRole \
-                        else getattr(data, self.meta_columns[column]["name"])
-                else:
-                    value = getattr(data, self.meta_columns[column]["name"])
-                if role == Qt.UserRole:
-                    value = data
-            # Checking value or meta_columns type for individual type representation:
-            if isinstance(value, date):
-                value = QDate(value)
-            return value
-        return None
+        data = self._row(index.row())
+        if data is None:  # row was evicted and deleted elsewhere meanwhile
+            return None
+        accessor = self._accessors[index.column()]
+        if role == Qt.UserRole:
+            value = accessor.obj(data)
+        elif role == Qt.DisplayRole and accessor.relation:
+            return self._list_relations(index)
+        else:
+            value = accessor.value(data)
+        return accessor.convert(value) if accessor.convert else value
 
     def setData(self, index, value, role=Qt.EditRole):
         if role == Qt.EditRole:
             if not index.isValid() or not (0 <= index.row() < len(self._data)):
                 return False
-            data = self._data[index.row()]
-            column = index.column()
+            data = self._row(index.row())
+            if data is None:
+                return False
+            row_key = self._row_key(data)
+            if self._pending_row is not None and self._pending_row != row_key:
+                self.save()  # moving on to another row commits the previous one
+            accessor = self._accessors[index.column()]
             if isinstance(value, QDate):
                 value = value.toPyDate()
-            if self._result_is_collection:
-                model_obj = data[self.meta_columns[column]["result_position"]]
-                # handle collections returned by query
-                if self.meta_columns[column]["type"] == "class_attr":
-                    setattr(model_obj, self.meta_columns[column]["name"], value)
-                if self.meta_columns[column]["type"] == "attr":
-                    # data[self.meta_columns[column]["result_position"]] = element
-                    pass  # TODO: Handle editing for single columns (not easy in SqlAlchemy)
-                if self.meta_columns[column]["type"] == "class_relation":
-                    setattr(model_obj, self.meta_columns[column]["name"], value)
+            if accessor.editable:
+                setattr(accessor.obj(data), accessor.name, value)
+            # TODO: Handle editing for single columns (type 'attr', not easy in SqlAlchemy)
+            self.clear_display_cache(index.row())
+            if self._commit_delay is None:
+                self.save()
             else:
-                # handle single result (only possible, when a single model class was queried for
-                setattr(data, self.meta_columns[column]["name"], value)
-            self.save()
-            self.dataChanged.emit(index, index, (Qt.EditRole,))
+                self._pending_row = row_key
+                if not self._commit_timer.isActive():
+                    self._commit_timer.start()
+            self.dataChanged.emit(index, index, (Qt.DisplayRole, Qt.EditRole))
             return True
         else:
             return False
 
-    def insertRows(self, row, count, parent=None, *args, **kwargs):
-        if count > 1 or row > self.rowCount():
+    def insertRows(self, row, count, parent=QModelIndex(), *args, **kwargs):
+        if count < 1 or row < 0 or row > self.rowCount():
             return False
         column_types = list()
         for column in self.meta_columns:
             if column["type"] == "class_attr" and column["class"] not in column_types:
                 column_types.append(column["class"])
         if 0 < len(column_types) < 2:
-            new_row = column_types[0]()
+            new_rows = [column_types[0]() for _ in range(count)]
         elif 0 < len(column_types) >= 2:
-            new_row = tuple(type_() for type_ in column_types)
+            new_rows = [tuple(type_() for type_ in column_types) for _ in range(count)]
         else:
             return False
         self.beginInsertRows(parent, row, row + count - 1)
+        self.clear_display_cache()
+        self._data[row:row] = new_rows
         self._last_insert = self.index(row, 0)
-        if row < self.rowCount():
-            self._data.insert(row, new_row)
-        elif row == self.rowCount():
-            self._data.append(new_row)
-        if isinstance(new_row, tuple):
-            self._query.session.add_all(new_row)
-        else:
-            self._query.session.add(new_row)
+        for new_row in new_rows:
+            self._inserted[self._row_key(new_row)] = new_row
+            if isinstance(new_row, tuple):
+                self._query.session.add_all(new_row)
+            else:
+                self._query.session.add(new_row)
         self.endInsertRows()
         return True
 
-    def removeRows(self, row, count, parent=None, *args, **kwargs):
-        if row < 0 or row > self.rowCount():
+    def _preload_relations(self, objects):
+        """
+        Loads the relationships of all persistent objects with a few SELECT ... IN queries, so
+        deleting them doesn't issue a query per object to find their association rows.
+        """
+        by_class = dict()
+        for obj in objects:
+            state = inspect(obj)
+            if state.identity is not None and state.mapper.relationships:
+                by_class.setdefault(state.mapper, list()).append(state.identity)
+        for mapper, identities in by_class.items():
+            if len(mapper.primary_key) != 1:
+                continue
+            options = [selectinload(getattr(mapper.class_, relation))
+                       for relation in mapper.relationships.keys()]
+            for start in range(0, len(identities), 500):  # stay below SQLite's variable limit
+                chunk = [identity[0] for identity in identities[start:start + 500]]
+                self._query.session.query(mapper.class_).options(*options)\
+                    .filter(mapper.primary_key[0].in_(chunk)).all()
+
+    def removeRows(self, row, count, parent=QModelIndex(), *args, **kwargs):
+        if count < 1 or row < 0 or row + count > self.rowCount():
             return False
-        item = self._data[row]  # Only implemented for single row removal, yet
+        items = [self._row(position) for position in range(row, row + count)]
+        objects = list()
+        for item in items:
+            if item is None:  # already deleted elsewhere
+                continue
+            for content in (item if self._result_is_collection else (item,)):
+                if inspect(content, raiseerr=False) is not None:  # skip single column values
+                    objects.append(content)
+        session = self._query.session
+        self._preload_relations([obj for obj in objects if obj not in session.new])
         self.beginRemoveRows(parent, row, row + count - 1)
-        if type(item).__name__ == "result" or isinstance(item, tuple):
-            for content in item:
-                if content in self._query.session.new:
-                    self._query.session.expunge(content)
-                else:
-                    self._query.session.delete(content)
-        else:
-            if item in self._query.session.new:
-                self._query.session.expunge(item)
+        self.clear_display_cache()
+        for obj in objects:
+            if obj in session.new:
+                session.expunge(obj)
             else:
-                self._query.session.delete(item)
+                session.delete(obj)
         self.save()
-        self.load()
+        if self._batch_size is not None:
+            # keep the offset for fetching the next page aligned with the database
+            for item in items:
+                key = self._inserted_key(item) if item is not None else None
+                if key is not None:
+                    del self._inserted[key]
+                else:
+                    self._fetched -= 1
+        del self._data[row:row + count]
         self.endRemoveRows()
         return True
 
     def flags(self, index):
-        column = index.column()
-        if self.meta_columns[column]["type"] in ("class_attr", "class_relation"):
+        if self._accessors[index.column()].editable:
             return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
         else:
             return Qt.ItemIsEnabled | Qt.ItemIsSelectable
@@ -283,9 +677,36 @@ class SqlAlchemyQueryModel(QAbstractTableModel):
 
 
 class SortFilterModel(QSortFilterProxyModel):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, server_side=False):
+        """
+        Proxy model for sorting and filtering a SqlAlchemyQueryModel. In server_side mode the
+        proxy doesn't compare any rows itself but passes sorting and filtering on to the source
+        model, which turns them into ORDER BY and WHERE clauses of its query. This is needed
+        whenever the source model fetches its rows incrementally.
+        :param QObject parent: optional - Parent of the model
+        :param bool server_side: optional - Whether the database sorts and filters
+        """
         super(SortFilterModel, self).__init__(parent)
         self._keep_vheader_order = True
+        self._server_side = server_side
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if self._server_side:
+            self.sourceModel().sort(column, order)
+        else:
+            super(SortFilterModel, self).sort(column, order)
+
+    def set_filter(self, text):
+        """
+        Shows only rows containing text in one of their columns (case insensitive).
+        :param str text: Text to search for, an empty text removes the filter
+        """
+        if self._server_side:
+            self.sourceModel().set_filter(text)
+        else:
+            self.setFilterCaseSensitivity(Qt.CaseInsensitive)
+            self.setFilterKeyColumn(-1)
+            self.setFilterFixedString(text)
 
     def keep_vertical_header_order(self, status=True):
         self._keep_vheader_order = status
@@ -400,14 +821,74 @@ class SqlAlchemySelectDialog(QDialog):
         self.accept()
 
 
+def qt_thumbnail(read, cache):
+    """
+    Preview generator for PreviewCache scaling images down to its thumbnail_size with Qt, used
+    if Pillow isn't available. Formats like JPEG are decoded at the reduced size right away.
+    """
+    data = QByteArray(read(None))
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    size = reader.size()
+    if size.isValid():
+        size.scale(cache.thumbnail_size[0], cache.thumbnail_size[1], Qt.KeepAspectRatio)
+        reader.setScaledSize(size)
+    image = reader.read()
+    if image.isNull():
+        return None
+    if image.width() > cache.thumbnail_size[0] or image.height() > cache.thumbnail_size[1]:
+        image = image.scaled(cache.thumbnail_size[0], cache.thumbnail_size[1],
+                             Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    output = QByteArray()
+    output_buffer = QBuffer(output)
+    output_buffer.open(QIODevice.WriteOnly)
+    image.save(output_buffer, "PNG")
+    return Preview("image", bytes(output))
+
+
+def use_previews(cache):
+    """
+    Prepares a PreviewCache for the Qt views, adding the Qt thumbnail generator if needed.
+    """
+    if cache is not None and cache.generator("image/png") is None:
+        cache.register("image/", qt_thumbnail)
+
+
 class SqlAlchemyAddFileDialog(QDialog):
-    def __init__(self, caption, parent=None):
+    """
+    Dialog for choosing files and copying them into a FileManager. The files are stored in the
+    background by FileManager.store_many(), while a progress bar shows how far it got and Cancel
+    skips the files not copied yet. stored lists the stored items, even if the dialog was
+    cancelled after some files were copied.
+    """
+    store_progress = pyqtSignal(int, int)
+    store_finished = pyqtSignal(object)
+    preview_ready = pyqtSignal(str, object)
+
+    def __init__(self, caption, storage=None, previews=None, parent=None):
         super(SqlAlchemyAddFileDialog, self).__init__(parent)
         self.setWindowTitle(caption)
+        self.storage = storage
+        self.previews = previews
+        use_previews(previews)
+        self.sources = list()
+        self.stored = list()  # item names of the files stored by the dialog
+        self._cancel = threading.Event()
+        self._storing = False
         self.name_edit = QLineEdit()
         self.name_edit.setMinimumWidth(300)
         self.meta_data_display = QPlainTextEdit()
         self.meta_data_display.setEnabled(False)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.hide()
+        self.preview_label = QLabel()
+        self.preview_label.setWordWrap(True)
+        self.preview_label.setAlignment(Qt.AlignCenter)
+        if previews is not None:
+            self.preview_label.setFixedWidth(previews.thumbnail_size[0])
+        else:
+            self.preview_label.hide()
         name_label = QLabel(qApp.translate("SqlAlchemyAddFileDialog", "&Name:"))
         name_label.setBuddy(self.name_edit)
         meta_data_label = QLabel(qApp.translate("SqlAlchemyAddFileDialog", "&File Info:"))
@@ -430,35 +911,130 @@ class SqlAlchemyAddFileDialog(QDialog):
         dialog_layout.addWidget(self.new_button, 0, 2)
         dialog_layout.addWidget(meta_data_label, 1, 0)
         dialog_layout.addWidget(self.meta_data_display, 1, 1, 1, 2)
-        dialog_layout.addLayout(button_layout, 2, 2, Qt.AlignRight)
+        dialog_layout.addWidget(self.preview_label, 1, 3)
+        dialog_layout.addWidget(self.progress_bar, 2, 0, 1, 4)
+        dialog_layout.addLayout(button_layout, 3, 2, 1, 2, Qt.AlignRight)
         self.setLayout(dialog_layout)
 
         # Connection
         self.new_button.pressed.connect(self.new_pressed)
-        self.cancel_button.pressed.connect(self.reject)
+        self.add_button.pressed.connect(self.add_pressed)
+        self.cancel_button.pressed.connect(self.cancel_pressed)
+        # emitted by worker threads, queued into the GUI thread
+        self.store_progress.connect(self.show_progress)
+        self.store_finished.connect(self.storing_finished)
+        self.preview_ready.connect(self.show_preview)
 
     @pyqtSlot()
     def new_pressed(self):
         start_dir = QStandardPaths.standardLocations(QStandardPaths.HomeLocation)[-1]
         file_dialog = QFileDialog(self)
         file_dialog.setDirectory(start_dir)
+        file_dialog.setFileMode(QFileDialog.ExistingFiles)
         if file_dialog.exec_():
-            # TODO: Implement File-adding logic using storage module
+            self.sources = file_dialog.selectedFiles()
+            single = len(self.sources) == 1
+            self.name_edit.setEnabled(single)
+            self.name_edit.setText(os.path.basename(self.sources[0]) if single else "")
+            self.meta_data_display.setPlainText("\n".join(self.sources))
             self.add_button.setEnabled(True)
+            self.preview_label.clear()
+            if self.previews is not None and single:
+                self.previews.request_path(self.sources[0], self.preview_ready.emit)
+
+    @pyqtSlot(str, object)
+    def show_preview(self, path, preview):
+        if self.sources != [path] or preview is None:
+            return
+        if preview.kind == "image":
+            pixmap = QPixmap()
+            pixmap.loadFromData(preview.data)
+            self.preview_label.setPixmap(pixmap)
+        else:
+            self.preview_label.setText(preview.data)
 
     @pyqtSlot()
     def add_pressed(self):
-        self.accept()
+        if not self.storage or not self.sources:
+            self.accept()
+            return
+        sources = self.sources
+        if len(sources) == 1 and self.name_edit.text():
+            sources = [(sources[0], self.name_edit.text())]
+        self._storing = True
+        self._cancel.clear()
+        self.add_button.setEnabled(False)
+        self.new_button.setEnabled(False)
+        self.progress_bar.setRange(0, len(sources))
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        threading.Thread(target=self._store, args=(sources,), daemon=True).start()
+
+    def _store(self, sources):
+        try:
+            results = self.storage.store_many(
+                sources, cancel=self._cancel,
+                progress=lambda done, total, result: self.store_progress.emit(done, total))
+        except Exception as error:  # i.e. the FileManager isn't set up, nothing got stored
+            results = error
+        self.store_finished.emit(results)
+
+    @pyqtSlot(int, int)
+    def show_progress(self, done, total):
+        self.progress_bar.setValue(done)
+
+    @pyqtSlot(object)
+    def storing_finished(self, results):
+        self._storing = False
+        if isinstance(results, Exception):
+            if self._cancel.is_set():
+                self.reject()
+                return
+            self.meta_data_display.setPlainText(str(results))
+            self.add_button.setEnabled(True)
+            self.new_button.setEnabled(True)
+            return
+        self.stored.extend(result.item for result in results if result.error is None)
+        failed = [result for result in results if result.error is not None]
+        if self._cancel.is_set():
+            self.reject()
+            return
+        if not failed:
+            self.accept()
+            return
+        self.sources = [result.source[0] if isinstance(result.source, tuple) else result.source
+                        for result in failed]
+        self.meta_data_display.setPlainText("\n".join(
+            "{}: {}".format(result.source, result.error) for result in failed))
+        self.add_button.setEnabled(True)
+        self.new_button.setEnabled(True)
+
+    @pyqtSlot()
+    def cancel_pressed(self):
+        if self._storing:
+            self._cancel.set()  # storing_finished() closes the dialog
+        else:
+            self.reject()
 
 
 class DisplayWidget(QWidget):
+    preview_ready = pyqtSignal(str, object)
+
     def __init__(self, model, parent=None):
         super(DisplayWidget, self).__init__(parent)
         self._last_index = None
         self._edit_new = False
         self._file_fields = ("name", "subpath", "timestamp")
+        self.previews = None  # PreviewCache for the files, see set_previews()
+        self.storage = None  # FileManager new files are added to, see set_storage()
 
         # Widgets
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText(qApp.translate("DisplayWidget", "Search"))
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_timer = QTimer(self)  # delays searching while typing
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(300)
         self.entry_display = QTableView()
         self.entry_display.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.entry_display.setEditTriggers(QAbstractItemView.NoEditTriggers)
@@ -544,6 +1120,7 @@ class DisplayWidget(QWidget):
         button_layout.setAlignment(Qt.AlignTop)
         sub_layout.addLayout(edit_layout)
         sub_layout.addLayout(button_layout)
+        main_layout.addWidget(self.search_edit)
         main_layout.addWidget(self.entry_display)
         main_layout.addLayout(sub_layout)
         self.setLayout(main_layout)
@@ -561,6 +1138,53 @@ class DisplayWidget(QWidget):
         self.fconnect_button.pressed.connect(self.fconnect_pressed)
         self.fdisconnect_button.pressed.connect(self.fdisconnect_pressed)
         self.fadd_button.pressed.connect(self.fadd_pressed)
+        self.search_edit.textChanged.connect(self.search_timer.start)
+        self.search_timer.timeout.connect(self.search)
+        self.mapper.currentIndexChanged.connect(self.update_previews)
+        self.preview_ready.connect(self.show_preview)
+
+    def set_previews(self, cache):
+        """
+        Shows previews of the files of the current entry, thumbnails as icons and text excerpts
+        as tool tips. They are created in the background by the PreviewCache.
+        :param PreviewCache cache: Cache creating the previews, None disables them
+        """
+        use_previews(cache)
+        self.previews = cache
+        self.update_previews()
+
+    def set_storage(self, storage):
+        """
+        Sets the FileManager the files chosen by 'Add File' are stored in.
+        :param FileManager storage: FileManager for new files, None only lets them be chosen
+        """
+        self.storage = storage
+
+    @pyqtSlot()
+    def update_previews(self):
+        if self.previews is None:
+            return
+        for row in range(self.file_edit.rowCount()):
+            file = self.file_edit.item(row, 0).data(Qt.UserRole)
+            try:
+                self.previews.request(FileManager.file_item(file), self.preview_ready.emit)
+            except (FileNotFoundError, ValueError):  # not in the storage
+                continue
+
+    @pyqtSlot(str, object)
+    def show_preview(self, item, preview):
+        if preview is None:
+            return
+        for row in range(self.file_edit.rowCount()):
+            cell = self.file_edit.item(row, 0)
+            if FileManager.file_item(cell.data(Qt.UserRole)) != item:
+                continue
+            if preview.kind == "image":
+                pixmap = QPixmap()
+                pixmap.loadFromData(preview.data)
+                cell.setData(Qt.DecorationRole, QIcon(pixmap))
+            else:
+                cell.setToolTip(preview.data)
 
     def enable_mapping(self):
         self.mapper.addMapping(self.title_edit, 1)
@@ -583,6 +1207,10 @@ class DisplayWidget(QWidget):
     def model(self):
         return self.entry_display.model()
 
+    @pyqtSlot()
+    def search(self):
+        self.model().set_filter(self.search_edit.text())
+
     @pyqtSlot()
     def add_pressed(self):
         model = self.model()
@@ -664,6 +1292,7 @@ class DisplayWidget(QWidget):
                     if column == 0:
                         item.setData(Qt.UserRole, file)
                     self.file_edit.setItem(row, column, item)
+            self.update_previews()
             self.date_edit.editingFinished.emit()  # To trigger start_edit_mode()
 
     @pyqtSlot()
@@ -676,7 +1305,9 @@ class DisplayWidget(QWidget):
 
     @pyqtSlot()
     def fadd_pressed(self):
-        dialog = SqlAlchemyAddFileDialog(qApp.translate("DisplayWidget", "Add a new File"))
+        dialog = SqlAlchemyAddFileDialog(qApp.translate("DisplayWidget", "Add a new File"),
+                                         storage=self.storage, previews=self.previews,
+                                         parent=self)
         if dialog.exec_():
             pass
 
@@ -686,6 +1317,8 @@ class DiaryViewer(QMainWindow):
         super(DiaryViewer, self).__init__(parent)
         self.model = None
         self.sortable_model = None
+        self.previews = None
+        self.storage = None
         self.setWindowTitle("Diary")
         if not self.load_settings():
             self.setGeometry(200, 20, 1500, 1000)
@@ -694,25 +1327,57 @@ class DiaryViewer(QMainWindow):
         if not self.sortable_model:
             raise ValueError("No model available, set a data soure first.")
         central_widget = DisplayWidget(self.sortable_model, self)
+        central_widget.set_previews(self.previews)
+        central_widget.set_storage(self.storage)
         self.setCentralWidget(central_widget)
 
-    def set_source(self, source):
+    def set_previews(self, cache):
+        """
+        Sets the PreviewCache for showing previews of files (see DisplayWidget.set_previews()).
+        """
+        self.previews = cache
+        if self.centralWidget():
+            self.centralWidget().set_previews(cache)
+
+    def set_storage(self, storage):
+        """
+        Sets the FileManager new files are stored in (see DisplayWidget.set_storage()).
+        """
+        self.storage = storage
+        if self.centralWidget():
+            self.centralWidget().set_storage(storage)
+
+    def set_source(self, source, batch_size=256, max_pages=20, search=None):
         """
         Sets the data source used for models inside DiaryView and its widgets.
         :param sqlalchemy.orm.query.Query source:  Query to the data for display
+        :param int batch_size: optional - Rows fetched at once, None loads all rows immediately
+        :param int max_pages: optional - Pages of rows kept in memory while scrolling
+        :param callable search: optional - Filter function for the search box, i.e.
+        DbManager.filter_search (see SqlAlchemyQueryModel.set_filter_function())
         """
-        self.model = SqlAlchemyQueryModel(source, self)
+        self.model = SqlAlchemyQueryModel(source, self, batch_size=batch_size,
+                                          max_pages=max_pages if batch_size else None)
         self.model.set_relation_display("files", "name")
+        self.model.set_commit_delay(2000)
+        self.model.commit_failed.connect(self.show_commit_error)
+        self.model.set_filter_function(search)
         self.model.vertical_headers_enabled()
         self.model.setHeaderData(0, Qt.Horizontal, qApp.translate("DiaryViewer", "ID"))
         self.model.setHeaderData(1, Qt.Horizontal, qApp.translate("DiaryViewer", "Title"))
         self.model.setHeaderData(2, Qt.Horizontal, qApp.translate("DiaryViewer", "Text"))
         self.model.setHeaderData(3, Qt.Horizontal, qApp.translate("DiaryViewer", "Date"))
         self.model.setHeaderData(4, Qt.Horizontal, qApp.translate("DiaryViewer", "Files"))
-        self.sortable_model = SortFilterModel(self)
+        self.sortable_model = SortFilterModel(self, server_side=batch_size is not None)
         self.sortable_model.setSourceModel(self.model)
         self._setup_ui()
 
+    @pyqtSlot(object)
+    def show_commit_error(self, error):
+        QMessageBox.warning(self, qApp.translate("DiaryViewer", "Saving failed"),
+                            qApp.translate("DiaryViewer", "The latest changes couldn't be saved "
+                                                          "and were undone:\n{}").format(error))
+
     def load_settings(self):
         """
         Tries to load the saved settings and geometry for this QMainWindow from configmanager of
@@ -725,6 +1390,8 @@ class DiaryViewer(QMainWindow):
 
     def closeEvent(self, event):
         # TODO: Use configmanager module to save settings of DiaryViewer
+        if self.model:
+            self.model.submit()  # commit edits still waiting for the write-behind delay
         super(DiaryViewer, self).closeEvent(event)
 
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from diary.storage import is_temp_name
+
+
+class Inotify:
+    """
+    Minimal binding of the Linux inotify API through ctypes. Raises OSError on systems
+    without inotify.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+        IN_DELETE
+    _event = struct.Struct("iIII")  # watch descriptor, mask, cookie, length of the name
+
+    def __init__(self):
+        library = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(library, use_errno=True)
+        try:
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify is not available.")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories = dict()  # directory by watch descriptor
+
+    def watch(self, directory):
+        descriptor = self._add_watch(self.fd, os.fsencode(directory), self.mask)
+        if descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+        self._directories[descriptor] = directory
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds for events.
+        :return: (path, mask) of every event, path is None for IN_Q_OVERFLOW
+        :rtype: list
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return list()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return list()
+        events = list()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_IGNORED:  # the directory is gone
+                self._directories.pop(descriptor, None)
+            elif mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif descriptor in self._directories and name:
+                events.append((os.path.join(self._directories[descriptor], name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class StorageWatcher:
+    """
+    Watches the items of a FileManager for changes made outside of it and applies them to the
+    File rows of its backend through FileManager.reconcile(), which only hashes files again if
+    their size or modification time changed. On Linux inotify reports the changes, elsewhere
+    the directory tree is polled every interval seconds. Changes are debounced: items are
+    collected until they weren't touched for debounce seconds, so writing a file results in a
+    single update. Listeners, i.e. caches, are called from the watcher thread with the set of
+    changed items afterwards, or with None when everything has to be considered changed.
+    """
+    def __init__(self, file_manager, debounce=0.5, interval=5.0, polling=None):
+        """
+        :param FileManager file_manager: FileManager to watch
+        :param float debounce: optional - Seconds without changes before they are applied
+        :param float interval: optional - Seconds between two scans when polling
+        :param bool polling: optional - True to always poll, False to require inotify, by
+                             default inotify is used where it's available
+        """
+        self._manager = file_manager
+        self.debounce = debounce
+        self.interval = interval
+        self._polling = polling
+        self._listeners = list()
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._top = None
+        self._previous = None  # snapshot of the last scan when polling
+        self._pending = set()
+        self._rescan = False  # whether everything has to be checked
+        self.error = None  # last error raised while applying changes, they are tried again
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None if self.is_running else None
+
+    def start(self):
+        if self.is_running:
+            return
+        self._top = self._manager.items_directory
+        if self._top is None:
+            raise ValueError("StorageWatcher needs a FileManager with a local storage.")
+        self._inotify = None
+        if not self._polling:
+            try:
+                self._inotify = Inotify()
+            except OSError:
+                if self._polling is False:
+                    raise
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch if self._inotify else self._poll,
+                                        name="diary-watcher", daemon=True)
+        # watches and the first snapshot exist before start() returns, so no change is missed
+        if self._inotify:
+            self._watch_tree(self._top)
+        else:
+            self._previous = self._snapshot()
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops watching, changes not applied yet are applied before.
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _directories(self, top):
+        for directory, subdirectories, _ in os.walk(top):
+            if directory == self._top and not self._manager._content_addressed:
+                subdirectories[:] = [name for name in subdirectories
+                                     if name not in ("names", "blobs")]
+            yield directory
+
+    def _item(self, path):
+        item = os.path.relpath(path, self._top)
+        if item.startswith(os.pardir) or is_temp_name(os.path.basename(path)):
+            return None
+        if not self._manager._content_addressed and \
+                item.split(os.sep)[0] in ("names", "blobs"):
+            return None
+        return item
+
+    def _watch_tree(self, top):
+        """
+        Watches top and its subdirectories and returns the items found inside.
+        """
+        items = set()
+        for directory in self._directories(top):
+            try:
+                self._inotify.watch(directory)
+                names = os.listdir(directory)
+            except OSError:  # removed again in the meantime
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                item = self._item(path)
+                if item and os.path.isfile(path):
+                    items.add(item)
+        return items
+
+    def _flush(self):
+        items = None if self._rescan else set(self._pending)
+        try:
+            if self._manager._db is not None:
+                self._manager.reconcile(fix=True, items=items)
+        except Exception as error:  # kept pending for the next try
+            self.error = error
+            return
+        self._pending.clear()
+        self._rescan = False
+        for listener in list(self._listeners):
+            listener(items)
+
+    def _watch(self):
+        last_event = 0
+        try:
+            while not self._stop.is_set():
+                events = self._inotify.read(self.debounce if self._pending else 0.5)
+                for path, mask in events:
+                    last_event = time.monotonic()
+                    if path is None:  # events were lost
+                        self._rescan = True
+                    elif mask & Inotify.IN_ISDIR:
+                        if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                            self._pending.update(self._watch_tree(path))
+                        elif mask & Inotify.IN_MOVED_FROM:  # items moved away with it
+                            self._rescan = True
+                    else:
+                        item = self._item(path)
+                        if item:
+                            self._pending.add(item)
+                if (self._pending or self._rescan) and \
+                        time.monotonic() - last_event >= self.debounce:
+                    self._flush()
+            if self._pending or self._rescan:
+                self._flush()
+        finally:
+            self._inotify.close()
+
+    def _snapshot(self):
+        snapshot = dict()
+        for directory in self._directories(self._top):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    item = self._item(entry.path)
+                    if item:
+                        stat = entry.stat(follow_symlinks=False)
+                        snapshot[item] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            current = self._snapshot()
+            changed = {item for item in current.keys() | self._previous.keys()
+                       if current.get(item) != self._previous.get(item)}
+            self._previous = current
+            # items changed since the last scan may still be written, they wait for the next
+            ready = self._pending - changed
+            self._pending.update(changed)
+            if ready:
+                waiting = self._pending - ready
+                self._pending = ready
+                self._flush()
+                self._pending.update(waiting)
+        if self._pending:
+            self._flush()
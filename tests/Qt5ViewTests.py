@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import tempfile
+import unittest
+from os import path
+from unittest.mock import patch
+from datetime import date
+from PyQt5.QtCore import Qt, QDate
+from PyQt5.QtTest import QTest
+from PyQt5.QtWidgets import QApplication
+from sqlalchemy.exc import OperationalError
+from diary.database import DbManager
+from diary.models import Entry, File
+from diary.storage import FileManager
+from diary.views.Qt5View import SqlAlchemyQueryModel, SortFilterModel, _EvictedRow, \
+    SqlAlchemyAddFileDialog, DiaryViewer
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")  # no display needed
+app = QApplication.instance() or QApplication([])
+
+
+class QueryModelTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db = DbManager()
+        self.db.initialize(db=path.join(self.temp_dir.name, "diary.db"))
+        self.db.add(*[Entry(title="entry {:02}".format(number), text="text")
+                      for number in range(25)])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.session.remove()
+        self.db.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def titles(self, model):
+        column = self.column(model, "title")
+        return [model.data(model.index(row, column)) for row in range(model.rowCount())]
+
+    @staticmethod
+    def column(model, name):
+        return [field["name"] for field in model.meta_columns].index(name)
+
+    def committed_titles(self):
+        with self.db.task_session() as session:
+            return sorted(entry.title for entry in session.query(Entry))
+
+    def test_fetch_more(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=10)
+        self.assertEqual(test.rowCount(), 10)
+        self.assertTrue(test.canFetchMore())
+        test.fetchMore()
+        test.fetchMore()
+        self.assertEqual(test.rowCount(), 25)
+        self.assertFalse(test.canFetchMore())
+        self.assertEqual(self.titles(test), ["entry {:02}".format(number)
+                                             for number in range(25)])
+
+    def test_eviction(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=5, max_pages=2)
+        while test.canFetchMore():
+            test.fetchMore()
+        self.assertEqual(test.rowCount(), 25)
+        self.assertEqual(list(test._pages), [3, 4])
+        self.assertIsInstance(test._data[0], _EvictedRow)
+        self.db.session.expunge_all()  # restoring has to query the rows again
+        column = self.column(test, "title")
+        self.assertEqual(test.data(test.index(1, column)), "entry 01")
+        self.assertNotIsInstance(test._data[0], _EvictedRow)
+        self.assertEqual(list(test._pages), [4, 0])
+        self.assertIsInstance(test._data[15], _EvictedRow)
+
+    def test_eviction_of_deleted_rows(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=5, max_pages=1)
+        test.fetchMore()
+        with self.db.task_session() as session:
+            session.query(Entry).filter(Entry.title == "entry 00").delete()
+        self.db.session.expunge_all()
+        self.assertIsNone(test.data(test.index(0, self.column(test, "title"))))
+        self.assertEqual(test.data(test.index(1, self.column(test, "title"))), "entry 01")
+
+    def test_remove_rows(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=5)
+        test.fetchMore()
+        self.assertTrue(test.removeRows(2, 3))
+        self.assertEqual(test._fetched, 7)
+        while test.canFetchMore():
+            test.fetchMore()
+        expected = ["entry {:02}".format(number) for number in range(25) if number not in (2, 3, 4)]
+        self.assertEqual(self.titles(test), expected, msg="No rows may be skipped or repeated.")
+        self.assertEqual(self.committed_titles(), expected)
+
+    def test_remove_inserted_rows(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=5)
+        test.insertRows(0, 2)
+        self.assertTrue(test.removeRows(0, 3))
+        self.assertEqual(test._fetched, 4)
+        while test.canFetchMore():
+            test.fetchMore()
+        self.assertEqual(self.titles(test), ["entry {:02}".format(number)
+                                             for number in range(1, 25)])
+
+    def test_inserted_rows_after_eviction(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=5, max_pages=1)
+        test.insertRows(0, 1)
+        test.setData(test.index(0, self.column(test, "title")), "NEW")
+        while test.canFetchMore():
+            test.fetchMore()
+        self.assertIsInstance(test._data[0], _EvictedRow)
+        titles = self.titles(test)
+        self.assertEqual(len(titles), 26)
+        self.assertEqual(titles.count("NEW"), 1, msg="Inserted rows shouldn't be fetched again.")
+        self.db.session.expunge_all()  # the row is a new object when it is loaded again
+        test.load()
+        test.insertRows(0, 1)
+        test.setData(test.index(0, self.column(test, "title")), "NEWER")
+        self.db.session.expunge_all()
+        while test.canFetchMore():
+            test.fetchMore()
+        self.assertEqual(self.titles(test).count("NEWER"), 1)
+        self.assertTrue(test.removeRows(0, 1))
+        self.assertEqual(test._inserted, dict())
+        self.assertEqual(test._fetched, 26, msg="Inserted rows aren't counted as fetched.")
+
+    def test_commit_delay(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry))
+        column = self.column(test, "title")
+        with self.assertRaises(ValueError):
+            test.set_commit_delay(-1)
+        test.set_commit_delay(60000)
+        self.assertTrue(test.setData(test.index(0, column), "changed 00"))
+        self.assertTrue(test.setData(test.index(0, column), "changed 00 again"))
+        self.assertNotIn("changed 00 again", self.committed_titles())
+        self.assertTrue(test._commit_timer.isActive())
+        test.setData(test.index(1, column), "changed 01")
+        self.assertIn("changed 00 again", self.committed_titles(),
+                      msg="Editing another row should commit the previous one.")
+        self.assertNotIn("changed 01", self.committed_titles())
+        test.save()
+        self.assertIn("changed 01", self.committed_titles())
+        self.assertFalse(test._commit_timer.isActive())
+        test.setData(test.index(2, column), "changed 02")
+        test.set_commit_delay(None)
+        self.assertIn("changed 02", self.committed_titles())
+        test.setData(test.index(3, column), "changed 03")
+        self.assertIn("changed 03", self.committed_titles())
+
+    def test_commit_delay_failing(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry))
+        errors = list()
+        test.commit_failed.connect(errors.append)
+        test.set_commit_delay(10)
+        test.setData(test.index(0, self.column(test, "title")), "lost")
+        error = OperationalError("COMMIT", None, Exception("database is locked"))
+        with patch.object(test._query.session, "commit", side_effect=error):
+            for _ in range(50):
+                QTest.qWait(10)
+                if errors:
+                    break
+        self.assertEqual(errors, [error], msg="The failed commit should be reported.")
+        self.assertEqual(test.data(test.index(0, self.column(test, "title"))), "entry 00")
+
+    def test_sort(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=10)
+        test.sort(self.column(test, "title"), Qt.DescendingOrder)
+        self.assertEqual(test.rowCount(), 10)
+        while test.canFetchMore():
+            test.fetchMore()
+        self.assertEqual(self.titles(test), ["entry {:02}".format(number)
+                                             for number in reversed(range(25))])
+        test.sort(self.column(test, "files"))  # relation columns are ignored
+        self.assertEqual(self.titles(test)[0], "entry 24")
+
+    def test_filter(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=10)
+        test.set_filter("ENTRY 1")
+        self.assertEqual(self.titles(test), ["entry {:02}".format(number)
+                                             for number in range(10, 20)])
+        test.set_filter("100%")
+        self.assertEqual(test.rowCount(), 0)
+        test.set_filter_function(lambda query, text: query.filter(Entry.title.endswith(text)))
+        test.set_filter("5")
+        self.assertEqual(self.titles(test), ["entry 05", "entry 15"])
+        test.set_filter("")
+        self.assertEqual(test.rowCount(), 10)
+
+    def test_server_side_proxy(self):
+        source = SqlAlchemyQueryModel(self.db.read(Entry), batch_size=10)
+        test = SortFilterModel(server_side=True)
+        test.setSourceModel(source)
+        column = self.column(source, "title")
+        test.sort(column, Qt.DescendingOrder)
+        self.assertEqual(test.data(test.index(0, column)), "entry 24")
+        test.set_filter("entry 0")
+        self.assertEqual(test.rowCount(), 10)
+        self.assertEqual(test.data(test.index(0, column)), "entry 09")
+        self.assertEqual(source.rowCount(), 10, msg="The source model should filter the rows.")
+
+
+class DisplayTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db = DbManager()
+        self.db.initialize(db=path.join(self.temp_dir.name, "diary.db"))
+        self.first = Entry(title="first", timestamp=date(2020, 5, 17))
+        self.first.files = [File(name="a.jpg")]
+        self.second = Entry(title="second", timestamp=date(2021, 1, 2))
+        self.second.files = [File(name="b.jpg"), File(name="c.jpg")]
+        self.db.add(self.first, self.second)
+        self.db.commit()
+        self.test = SqlAlchemyQueryModel(self.db.read(Entry))
+        self.test.set_relation_display("files", "name")
+        self.files = QueryModelTest.column(self.test, "files")
+
+    def tearDown(self):
+        self.db.session.remove()
+        self.db.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def displayed_files(self):
+        return [self.test.data(self.test.index(row, self.files))
+                for row in range(self.test.rowCount())]
+
+    def test_cache_cleared_by_flush(self):
+        self.assertEqual(self.displayed_files(), ["a.jpg", "b.jpg, c.jpg"])
+        self.first.files.append(File(name="d.jpg"))
+        self.assertEqual(self.displayed_files()[0], "a.jpg", msg="The cache should be used.")
+        self.db.session.flush()
+        self.assertEqual(self.displayed_files(), ["a.jpg, d.jpg", "b.jpg, c.jpg"])
+        self.second.files = list()
+        self.db.commit()
+        self.assertEqual(self.displayed_files(), ["a.jpg, d.jpg", ""])
+
+    def test_cache_cleared_by_set_data(self):
+        self.test.set_commit_delay(60000)  # no flush before the display is checked
+        self.displayed_files()
+        self.assertTrue(self.test.setData(self.test.index(0, self.files),
+                                          self.second.files + self.first.files))
+        self.assertEqual(self.displayed_files(), ["b.jpg, c.jpg, a.jpg", "b.jpg, c.jpg"])
+
+    def test_cache_cleared_by_inserting_and_removing(self):
+        self.displayed_files()
+        self.test.insertRows(0, 1)
+        self.assertEqual(self.displayed_files(), ["", "a.jpg", "b.jpg, c.jpg"])
+        self.test.removeRows(0, 2)
+        self.assertEqual(self.displayed_files(), ["b.jpg, c.jpg"])
+
+    def test_model_columns(self):
+        self.assertEqual(self.test.data(self.test.index(0, 3)), QDate(2020, 5, 17))
+        self.assertIs(self.test.data(self.test.index(1, 1), Qt.UserRole), self.second)
+        self.assertTrue(self.test.flags(self.test.index(0, 1)) & Qt.ItemIsEditable)
+        self.assertTrue(self.test.setData(self.test.index(0, 3), QDate(2020, 6, 1)))
+        self.assertEqual(self.first.timestamp, date(2020, 6, 1))
+
+    def test_single_columns(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry.title, Entry.timestamp))
+        self.assertEqual([field["type"] for field in test.meta_columns], ["attr", "attr"])
+        self.assertEqual(test.data(test.index(1, 0)), "second")
+        self.assertEqual(test.data(test.index(1, 1)), QDate(2021, 1, 2))
+        self.assertEqual(test.data(test.index(0, 0), Qt.UserRole), "first")
+        self.assertFalse(test.flags(test.index(0, 0)) & Qt.ItemIsEditable)
+
+    def test_collection_of_models(self):
+        test = SqlAlchemyQueryModel(self.db.read(Entry, File).join(Entry.files)
+                                    .order_by(File.name))
+        names = [field["class_name"] + "." + field["name"] for field in test.meta_columns]
+        title, name = names.index("Entry.title"), names.index("File.name")
+        self.assertEqual([(test.data(test.index(row, title)), test.data(test.index(row, name)))
+                          for row in range(test.rowCount())],
+                         [("first", "a.jpg"), ("second", "b.jpg"), ("second", "c.jpg")])
+        self.assertIs(test.data(test.index(0, name), Qt.UserRole), self.first.files[0])
+        self.assertTrue(test.setData(test.index(0, name), "renamed.jpg"))
+        self.assertEqual(self.first.files[0].name, "renamed.jpg")
+
+
+class AddFileDialogTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.src = path.join(self.temp_dir.name, "notes.txt")
+        with open(self.src, "w") as src_file:
+            src_file.write("some notes")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def store(self, storage):
+        test = SqlAlchemyAddFileDialog("Add", storage=storage)
+        test.sources = [self.src]
+        test.add_pressed()
+        for _ in range(100):  # the result is queued into this thread
+            QTest.qWait(20)
+            if not test._storing:
+                break
+        self.assertFalse(test._storing, msg="The dialog should hear about the end of storing.")
+        return test
+
+    def test_store(self):
+        root = path.join(self.temp_dir.name, "root")
+        os.mkdir(root)
+        test = self.store(FileManager(root))
+        self.assertEqual(test.result(), test.Accepted)
+        self.assertEqual(test.stored, ["notes.txt"])
+
+    def test_store_failing(self):
+        test = self.store(FileManager())  # no root set, store_many() raises a ValueError
+        self.assertIn("not in a valid state", test.meta_data_display.toPlainText())
+        self.assertTrue(test.add_button.isEnabled())
+        self.assertEqual(test.stored, list())
+
+    def test_storage_passed_on(self):
+        db = DbManager()
+        db.initialize()
+        storage = FileManager()
+        test = DiaryViewer()
+        test.set_storage(storage)
+        test.set_source(db.read(Entry))
+        self.assertIs(test.centralWidget().storage, storage)
+        test.set_storage(None)
+        self.assertIsNone(test.centralWidget().storage)
+
+
+if __name__ == "__main__":
+    unittest.main()
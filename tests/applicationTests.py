@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import asyncio
 import unittest
 from unittest.mock import MagicMock
 from diary.application import App, Component
@@ -85,6 +86,10 @@ class ComponentTest(unittest.TestCase):
         def test_method(self):
             pass
 
+        @Component.dependent
+        async def test_async_method(self):
+            return "done"
+
     def test_is_valid_for_invalid_state(self):
         test_obj = self.TestClass()
         test_obj.test = test_obj.invalid_state("test", None)
@@ -148,6 +153,15 @@ class ComponentTest(unittest.TestCase):
                                msg="calling decorated method in invalid state should raise error"):
             test_obj.test_method()
 
+    def test_dependent_decorator_async(self):
+        test_obj = self.TestClass()
+        test_obj.test = test_obj.invalid_state("test", None)
+        with self.assertRaises(ValueError,
+                               msg="awaiting decorated coroutine in invalid state should raise"):
+            asyncio.run(test_obj.test_async_method())
+        test_obj.test = "valid"
+        self.assertEqual(asyncio.run(test_obj.test_async_method()), "done")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
 import unittest
-from diary.database import DbManager
-from diary.models import Entry
+from unittest.mock import MagicMock, call
+from sqlalchemy import inspect
+from diary.database import DbManager, AsyncDbManager
+from diary.models import Entry, File, entry_files
 
 
 class TestDbManager(unittest.TestCase):
@@ -34,6 +41,41 @@ class TestDbManager(unittest.TestCase):
         with self.assertRaises(ValueError, msg="Invalid action tag should raise ValueError."):
             self.db._session_action("wrong", test1, test2)
 
+    def test_set_loading_invalid_strategy(self):
+        with self.assertRaises(ValueError, msg="Unknown loading strategy should raise ValueError."):
+            self.db.set_loading("eager")
+
+    def test_configure_loading(self):
+        config = MagicMock()
+        settings = {"relation_loading": "joined"}
+        config.get.side_effect = lambda key, section: settings[key]
+        self.db.configure(config)
+        config.get.assert_any_call("relation_loading", "database")
+        self.assertEqual(self.db._loading, "joined")
+
+    def test_configure_profile(self):
+        config = MagicMock()
+        settings = {"profile": "fast", "cache_size": "-1000"}
+        config.get.side_effect = lambda key, section: settings[key]
+        self.db.configure(config)
+        self.assertEqual(self.db._pragmas["synchronous"], "NORMAL")
+        self.assertEqual(self.db._pragmas["cache_size"], -1000,
+                         msg="Single pragmas should override the profile.")
+
+    def test_set_profile_invalid(self):
+        with self.assertRaises(ValueError, msg="Unknown profile should raise ValueError."):
+            self.db.set_profile("fastest")
+        with self.assertRaises(ValueError, msg="Unknown pragma should raise ValueError."):
+            self.db.set_profile(foreign_keys=1)
+        with self.assertRaises(ValueError, msg="Invalid value should raise ValueError."):
+            self.db.set_profile(synchronous="FULL; DROP TABLE entries")
+
+    def test_configure_missing_key(self):
+        config = MagicMock()
+        config.get.side_effect = KeyError("relation_loading")
+        self.db.configure(config)
+        self.assertEqual(self.db._loading, "select")
+
 
 class TestDbManagerIntegration(unittest.TestCase):
 
@@ -64,6 +106,224 @@ class TestDbManagerIntegration(unittest.TestCase):
         result = self.db.read(Entry).filter_by(title="test2").one()
         self.assertIs(result, test2)
 
+    def test_read_loading_strategies(self):
+        test1 = Entry(title="test1", text="test text1")
+        test1.files = [File(name="file1"), File(name="file2")]
+        self.db.add(test1)
+        self.db.commit()
+        for strategy in ("selectin", "joined", "subquery"):
+            self.db.session.expunge_all()
+            result = self.db.read(Entry, loading=strategy).one()
+            self.assertNotIn("files", inspect(result).unloaded,
+                             msg="'{}' should load files with the entry.".format(strategy))
+            self.assertEqual(len(result.files), 2)
+        self.db.session.expunge_all()
+        result = self.db.read(Entry).one()
+        self.assertIn("files", inspect(result).unloaded,
+                      msg="Default strategy should load files lazily.")
+
+    def test_bulk_insert(self):
+        progress = MagicMock()
+        count = self.db.bulk_insert(Entry, ({"id": number, "title": "bulk{}".format(number)}
+                                            for number in range(1, 6)),
+                                    chunk_size=2, progress=progress)
+        self.db.bulk_insert(File, [{"id": 1, "name": "file1"}, {"id": 2}])
+        self.db.bulk_insert(entry_files, [{"entry_id": 1, "file_id": 1},
+                                          {"entry_id": 1, "file_id": 2}])
+        self.db.commit()
+        self.assertEqual(count, 5)
+        progress.assert_has_calls([call(2), call(4), call(5)])
+        self.assertEqual(self.db.read(Entry).count(), 5)
+        entry = self.db.read(Entry).filter_by(id=1).one()
+        self.assertEqual(sorted(file.id for file in entry.files), [1, 2])
+        self.assertIsNone(self.db.read(File).filter_by(id=2).one().name,
+                          msg="Missing values should be inserted as NULL.")
+
+    def test_bulk_insert_invalid_target(self):
+        with self.assertRaises(TypeError, msg="Invalid target should raise TypeError."):
+            self.db.bulk_insert("entries", [{"id": 1}])
+        with self.assertRaises(ValueError, msg="Unknown columns should raise ValueError."):
+            self.db.bulk_insert(Entry, [{"id": 1, "wrong": 2}])
+
+    def test_stream(self):
+        self.db.bulk_insert(Entry, ({"title": "stream{}".format(number), "text": "text"}
+                                    for number in range(25)))
+        result = list(self.db.stream(Entry, chunk_size=10))
+        self.assertEqual(len(result), 25)
+        self.assertTrue(all(isinstance(entry, Entry) for entry in result))
+
+    def test_stream_eager_query(self):
+        self.db.bulk_insert(Entry, ({"title": "stream{}".format(number), "text": "text"}
+                                    for number in range(25)))
+        for strategy in ("joined", "subquery"):
+            self.db.set_loading(strategy)
+            result = list(self.db.stream(self.db.read(Entry), chunk_size=10))
+            self.assertEqual(len(result), 25)
+
+    def test_stream_plain_query(self):
+        self.db.bulk_insert(Entry, ({"title": "stream{}".format(number), "text": "text"}
+                                    for number in range(25)))
+        query = self.db.read(Entry.id, Entry.title).filter(Entry.title.like("stream1%"))
+        result = list(self.db.stream(query, chunk_size=4, plain=True))
+        self.assertEqual(len(result), 11)
+        self.assertEqual(tuple(result[0]), (2, "stream1"))
+
+    def test_stream_invalid_chunk_size(self):
+        with self.assertRaises(ValueError, msg="chunk_size of 0 should raise ValueError."):
+            self.db.stream(Entry, chunk_size=0)
+
+
+class TestDbManagerSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = DbManager()
+        self.db.initialize(db=os.path.join(self.directory.name, "test.db"), busy_timeout=1234)
+
+    def tearDown(self):
+        self.db.release_session()
+        self.db.engine.dispose()
+        self.directory.cleanup()
+
+    def test_pragmas(self):
+        connection = self.db.engine.connect()
+        self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "wal")
+        self.assertEqual(connection.execute("PRAGMA synchronous").scalar(), 2)  # FULL
+        self.assertEqual(connection.execute("PRAGMA busy_timeout").scalar(), 1234)
+        connection.close()
+
+    def test_indexes_added_to_existing_database(self):
+        self.db.release_session()
+        self.db.engine.dispose()
+        path = os.path.join(self.directory.name, "old.db")
+        connection = sqlite3.connect(path)
+        connection.executescript("""
+            CREATE TABLE entries (id INTEGER PRIMARY KEY, title VARCHAR(80), text TEXT,
+                                  timestamp DATE);
+            CREATE TABLE files (id INTEGER PRIMARY KEY, name VARCHAR(80), subpath VARCHAR(120),
+                                type VARCHAR(10), timestamp DATE);
+            CREATE TABLE entry_files (entry_id INTEGER, file_id INTEGER,
+                                      PRIMARY KEY (entry_id, file_id));
+            """)
+        connection.close()
+        self.db.initialize(db=path)
+        indexes = {index["name"] for table in ("entries", "files", "entry_files")
+                   for index in inspect(self.db.engine).get_indexes(table)}
+        self.assertTrue({"ix_entries_timestamp", "ix_files_name", "ix_files_timestamp",
+                         "ix_entry_files_file_id"}.issubset(indexes))
+
+    def test_using_profile(self):
+        with self.db.using_profile("bulk-load"):
+            connection = self.db.engine.connect()
+            self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "memory")
+            self.assertEqual(connection.execute("PRAGMA synchronous").scalar(), 0)  # OFF
+            self.assertEqual(connection.execute("PRAGMA temp_store").scalar(), 2)  # MEMORY
+            connection.close()
+        connection = self.db.engine.connect()
+        self.assertEqual(connection.execute("PRAGMA journal_mode").scalar(), "wal")
+        self.assertEqual(connection.execute("PRAGMA busy_timeout").scalar(), 1234)
+        connection.close()
+
+    def test_using_profile_in_session(self):
+        self.db.add(Entry(title="before"))
+        self.db.read(Entry).all()  # the session holds a connection in an open transaction
+        with self.db.using_profile("bulk-load"):
+            self.assertEqual(self.db.session.execute("PRAGMA journal_mode").scalar(), "memory")
+            self.assertEqual(self.db.session.execute("PRAGMA synchronous").scalar(), 0)  # OFF
+            self.db.bulk_insert(Entry, [{"title": "imported"}])
+        self.assertEqual(self.db.session.execute("PRAGMA journal_mode").scalar(), "wal")
+        self.assertEqual(self.db.session.execute("PRAGMA synchronous").scalar(), 2)  # FULL
+        self.assertEqual(sorted(entry.title for entry in self.db.read(Entry)),
+                         ["before", "imported"])
+        with self.assertRaises(RuntimeError):
+            with self.db.using_profile("bulk-load"):
+                self.db.add(Entry(title="failed"))
+                raise RuntimeError()
+        self.assertEqual(self.db.read(Entry).count(), 2,
+                         msg="Changes of a failing block should be rolled back.")
+
+    def test_session_per_thread(self):
+        sessions = list()
+
+        def worker():
+            sessions.append(self.db.session())
+            self.db.add(Entry(title="from worker"))
+            self.db.commit()
+            self.db.release_session()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], self.db.session(),
+                         msg="Every thread should get its own session.")
+        self.assertEqual(self.db.read(Entry).one().title, "from worker")
+
+    def test_task_session(self):
+        with self.db.task_session() as session:
+            self.assertIsNot(session, self.db.session())
+            session.add(Entry(title="task"))
+        self.assertEqual(self.db.read(Entry).count(), 1)
+
+    def test_task_session_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.task_session() as session:
+                session.add(Entry(title="task"))
+                session.flush()
+                raise RuntimeError()
+        self.assertEqual(self.db.read(Entry).count(), 0)
+
+
+class TestAsyncDbManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = DbManager()
+        self.db.initialize(db=os.path.join(self.directory.name, "test.db"))
+        self.async_db = AsyncDbManager(self.db, workers=2)
+
+    def tearDown(self):
+        self.async_db.shutdown()
+        self.db.engine.dispose()
+        self.directory.cleanup()
+
+    def test_invalid_state(self):
+        async_db = AsyncDbManager()
+        with self.assertRaises(ValueError, msg="Awaiting without DbManager should raise."):
+            asyncio.run(async_db.read(Entry))
+        async_db.shutdown()
+
+    def test_add_read_delete(self):
+        async def work():
+            await asyncio.gather(*(self.async_db.add(Entry(title="async{}".format(number)))
+                                   for number in range(5)))
+            entries = await self.async_db.read(Entry, where=Entry.title != "async0")
+            await self.async_db.delete(*entries)
+            return entries, await self.async_db.read(Entry)
+
+        deleted, remaining = asyncio.run(work())
+        self.assertEqual(len(deleted), 4)
+        self.assertEqual([entry.title for entry in remaining], ["async0"])
+
+    def test_add_invalid_type(self):
+        with self.assertRaises(TypeError, msg="Invalid item type should raise TypeError."):
+            asyncio.run(self.async_db.add("dummy"))
+
+    def test_run_rollback(self):
+        def failing(session):
+            session.add(Entry(title="lost"))
+            session.flush()
+            raise RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(self.async_db.run(failing))
+        self.assertEqual(self.db.read(Entry).count(), 0)
+
+    def test_search(self):
+        self.db.add(Entry(title="Rome", text="colosseum"))
+        self.db.commit()
+        result = asyncio.run(self.async_db.search("colosseum"))
+        self.assertEqual([match.entry.title for match in result], ["Rome"])
+
 
 if __name__ == '__main__':
     unittest.main()
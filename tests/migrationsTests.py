@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import unittest
+from sqlalchemy import create_engine, event, inspect, MetaData, Table, Column, Integer, String, \
+    select
+from diary.migrations import Migrator, Migration, migrations
+from diary.models import Model
+
+
+class MigratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+
+    def test_schema_matches_models(self):
+        """
+        Test if applying all migrations results in the schema declared by diary.models.
+        """
+        Migrator(self.engine).upgrade()
+        inspector = inspect(self.engine)
+        for table in Model.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            self.assertEqual(columns, set(table.columns.keys()),
+                             msg="Columns of '{}' don't match the model.".format(table.name))
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            self.assertEqual(indexes, {index.name for index in table.indexes},
+                             msg="Indexes of '{}' don't match the model.".format(table.name))
+
+    def test_version_stored(self):
+        migrator = Migrator(self.engine)
+        self.assertEqual(migrator.current_version(), 0)
+        self.assertEqual(migrator.upgrade(), len(migrations))
+        self.assertEqual(migrator.current_version(), migrator.latest_version)
+        self.assertEqual(migrator.pending(), list())
+
+    def test_up_to_date_costs_single_query(self):
+        Migrator(self.engine).upgrade()
+        statements = list()
+        event.listen(self.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+        self.assertEqual(Migrator(self.engine).upgrade(), 0)
+        self.assertEqual(len(statements), 1, msg="Only the version should be queried.")
+
+    def test_existing_unversioned_database(self):
+        Model.metadata.create_all(self.engine)
+        self.engine.execute("INSERT INTO entries (id, title) VALUES (1, 'kept')")
+        Migrator(self.engine).upgrade()
+        self.assertEqual(self.engine.execute("SELECT title FROM entries").scalar(), "kept")
+
+    def test_full_text_index(self):
+        Migrator(self.engine, [item for item in migrations if item.version < 4]).upgrade()
+        self.engine.execute("INSERT INTO entries (id, title, text) VALUES (1, 'kept', 'old')")
+        Migrator(self.engine).upgrade()
+        self.engine.execute("INSERT INTO entries (id, title, text) VALUES (2, 'new', 'old')")
+        matches = "SELECT rowid FROM entries_fts WHERE entries_fts MATCH '{}' ORDER BY rowid"
+        self.assertEqual([row[0] for row in self.engine.execute(matches.format("kept"))], [1],
+                         msg="Existing entries should be indexed.")
+        self.assertEqual([row[0] for row in self.engine.execute(matches.format("old"))], [1, 2])
+
+    def test_order_and_batches(self):
+        table = Table("items", MetaData(), Column("id", Integer, primary_key=True),
+                      Column("value", String(10)))
+        batches = list()
+
+        def create(context):
+            table.create(context.connection)
+            context.connection.execute(table.insert(), [{"id": number, "value": "old"}
+                                                        for number in range(1, 26)])
+
+        def rewrite(context):
+            def update(connection, low, high):
+                batches.append((low, high))
+                connection.execute(table.update().where(table.c.id.between(low, high))
+                                   .values(value="new"))
+            context.batched(table, update, batch_size=10)
+
+        applied = list()
+        migrator = Migrator(self.engine, [Migration(2, rewrite, True),
+                                          Migration(1, create, False)])
+        migrator.upgrade(progress=applied.append)
+        self.assertEqual(applied, [1, 2])
+        self.assertEqual(batches, [(1, 10), (11, 20), (21, 30)])
+        values = {row[0] for row in self.engine.execute(select([table.c.value]))}
+        self.assertEqual(values, {"new"})
+
+    def test_failed_migration_rolls_back(self):
+        def failing(context):
+            context.connection.execute("CREATE TABLE broken (id INTEGER)")
+            raise RuntimeError()
+
+        migrator = Migrator(self.engine, [Migration(1, failing, False)])
+        with self.assertRaises(RuntimeError):
+            migrator.upgrade()
+        self.assertEqual(migrator.current_version(), 0)
+        self.assertNotIn("broken", inspect(self.engine).get_table_names())
+
+    def test_duplicate_versions(self):
+        with self.assertRaises(ValueError, msg="Duplicate versions should raise ValueError."):
+            Migrator(self.engine, [Migration(1, None, False), Migration(1, None, False)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from os import path
+from diary.previews import PreviewCache, Preview
+from diary.storage import FileManager
+
+
+class PreviewCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        self.cache_dir = path.join(self.temp_dir.name, "cache")
+        os.mkdir(self.root)
+        self.manager = FileManager(root=self.root)
+        self.cache = PreviewCache(self.manager, self.cache_dir, excerpt_length=20)
+
+    def tearDown(self):
+        self.cache.shutdown()
+        self.temp_dir.cleanup()
+
+    def store(self, name, text):
+        src = path.join(self.temp_dir.name, name)
+        with open(src, "w") as src_file:
+            src_file.write(text)
+        return self.manager.store(src)
+
+    def test_text_excerpt(self):
+        item = self.store("notes.txt", "Dear   diary,\n\ntoday was a very good day.")
+        callback = MagicMock()
+        preview = self.cache.request(item, callback).result()
+        self.assertEqual(preview, Preview("text", "Dear diary, today wa"))
+        callback.assert_called_once_with(item, preview)
+        self.assertEqual(self.cache.get(item), preview, msg="Preview should be cached.")
+
+    def test_cached_on_disk(self):
+        item = self.store("notes.txt", "notes")
+        generator = MagicMock(return_value=Preview("text", "generated"))
+        self.cache.register("text/", generator)
+        self.cache.request(item).result()
+        self.cache.request(item).result()
+        self.assertEqual(generator.call_count, 1)
+        cache = PreviewCache(self.manager, self.cache_dir, excerpt_length=20)
+        self.assertEqual(cache.get(item), Preview("text", "generated"),
+                         msg="Previews should survive in the cache directory.")
+        cache.shutdown()
+
+    def test_changed_file(self):
+        item = self.store("notes.txt", "old notes")
+        self.cache.request(item).result()
+        os.utime(path.join(self.root, item), (0, 0))
+        self.assertIsNone(self.cache.get(item))
+        self.assertIsNotNone(self.cache.request(item).result())
+
+    def test_lru_eviction(self):
+        self.cache.max_size = 2 * (100 + PreviewCache.entry_overhead)
+        self.cache.register("text/", lambda read, cache: Preview("text", "x" * 100))
+        items = [self.store("{}.txt".format(number), "notes") for number in range(3)]
+        self.cache.request(items[0]).result()
+        self.cache.request(items[1]).result()
+        self.cache.get(items[0])  # items[1] becomes the least recently used
+        self.cache.request(items[2]).result()
+        self.assertIsNotNone(self.cache.get(items[0]))
+        self.assertIsNone(self.cache.get(items[1]))
+        self.assertLessEqual(self.cache.size, self.cache.max_size)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_without_preview(self):
+        item = self.store("video.mp4", "not really a video")
+        self.assertIsNone(self.cache.request(item).result())
+        failing = self.store("broken.txt", "text")
+        self.cache.register("text/", MagicMock(side_effect=ValueError()))
+        self.assertIsNone(self.cache.request(failing).result())
+
+    def test_request_path(self):
+        src = path.join(self.temp_dir.name, "outside.txt")
+        with open(src, "w") as src_file:
+            src_file.write("not stored")
+        self.assertEqual(self.cache.request_path(src).result(), Preview("text", "not stored"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import tempfile
+import unittest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from diary.database import DbManager
+from diary.models import Entry
+from diary.search import SearchIndex, SqliteSearchIndex
+
+
+class TestSqliteSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DbManager()
+        self.db.initialize()
+        self.rome = Entry(title="Holiday in Rome", text="We visited the colosseum and ate pasta.")
+        self.work = Entry(title="Work", text="Rome was not built in a day.")
+        self.db.add(self.rome, self.work)
+        self.db.commit()
+
+    def test_index_type(self):
+        self.assertIsInstance(self.db.search_index, SqliteSearchIndex,
+                              msg="SQLite with FTS5 should use the SqliteSearchIndex.")
+
+    def test_startup_leaves_schema_alone(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db = DbManager()
+            db.initialize(db=os.path.join(temp_dir, "diary.db"))
+            db.engine.dispose()
+            statements = list()
+
+            def record(connection, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(Engine, "before_cursor_execute", record)
+            try:
+                db = DbManager()
+                db.initialize(db=os.path.join(temp_dir, "diary.db"))
+            finally:
+                event.remove(Engine, "before_cursor_execute", record)
+            db.engine.dispose()
+        self.assertIsInstance(db.search_index, SqliteSearchIndex)
+        self.assertFalse([statement for statement in statements
+                          if "CREATE" in statement or "sqlite_master" in statement],
+                         msg="An up to date database shouldn't be probed or changed.")
+
+    def test_search(self):
+        result = self.db.search("colosseum")
+        self.assertEqual([match.entry for match in result], [self.rome])
+        self.assertIn("[colosseum]", result[0].text,
+                      msg="Matched terms should be highlighted in the snippet.")
+
+    def test_search_prefix_and_all_terms(self):
+        self.assertEqual(len(self.db.search("rom")), 2)
+        self.assertEqual([match.entry for match in self.db.search("rome day")], [self.work])
+
+    def test_search_follows_changes(self):
+        self.rome.title = "Trip"
+        self.rome.text = "Paris"
+        self.db.delete(self.work)
+        self.db.add(Entry(title="Rome again", text=""))
+        self.db.commit()
+        result = self.db.search("rome")
+        self.assertEqual([match.entry.title for match in result], ["Rome again"])
+
+    def test_search_pending_changes(self):
+        self.db.add(Entry(title="Venice", text="Not committed yet"))
+        self.assertEqual(len(self.db.search("venice")), 1,
+                         msg="Search should include added but uncommitted entries.")
+
+    def test_search_query_syntax_is_escaped(self):
+        self.assertEqual(self.db.search('"rome AND NOT (day'), list())
+        self.assertEqual(self.db.search("   "), list())
+
+    def test_filter_search(self):
+        result = self.db.filter_search(self.db.read(Entry), "pasta").all()
+        self.assertEqual(result, [self.rome])
+
+
+class TestSearchIndex(unittest.TestCase):
+    """
+    Tests the generic implementation used for databases without a full-text index.
+    """
+
+    def setUp(self):
+        self.db = DbManager()
+        self.db.initialize()
+        self.db.search_index = SearchIndex(self.db.engine)
+        self.db.add(Entry(title="Rome", text="The city of Rome."),
+                    Entry(title="Work", text="Rome was not built in a day, 100% true."))
+        self.db.commit()
+
+    def test_search_ranking(self):
+        result = self.db.search("rome")
+        self.assertEqual([match.entry.title for match in result], ["Rome", "Work"],
+                         msg="Matches in the title should rank higher.")
+        self.assertEqual(result[0].title, "[Rome]")
+
+    def test_search_limit(self):
+        self.assertEqual(len(self.db.search("rome", limit=1)), 1)
+
+    def test_search_escapes_wildcards(self):
+        self.assertEqual(len(self.db.search("100%")), 1)
+        self.assertEqual(len(self.db.search("%")), 1)
+
+    def test_filter_search(self):
+        result = self.db.filter_search(self.db.read(Entry), "city rome").all()
+        self.assertEqual([entry.title for entry in result], ["Rome"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock, patch, call
+from unittest.mock import MagicMock, patch
 from os import path
-from diary.storage import FileManager
+from concurrent.futures import CancelledError
+from diary.database import DbManager
+from diary.models import File
+from diary.storage import FileManager, LocalStorage, codecs, copy_file
 
 
 class FileManagerTest(unittest.TestCase):
@@ -71,45 +80,48 @@ class FileManagerTest(unittest.TestCase):
             test.get_info("test")
 
     def test_store_new_file(self):
-        test_root = "./testroot"
         test_file = "storage_test.py"
-        source_location = "/tmp"
-        source_path = path.abspath(path.join(source_location, test_file))
-        target_path = path.abspath(path.join(test_root, test_file))
-        exists_mock = MagicMock(side_effect=lambda mock_path: {path.abspath(test_root): True,
-                                                               target_path: False}[mock_path])
-        exists_expected_calls = [call(path.abspath(test_root)),
-                                 call(target_path)]
-        isfile_mock = MagicMock(return_value=True)
-        copy_mock = MagicMock()
-        with patch("shutil.copy", copy_mock),\
-             patch("os.path.exists", exists_mock),\
-             patch("os.path.isfile", isfile_mock):
+        with tempfile.TemporaryDirectory() as test_root:
+            source_path = path.join(test_root, test_file)
+            with open(source_path, "w") as src_file:
+                src_file.write("content")
+            target_root = path.join(test_root, "root")
+            os.mkdir(target_root)
+            copy_mock = MagicMock(side_effect=copy_file)
+            with patch("diary.storage.copy_file", copy_mock):
+                test = FileManager(root=target_root)
+                self.assertEqual(test.store(source_path), test_file)
+            src, temp_path, exclusive, buffer_size, hardlink = copy_mock.call_args[0]
+            self.assertEqual((src, exclusive, buffer_size, hardlink),
+                             (source_path, True, LocalStorage.copy_buffer_size, False))
+            self.assertEqual(path.dirname(temp_path), target_root)
+            self.assertTrue(temp_path.endswith(".tmp"))
+            self.assertEqual(os.listdir(target_root), [test_file],
+                             msg="Only the stored file should be left in the root.")
+
+    def test_store_existing_file(self):
+        with tempfile.TemporaryDirectory() as test_root:
+            source_path = path.join(test_root, "storage_test.py")
+            with open(source_path, "w") as src_file:
+                src_file.write("content")
+            copy_mock = MagicMock(side_effect=FileExistsError())
+            with patch("diary.storage.copy_file", copy_mock):
                 test = FileManager(root=test_root)
-                test.store(source_path)
-        exists_mock.assert_has_calls(exists_expected_calls)
-        isfile_mock.assert_called_with(source_path)
-        copy_mock.assert_called_with(source_path, path.abspath(test_root))
+                with self.assertRaises(FileExistsError):
+                    test.store(source_path)
 
     def test_retrieve(self):
-        test_root = "./testroot"
         test_file = "storage_test.py"
-        target_dir = "/tmp/testdir"
-        src_path = path.abspath(path.join(test_root, test_file))
-        target_path = path.abspath(target_dir)
-        isdir_mock = MagicMock(return_value=True)
-        isfile_mock = MagicMock(return_value=True)
-        exists_mock = MagicMock(return_value=True)
-        copy_mock = MagicMock()
-        with patch("os.path.isdir", isdir_mock),\
-             patch("os.path.isfile", isfile_mock),\
-             patch("os.path.exists", exists_mock),\
-             patch("shutil.copy", copy_mock):
-                test = FileManager(root=test_root)
-                test.retrieve(test_file, target_dir)
-        isdir_mock.assert_called_with(target_path)
-        isfile_mock.assert_called_with(src_path)
-        copy_mock.assert_called_with(src_path, target_path)
+        with tempfile.TemporaryDirectory() as test_root, \
+                tempfile.TemporaryDirectory() as target_dir:
+            with open(path.join(test_root, test_file), "w") as src_file:
+                src_file.write("content")
+            test = FileManager(root=test_root)
+            test.retrieve(test_file, target_dir)
+            with open(path.join(target_dir, test_file)) as result:
+                self.assertEqual(result.read(), "content")
+            with self.assertRaises(NotADirectoryError):
+                test.retrieve(test_file, path.join(target_dir, "nonexistent"))
 
     def test_delete(self):
         test_root = "./testroot"
@@ -142,5 +154,525 @@ class FileManagerTest(unittest.TestCase):
                          msg="Returned Obj's 'path' should match '{}'.".format(src_path))
 
 
+class ContentAddressedTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        os.mkdir(self.root)
+        self.src = path.join(self.temp_dir.name, "photo.jpg")
+        with open(self.src, "wb") as src_file:
+            src_file.write(b"image data")
+        self.test = FileManager(root=self.root, content_addressed=True)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def blobs(self):
+        return [name for _, _, names in os.walk(path.join(self.root, "blobs"))
+                for name in names if not name.endswith(".refs")]
+
+    def test_store_deduplicates(self):
+        self.assertEqual(self.test.store(self.src), "photo.jpg")
+        self.assertEqual(self.test.store(self.src, name="copy.jpg", hierarchy="2020/rome"),
+                         path.join("2020/rome", "copy.jpg"))
+        digest = FileManager.hash_file(self.src)
+        self.assertEqual(self.blobs(), [digest], msg="Same content should be stored once.")
+        info = self.test.get_info("2020/rome/copy.jpg")
+        self.assertEqual(info["hash"], digest)
+        self.assertEqual(info["path"], path.join(self.root, "blobs", digest[:2], digest[2:4],
+                                                 digest))
+        with self.assertRaises(FileExistsError):
+            self.test.store(self.src)
+
+    def test_delete_keeps_referenced_blobs(self):
+        self.test.store(self.src)
+        self.test.store(self.src, name="copy.jpg")
+        self.test.delete("photo.jpg")
+        self.assertFalse(self.test.exists("photo.jpg"))
+        self.assertTrue(self.test.exists("copy.jpg"))
+        self.assertEqual(len(self.blobs()), 1, msg="Referenced content should be kept.")
+        self.test.delete("copy.jpg")
+        self.assertEqual(self.blobs(), list(), msg="Unreferenced content should be removed.")
+
+    def test_retrieve(self):
+        target = path.join(self.temp_dir.name, "target")
+        os.mkdir(target)
+        self.test.store(self.src, hierarchy="2020")
+        self.test.retrieve("2020/photo.jpg", target)
+        with open(path.join(target, "photo.jpg"), "rb") as result:
+            self.assertEqual(result.read(), b"image data")
+
+    def test_failed_store_releases_blob(self):
+        error = OSError(errno.ENOSPC, "No space left")
+        with patch("diary.storage.copy_file", MagicMock(side_effect=error)):
+            with self.assertRaises(OSError):
+                self.test.store(self.src, name="a.jpg")
+        self.test.store(self.src, name="b.jpg")
+        self.test.delete("b.jpg")
+        leftovers = [name for _, _, names in os.walk(path.join(self.root, "blobs"))
+                     for name in names]
+        self.assertEqual(leftovers, list(), msg="Neither blob nor reference count should be left.")
+
+    def test_invalid_item(self):
+        with self.assertRaises(ValueError):
+            self.test.store(self.src, hierarchy="../outside")
+        with self.assertRaises(ValueError):
+            self.test.get_info("/etc/passwd")
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        self.target = path.join(self.temp_dir.name, "target")
+        os.mkdir(self.root)
+        os.mkdir(self.target)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def source(self, name, data):
+        src = path.join(self.temp_dir.name, name)
+        with open(src, "wb") as src_file:
+            src_file.write(data)
+        return src
+
+    def round_trip(self, test, name, data):
+        item = test.store(self.source(name, data))
+        test.retrieve(item, self.target)
+        with open(path.join(self.target, name), "rb") as result:
+            self.assertEqual(result.read(), data, msg="Retrieved file should match the original.")
+        return test.get_info(item)["path"]
+
+    def test_compress_text(self):
+        data = b"Dear diary, today was a good day. " * 1000
+        for codec in codecs:
+            test = FileManager(root=self.root, compressed=codec)
+            test.chunk_size = 1000  # several chunks per file
+            stored = self.round_trip(test, "{}.txt".format(codec), data)
+            self.assertLess(path.getsize(stored), len(data) // 10,
+                            msg="Text should be stored compressed with {}.".format(codec))
+
+    def test_skip_compressed_formats(self):
+        test = FileManager(root=self.root, compressed=True)
+        data = b"\xff\xd8\xff\xe0" + b"a" * 2000
+        stored = self.round_trip(test, "photo.jpg", data)
+        self.assertEqual(path.getsize(stored), len(data),
+                         msg="JPEG files should be stored without compression.")
+
+    def test_incompressible_stored_plain(self):
+        test = FileManager(root=self.root, compressed=True)
+        data = os.urandom(4000)
+        self.assertEqual(path.getsize(self.round_trip(test, "random.bin", data)), len(data))
+
+    def test_magic_is_wrapped(self):
+        test = FileManager(root=self.root, compressed=True)
+        self.round_trip(test, "tricky.bin", b"\x89DIARY" + os.urandom(2000))
+        self.round_trip(test, "small.bin", b"\x89DIARYx" + bytes(8) + b"hello world")
+
+    def test_magic_is_wrapped_without_compression(self):
+        test = FileManager(root=self.root)
+        data = b"\x89DIARYx" + bytes(8) + b"hello world"
+        self.round_trip(test, "tricky.bin", data)
+        item = test.store(self.source("other.bin", data))
+        self.assertEqual(test.read(item), data)
+        with test.view(item) as content:
+            self.assertEqual(bytes(content), data)
+        db = DbManager()
+        db.initialize(db=path.join(self.temp_dir.name, "diary.db"))
+        test = FileManager(root=self.root, backend=db)
+        test.store(self.source("third.bin", data))
+        self.assertEqual(test.reconcile()["changed"], list())
+        db.engine.dispose()
+
+    def test_content_addressed(self):
+        test = FileManager(root=self.root, compressed=True, content_addressed=True)
+        self.round_trip(test, "notes.txt", b"note " * 1000)
+
+    def test_stats(self):
+        test = FileManager(root=self.root, compressed=True)
+        test.store(self.source("notes.txt", b"note " * 1000))
+        test.store(self.source("small.txt", b"note"))
+        stats = test.compression_stats()
+        self.assertEqual((stats["files"], stats["compressed"], stats["size"]), (2, 1, 5004))
+        self.assertEqual(stats["saved"], stats["size"] - stats["stored_size"])
+        self.assertGreater(stats["saved"], 4000)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            FileManager(compressed="unknown")
+
+
+class CopyFileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.src = path.join(self.temp_dir.name, "video.mp4")
+        self.target = path.join(self.temp_dir.name, "copy.mp4")
+        self.data = os.urandom(100000)
+        with open(self.src, "wb") as src_file:
+            src_file.write(self.data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def assertCopied(self, result):
+        self.assertEqual(result[1], len(self.data))
+        with open(self.target, "rb") as target_file:
+            self.assertEqual(target_file.read(), self.data)
+
+    def test_copy(self):
+        self.assertCopied(copy_file(self.src, self.target))
+        self.assertCopied(copy_file(self.src, self.target))  # replaces the existing target
+
+    def test_buffered_fallback(self):
+        unsupported = MagicMock(side_effect=OSError(errno.EXDEV, "Cross-device link"))
+        with patch("diary.storage.fcntl", None), \
+                patch("os.copy_file_range", unsupported, create=True), \
+                patch("os.sendfile", unsupported, create=True):
+            result = copy_file(self.src, self.target, buffer_size=4096)
+        self.assertEqual(result[0], "buffered")
+        self.assertCopied(result)
+
+    def test_exclusive(self):
+        copy_file(self.src, self.target, exclusive=True)
+        with self.assertRaises(FileExistsError):
+            copy_file(self.src, self.target, exclusive=True)
+
+    def test_same_file(self):
+        with self.assertRaises(shutil.SameFileError):
+            copy_file(self.src, self.src)
+        os.link(self.src, self.target)
+        with self.assertRaises(shutil.SameFileError):
+            copy_file(self.src, self.target)
+        with open(self.src, "rb") as src_file:
+            self.assertEqual(src_file.read(), self.data, msg="The source should be untouched.")
+
+    def test_retrieve_into_root(self):
+        root = path.join(self.temp_dir.name, "root")
+        os.mkdir(root)
+        text = path.join(self.temp_dir.name, "notes.txt")
+        with open(text, "wb") as text_file:
+            text_file.write(b"hello " * 1000)
+        for compressed in (False, True):
+            test = FileManager(root=root, compressed=compressed)
+            item = test.store(text, name="item{}.txt".format(int(compressed)))
+            with self.assertRaises(shutil.SameFileError):
+                test.retrieve(item, root)
+            self.assertEqual(test.read(item), b"hello " * 1000,
+                             msg="Retrieving an item onto itself should not truncate it.")
+
+    def test_hardlink(self):
+        result = copy_file(self.src, self.target, exclusive=True, hardlink=True)
+        self.assertEqual(result[0], "hardlink")
+        self.assertTrue(path.samefile(self.src, self.target))
+
+    def test_transfer_hook(self):
+        root = path.join(self.temp_dir.name, "root")
+        os.mkdir(root)
+        reports = list()
+        test = FileManager(root=root)
+        test.set_transfer_hook(reports.append)
+        test.store(self.src)
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]["operation"], "store")
+        self.assertEqual(reports[0]["bytes"], len(self.data))
+        self.assertIn("throughput", reports[0])
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        os.mkdir(self.root)
+        self.sources = list()
+        for number in range(20):
+            self.sources.append(path.join(self.temp_dir.name, "photo{}.jpg".format(number)))
+            with open(self.sources[-1], "w") as src_file:
+                src_file.write(str(number))
+        self.test = FileManager(root=self.root)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_store_many(self):
+        reports = list()
+        sources = self.sources + [path.join(self.temp_dir.name, "missing.jpg"),
+                                  (self.sources[0], "renamed.jpg")]
+        results = self.test.store_many(sources, hierarchy="2020",
+                                       progress=lambda *args: reports.append(args))
+        self.assertEqual([result.source for result in results], sources,
+                         msg="Results should be in the order of the sources.")
+        self.assertIsInstance(results[20].error, ValueError,
+                              msg="Failing files should report their error.")
+        self.assertEqual(results[21].item, path.join("2020", "renamed.jpg"))
+        self.assertEqual(sum(1 for result in results if result.error is None), 21)
+        self.assertEqual(sorted(report[0] for report in reports), list(range(1, 23)))
+        self.assertTrue(all(report[1] == 22 for report in reports))
+
+    def test_store_many_cancel(self):
+        cancel = threading.Event()
+        cancel.set()
+        results = self.test.store_many(self.sources, cancel=cancel)
+        self.assertTrue(all(isinstance(result.error, CancelledError) for result in results))
+        self.assertEqual(os.listdir(self.root), list())
+
+    def test_retrieve_many(self):
+        target = path.join(self.temp_dir.name, "target")
+        os.mkdir(target)
+        items = [result.item for result in self.test.store_many(self.sources, workers=2)]
+        results = self.test.retrieve_many(items + ["missing.jpg"], target)
+        self.assertEqual(results[0].item, path.join(target, "photo0.jpg"))
+        self.assertIsInstance(results[-1].error, FileNotFoundError)
+        self.assertEqual(len(os.listdir(target)), 20)
+
+
+class ReadTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        os.mkdir(self.root)
+        self.data = bytes(range(256)) * 40 + b"end"
+        self.src = path.join(self.temp_dir.name, "video.bin")
+        with open(self.src, "wb") as src_file:
+            src_file.write(self.data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def managers(self):
+        yield FileManager(root=self.root)
+        yield FileManager(root=self.root, compressed=True, content_addressed=True)
+
+    def test_read(self):
+        for test in self.managers():
+            test.chunk_size = 1000
+            item = test.store(self.src, name="{}.bin".format(test._compression))
+            self.assertEqual(test.read(item), self.data)
+            self.assertEqual(test.read(item, offset=2500, length=3000), self.data[2500:5500])
+            self.assertEqual(test.read(item, offset=len(self.data) - 3), b"end")
+            self.assertEqual(test.read(item, offset=len(self.data) + 10, length=5), b"")
+            with self.assertRaises(ValueError):
+                test.read(item, offset=-1)
+
+    def test_iter_chunks(self):
+        for test in self.managers():
+            item = test.store(self.src, name="{}.bin".format(test._compression))
+            chunks = list(test.iter_chunks(item, chunk_size=4096, offset=100))
+            self.assertTrue(all(len(chunk) <= 4096 for chunk in chunks))
+            self.assertEqual(b"".join(chunks), self.data[100:])
+
+    def test_view(self):
+        for test in self.managers():
+            item = test.store(self.src, name="{}.bin".format(test._compression))
+            with test.view(item) as content:
+                self.assertTrue(content.readonly)
+                self.assertEqual(content[-3:].tobytes(), b"end")
+                self.assertEqual(len(content), len(self.data))
+            self.assertRaises(ValueError, len, content)  # released
+
+    def test_view_empty(self):
+        test = FileManager(root=self.root)
+        empty = path.join(self.temp_dir.name, "empty")
+        open(empty, "w").close()
+        with test.view(test.store(empty)) as content:
+            self.assertEqual(len(content), 0)
+
+
+class MetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        os.mkdir(self.root)
+        self.db = DbManager()
+        self.db.initialize(db=path.join(self.temp_dir.name, "diary.db"))
+        self.src = path.join(self.temp_dir.name, "notes.txt")
+        with open(self.src, "w") as src_file:
+            src_file.write("some notes")
+        self.test = FileManager(root=self.root, backend=self.db)
+
+    def tearDown(self):
+        self.db.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def test_store_writes_row(self):
+        item = self.test.store(self.src, ftype="note", hierarchy="2020")
+        row = self.db.read(File).one()
+        self.assertEqual((row.name, row.subpath, row.type, row.size, row.mime),
+                         ("notes.txt", "2020", "note", 10, "text/plain"))
+        self.assertEqual(row.hash, FileManager.hash_file(self.src))
+        self.assertEqual(row.mtime, os.stat(path.join(self.root, item)).st_mtime)
+
+    def test_answers_from_database(self):
+        self.test.store(self.src)
+        with patch("os.path.isfile", MagicMock(return_value=False)):
+            self.assertTrue(self.test.exists("notes.txt"),
+                            msg="exists() should be answered from the database.")
+            info = self.test.get_info("notes.txt")
+        self.assertEqual(info["path"], path.join(self.root, "notes.txt"))
+        self.assertEqual((info["size"], info["mime"], info["type"]), (10, "text/plain", "txt"))
+        self.assertFalse(self.test.exists("other.txt"))
+        with self.assertRaises(FileNotFoundError):
+            self.test.get_info("other.txt")
+
+    def test_store_again_after_external_removal(self):
+        item = self.test.store(self.src)
+        os.remove(path.join(self.root, item))
+        self.test.store(self.src)
+        self.assertEqual(self.db.read(File).count(), 1, msg="The row should be reused.")
+        self.test.delete(item)
+        self.assertFalse(self.test.exists(item))
+        self.assertEqual(self.db.read(File).count(), 0)
+
+    def test_reconcile_keeps_tmp_items(self):
+        item = self.test.store(self.src, name="backup.tmp")
+        with open(path.join(self.root, ".0123456789abcdef.tmp"), "w") as temp_file:
+            temp_file.write("half written")
+        self.assertEqual(self.test.reconcile(fix=True),
+                         {"missing": [], "untracked": [], "changed": []})
+        self.assertTrue(self.test.exists(item))
+        with self.assertRaises(ValueError):
+            self.test.store(self.src, name=".0123456789abcdef.tmp")
+
+    def test_reserved_hierarchies(self):
+        for hierarchy in ("names", "blobs"):
+            with self.assertRaises(ValueError):
+                self.test.store(self.src, hierarchy=hierarchy)
+        self.assertEqual(self.db.read(File).count(), 0)
+        self.assertEqual(os.listdir(self.root), list())
+        self.test.store(self.src, name="names")  # only the directories are reserved
+        self.assertEqual(self.test.reconcile(fix=True),
+                         {"missing": [], "untracked": [], "changed": []})
+        self.assertTrue(self.test.exists("names"))
+
+    def test_delete_removes_row(self):
+        self.test.store(self.src)
+        self.test.delete("notes.txt")
+        self.assertEqual(self.db.read(File).count(), 0)
+        self.assertEqual(os.listdir(self.root), list())
+
+    def test_content_addressed(self):
+        self.test.set(content_addressed=True)
+        self.test.store(self.src)
+        info = self.test.get_info("notes.txt")
+        self.assertEqual(info["path"],
+                         self.test.storage.local_path(self.test._blob_key(info["hash"])))
+
+    def test_content_addressed_concurrent(self):
+        self.test.set(content_addressed=True)
+        put = self.test.storage.put
+        second = threading.Event()
+        calls = list()
+
+        def racing_put(src_path, key, exclusive=True, synced=None):
+            calls.append(key)
+            if len(calls) == 1:
+                second.wait(5)  # until the other store() decided to write the blob as well
+            else:
+                second.set()
+                time.sleep(0.1)  # the first store() writes and indexes the blob meanwhile
+            return put(src_path, key, exclusive, synced)
+
+        self.test.storage.put = racing_put
+        results = self.test.store_many([(self.src, "a.txt"), (self.src, "b.txt")], workers=2)
+        self.assertEqual([result.error for result in results], [None, None])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.test.reconcile(), {"missing": [], "untracked": [], "changed": []},
+                         msg="The blob shouldn't be written again.")
+
+    def test_reconcile(self):
+        for name in ("kept.txt", "changed.txt", "missing.txt"):
+            self.test.store(self.src, name=name)
+        with open(path.join(self.root, "untracked.txt"), "w") as untracked:
+            untracked.write("untracked")
+        os.utime(path.join(self.root, "changed.txt"), (0, 0))
+        os.remove(path.join(self.root, "missing.txt"))
+        expected = {"missing": ["missing.txt"], "untracked": ["untracked.txt"],
+                    "changed": ["changed.txt"]}
+        self.assertEqual(self.test.reconcile(), expected)
+        self.assertEqual(self.test.reconcile(fix=True), expected)
+        self.assertEqual(self.test.reconcile(), {"missing": [], "untracked": [], "changed": []})
+        self.assertEqual(self.test.get_info("untracked.txt")["size"], 9)
+        self.assertEqual(self.test.get_info("changed.txt")["mtime"], 0)
+
+
+class AtomicStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        os.mkdir(self.root)
+        self.sources = list()
+        for number in range(8):
+            self.sources.append(path.join(self.temp_dir.name, "source{}".format(number)))
+            with open(self.sources[-1], "w") as src_file:
+                src_file.write(str(number) * 100000)
+        self.test = FileManager(root=self.root)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_failed_copy_leaves_nothing(self):
+        def broken_copy(src_path, target_path, *args):
+            with open(target_path, "w") as target_file:
+                target_file.write("partial")
+            raise OSError(errno.EIO, "I/O error")
+
+        with patch("diary.storage.copy_file", broken_copy):
+            with self.assertRaises(OSError):
+                self.test.store(self.sources[0], name="photo.jpg")
+        self.assertEqual(os.listdir(self.root), list(),
+                         msg="Neither the item nor the temporary file should be left.")
+
+    def test_concurrent_stores_of_same_name(self):
+        errors = list()
+        barrier = threading.Barrier(len(self.sources))
+
+        def store(src):
+            barrier.wait()
+            try:
+                self.test.store(src, name="photo.jpg")
+            except FileExistsError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=store, args=(src,)) for src in self.sources]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), len(self.sources) - 1,
+                         msg="Exactly one store() should succeed.")
+        with open(path.join(self.root, "photo.jpg")) as stored_file:
+            self.assertIn(stored_file.read(), [number * 100000 for number in "01234567"])
+        self.assertEqual(os.listdir(self.root), ["photo.jpg"])
+
+    def test_without_hardlinks(self):
+        with patch("os.link", MagicMock(side_effect=PermissionError())):
+            self.test.store(self.sources[0], name="photo.jpg")
+            with self.assertRaises(FileExistsError):
+                self.test.store(self.sources[1], name="photo.jpg")
+        with open(path.join(self.root, "photo.jpg")) as stored_file:
+            self.assertEqual(stored_file.read(), "0" * 100000)
+        self.assertEqual(os.listdir(self.root), ["photo.jpg"])
+
+    def test_store_many_syncs_directories_once(self):
+        with patch("diary.storage._fsync_directory") as sync_mock:
+            self.test.store_many(self.sources, hierarchy="2020")
+        sync_mock.assert_called_once_with(path.join(self.root, "2020"))
+        with patch("diary.storage._fsync_directory") as sync_mock:
+            self.test.store(self.sources[0], name="single")
+        sync_mock.assert_called_once_with(self.root)
+
+    def test_content_addressed(self):
+        test = FileManager(root=self.root, content_addressed=True)
+        with patch("diary.storage._fsync_directory") as sync_mock:
+            test.store_many([(self.sources[0], "a"), (self.sources[0], "b")])
+        self.assertEqual(sync_mock.call_count, 2, msg="Blob and names directory are synced.")
+        with self.assertRaises(FileExistsError):
+            test.store(self.sources[1], name="a")
+        self.assertEqual(test.read("a"), test.read("b"))
+        leftovers = [name for _, _, names in os.walk(self.root) for name in names
+                     if name.endswith(".tmp")]
+        self.assertEqual(leftovers, list())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from os import path
+from diary.database import DbManager
+from diary.models import File
+from diary.storage import FileManager
+from diary.watcher import Inotify, StorageWatcher
+
+try:
+    Inotify().close()
+    inotify_available = True
+except OSError:
+    inotify_available = False
+
+
+class StorageWatcherTest(unittest.TestCase):
+    polling = True
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        os.mkdir(self.root)
+        self.db = DbManager()
+        self.db.initialize(db=path.join(self.temp_dir.name, "diary.db"))
+        self.manager = FileManager(root=self.root, backend=self.db)
+        self.watcher = StorageWatcher(self.manager, debounce=0.1, interval=0.1,
+                                      polling=self.polling)
+        self.changes = list()
+        self.watcher.add_listener(self.changes.append)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.db.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def write(self, item, text):
+        os.makedirs(path.dirname(path.join(self.root, item)), exist_ok=True)
+        with open(path.join(self.root, item), "w") as file:
+            file.write(text)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(condition(), msg="Watcher didn't apply the changes in time.")
+
+    def rows(self):
+        with self.db.task_session() as session:
+            return {path.normpath(path.join(row.subpath, row.name)): row.size
+                    for row in session.query(File)}
+
+    def test_external_changes(self):
+        self.write("notes.txt", "notes")
+        self.write("2020/photo.jpg", "photo")
+        self.wait_for(lambda: self.rows() == {"notes.txt": 5, "2020/photo.jpg": 5})
+        self.write("notes.txt", "more notes")
+        os.remove(path.join(self.root, "2020/photo.jpg"))
+        self.wait_for(lambda: self.rows() == {"notes.txt": 10})
+        self.assertIn({"notes.txt", "2020/photo.jpg"}, self.changes,
+                      msg="Listeners should get the changed items.")
+
+    def test_stored_files_are_not_duplicated(self):
+        src = path.join(self.temp_dir.name, "src.txt")
+        with open(src, "w") as file:
+            file.write("source")
+        self.manager.store(src)
+        self.wait_for(lambda: self.changes)
+        self.assertEqual(self.db.read(File).count(), 1)
+
+
+@unittest.skipUnless(inotify_available, "inotify is not available.")
+class InotifyWatcherTest(StorageWatcherTest):
+    polling = False
+
+    def test_uses_inotify(self):
+        self.assertTrue(self.watcher.uses_inotify)
+
+
+class IncrementalReconcileTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = path.join(self.temp_dir.name, "root")
+        os.mkdir(self.root)
+        self.db = DbManager()
+        self.db.initialize(db=path.join(self.temp_dir.name, "diary.db"))
+        self.manager = FileManager(root=self.root, backend=self.db)
+
+    def tearDown(self):
+        self.db.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def test_only_given_items(self):
+        for name in ("a.txt", "b.txt"):
+            with open(path.join(self.root, name), "w") as file:
+                file.write(name)
+        report = self.manager.reconcile(fix=True, items=["a.txt", "missing.txt"])
+        self.assertEqual(report, {"missing": [], "untracked": ["a.txt"], "changed": []})
+        self.assertEqual(self.manager.reconcile()["untracked"], ["b.txt"])
+
+    def test_unchanged_files_are_not_hashed(self):
+        with open(path.join(self.root, "a.txt"), "w") as file:
+            file.write("a")
+        self.manager.reconcile(fix=True)
+        with patch.object(FileManager, "_update_row") as update:
+            self.manager.reconcile(fix=True, items=["a.txt"])
+        update.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()